@@ -4,7 +4,10 @@ title = <value>
 * The title of the input
 
 port = <value>
-* The TCP port to listen at
+* The TCP port to listen at, not needed with unix_socket
+
+unix_socket = <value>
+* Path of a Unix domain socket to listen at instead of port, for interface engines running on the same host. The messages are framed, routed and acknowledged as over TCP. Access is controlled by the permissions of the directory of the socket, and listener_processes is ignored
 
 output_kvp = <value>
 raw HL7 message (filtered) or transformed key-value pairs
@@ -18,3 +21,104 @@ segments or fields to further remove from output, separated with ','.  For examp
 max_long_segment = <value>
 segments longer than this (in bytes) will be removed
 
+max_connections = <value>
+number of connections served at the same time by a fixed pool of workers. Unlimited (one thread per connection) if empty
+
+max_queued_connections = <value>
+connections waiting for a free worker when max_connections is reached, further connections are refused. 0 refuses them immediately, defaults to 64
+
+persistent_connections = <value>
+whether to keep the connections open after sending the ACK, so that a sender can deliver all its messages, and pipeline them, on one connection. Otherwise the connection is closed once the frames received in the first read are answered, and the sender must reconnect for every message. Ignored with max_connections
+
+idle_timeout = <value>
+seconds after which a persistent connection waiting for a new message is closed. Defaults to 10
+
+listener_processes = <value>
+number of processes listening on the same port with SO_REUSEPORT, each one with its own server and output. Dead processes are restarted. Defaults to 1
+
+durable_spool = <value>
+whether to store the messages in a spool under the checkpoint directory before acknowledging them. Messages acknowledged but not yet indexed are replayed when the input restarts
+
+tls_certfile = <value>
+PEM file with the certificate of the server, and optionally its private key. When set, senders must connect with TLS 1.2 or later. Environment variables like $SPLUNK_HOME are expanded
+
+tls_keyfile = <value>
+PEM file with the private key of the server, if not included in tls_certfile
+
+tls_cafile = <value>
+PEM file with the CA certificates used to verify the client certificates
+
+tls_require_client_cert = <value>
+whether to refuse senders that don't present a certificate signed by a CA in tls_cafile
+
+batch_directory = <value>
+directory polled for HL7 batch files (FHS/BHS envelopes). Their messages are indexed like the ones received over MLLP, then the file is moved to the processed subdirectory. A file whose BTS/FTS counts don't match is moved to failed before any of its messages is indexed. The messages of a batch file wait while their sender is above its rate_limits. A file interrupted by a stop is resumed at the next start from a hidden .<name>.offset checkpoint, saved every 100 messages and on stop
+
+queue_high_messages = <value>
+number of messages received but not yet written to Splunk above which new messages are throttled according to backpressure. Unlimited if empty
+
+queue_low_messages = <value>
+number of waiting messages below which throttling stops. Defaults to 80% of queue_high_messages
+
+queue_high_bytes = <value>
+size in bytes of the messages received but not yet written to Splunk above which new messages are throttled. Unlimited if empty
+
+queue_low_bytes = <value>
+size in bytes of the waiting messages below which throttling stops. Defaults to 80% of queue_high_bytes
+
+backpressure = <value>
+what to do with new messages while throttled: hold (default) delays the ACK until the queue drains, up to 30 seconds, then answers AE; AE or AR refuse the message immediately with that acknowledgment code so that the sender retries later. Batches are always held
+
+max_message_size = <value>
+maximum size in bytes of a message received over MLLP. Larger messages are discarded while they are received and handled according to oversize_policy. Unlimited if empty
+
+spill_message_size = <value>
+size in bytes above which a message is written to a temporary file while it is received instead of being buffered in memory, e.g. for messages with embedded documents. These messages are indexed without parsing them
+
+oversize_policy = <value>
+what to do with a message larger than max_message_size: close (default) closes the connection without acknowledging it; AE or AR answer with that acknowledgment code
+
+drain_timeout = <value>
+seconds allowed when Splunk stops the input (SIGTERM, e.g. after a configuration change) to stop accepting connections, let the messages being received get their ACKs and write the queued messages to Splunk. Connections still open after it are closed without ACK, so their senders retry. Defaults to 10
+
+dedupe_cache_size = <value>
+number of recent messages remembered, by sending application, sending facility and control id (MSH-3, MSH-4, MSH-10), to suppress the retransmissions of the senders: a duplicate is not indexed again and gets the ACK sent the first time. Messages without a control id are never suppressed. Disabled if empty. Can't be used with listener_processes, as every listener process would only remember the messages it received
+
+dedupe_persistent = <value>
+whether to also remember older messages, and the ones received before a restart, in a probabilistic filter stored in the checkpoint directory. A new message is mistaken for a duplicate with a probability of dedupe_filter_error_rate: it gets an AA but is not indexed, and a warning "Probable duplicate message" is logged with its control id
+
+dedupe_filter_size = <value>
+number of messages remembered by the persistent filter, which uses about 8.4 bytes per message at the default error rate. Defaults to 1000000
+
+dedupe_filter_error_rate = <value>
+probability of the persistent filter mistaking a new message for a duplicate, i.e. the share of the new messages lost. Each division by 10 adds about 1.2 bytes per message to the filter. Changing it resets the filter. Defaults to 0.0000001
+
+fair_queue_by = <value>
+how the senders are told apart so that a busy sender doesn't delay the others: facility gives every sending facility (MSH-4), and peer every sender address, its own queue, and the queues are written to Splunk in round robin. While throttled, only the senders with more than their share of the queue are held. All the messages share one queue if empty
+
+sender_weights = <value>
+comma separated list of sender=weight: the number of messages written from a sender at every round, e.g. LAB=4,*=1. * applies to the senders not listed. Defaults to 1
+
+sender_rate_limits = <value>
+comma separated list of sender=rate: the maximum number of messages per second accepted from a sender, e.g. ADT=50,*=200. Messages above the rate are handled according to backpressure. Senders are told apart according to fair_queue_by, by sending facility if empty. Unlimited if empty
+
+parse_workers = <value>
+number of processes parsing the messages in parallel, so that a busy sender can use more than one core. The messages are indexed as received: the workers only parse them to check that they are valid (an invalid message gets an AE application ACK in the enhanced acknowledgment mode) and build their events, so they speed up validation, not transformation. The messages of every sender are still written to Splunk in the order they were received. Parsed one at a time by the input if empty
+
+parse_buffer_size = <value>
+maximum number of messages being parsed or waiting for the messages received before them to be parsed. Defaults to 100 per parse worker
+
+parse_sharding = <value>
+how the messages are spread on the parse workers: sender always gives the messages with the same sending application and facility (MSH-3, MSH-4) to the same worker, peer the messages from the same address. The workers return the events ready to be written to Splunk. If empty, any idle worker parses the next message
+
+application_ack_destinations = <value>
+comma separated list of sending_facility=host:port, e.g. LAB=lab-engine:2576,*=engine:2576. Senders using the enhanced acknowledgment mode (MSH-15/MSH-16 valued) get a commit ACK (CA) as soon as the message is stored, if requested by MSH-15, and an application ACK (AA, or AE if the message can't be parsed), if requested by MSH-16, once it is written to Splunk. The enhanced acknowledgment mode needs durable_spool, as a CA means that the message is on disk: without it the messages are acknowledged in the original mode (AA) and an error is logged. The application ACKs are sent over MLLP to the address of the sending facility, or of *, and are not sent if none is configured. They are written without waiting for an answer, so the destination doesn't have to acknowledge them. With NE the ACK is never sent
+
+relay_destinations = <value>
+comma separated list of host:port of MLLP servers, e.g. other interface engines, receiving a copy of every message accepted by the input, as received, over a persistent connection. Every destination gets the messages in order from its own queue: a message that can't be delivered is sent again at once on a new connection, then after a delay of 1 second that doubles at every attempt up to 60 seconds, and a message refused 5 times by the destination is dropped. A slow destination never delays indexing nor the other destinations. Disabled if empty
+
+relay_queue_size = <value>
+maximum number of messages waiting for a relay destination. When the queue of a destination is full, new messages are not relayed to it. Defaults to 10000
+
+relay_max_in_flight = <value>
+maximum number of messages sent to a relay destination without waiting for their acknowledgments. When one of them is not delivered, it is sent again with the messages after it, so the destination may receive some messages twice. Destinations that close the connection after every acknowledgment, e.g. another instance of this input, need a new connection for every message and gain nothing above 1. Defaults to 1
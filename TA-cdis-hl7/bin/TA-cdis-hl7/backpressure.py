@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+
+"""
+Bounded queue between the MLLP server and the output loop. When the output to Splunk falls behind, the
+queue reports it is throttled, so that the server stops acknowledging new messages until it has drained.
+The queue can keep the messages of every sender apart, so that a busy sender doesn't delay the others, and
+the rate of every sender can be limited with a token bucket.
+"""
+
+from __future__ import absolute_import
+
+import collections
+import threading
+import time
+
+
+class WatermarkQueue(object):
+    """
+    FIFO queue with high and low watermarks, counted both in messages and in bytes.
+
+    The queue becomes throttled when either the number of messages or their size reaches its high watermark,
+    and it stays throttled until both are back below their low watermarks. The watermarks only tell the
+    producers to stop: :func:`put() <WatermarkQueue.put>` never blocks nor fails, so items already accepted
+    are never lost. Producers check :attr:`throttled` or wait with :func:`wait_for_room()
+    <WatermarkQueue.wait_for_room>` before accepting new items.
+
+    :attr:`listener`, if set, is called with the queue whenever it becomes throttled or is released.
+
+    :param high_messages: the number of messages that throttles the queue, ``None`` for no limit
+    :param low_messages: the number of messages that releases it, defaults to 80% of :attr:`high_messages`
+    :param high_bytes: the size of the messages that throttles the queue, ``None`` for no limit
+    :param low_bytes: the size of the messages that releases it, defaults to 80% of :attr:`high_bytes`
+    :param listener: a callable receiving the queue when it is throttled or released
+    """
+    def __init__(self, high_messages=None, low_messages=None, high_bytes=None, low_bytes=None, listener=None):
+        self.set_watermarks(high_messages, low_messages, high_bytes, low_bytes)
+        self.listener = listener
+
+        self.throttled = False
+        self.bytes = 0
+        #: number of times the queue became throttled
+        self.throttle_events = 0
+        #: number of producers that waited for the queue to be released
+        self.held = 0
+        #: number of messages refused while the queue was throttled
+        self.rejected = 0
+        self._throttled_since = None
+        self._throttled_time = 0.0
+
+        self._items = collections.deque()
+        self._cond = threading.Condition(threading.Lock())
+
+    def set_watermarks(self, high_messages=None, low_messages=None, high_bytes=None, low_bytes=None):
+        """
+        Change the watermarks. They are applied when the next item is added or removed
+        """
+        self.high_messages = high_messages
+        self.low_messages = low_messages if low_messages is not None or not high_messages else high_messages * 4 // 5
+        self.high_bytes = high_bytes
+        self.low_bytes = low_bytes if low_bytes is not None or not high_bytes else high_bytes * 4 // 5
+
+    def _above_high(self):
+        return (self.high_messages and self._length() >= self.high_messages) or \
+               (self.high_bytes and self.bytes >= self.high_bytes)
+
+    def _below_low(self):
+        return (not self.high_messages or self._length() <= self.low_messages) and \
+               (not self.high_bytes or self.bytes <= self.low_bytes)
+
+    # storage of the items, called with the lock held
+
+    def _length(self):
+        return len(self._items)
+
+    def _push(self, item, size, sender):
+        self._items.append((item, size))
+
+    def _pop(self):
+        return self._items.popleft()
+
+    def _has_room(self, sender):
+        return not self.throttled
+
+    def _notify(self, changed):
+        if changed and self.listener is not None:
+            self.listener(self)
+
+    def put(self, item, size=0, sender=None):
+        """
+        Append an item to the queue
+
+        :param item: the item
+        :param size: the size of the item in bytes
+        :param sender: the sender of the item, used by :class:`FairQueue`
+        """
+        with self._cond:
+            self._push(item, size, sender)
+            self.bytes += size
+            changed = not self.throttled and self._above_high()
+            if changed:
+                self.throttled = True
+                self.throttle_events += 1
+                self._throttled_since = time.time()
+            self._cond.notify_all()
+        self._notify(changed)
+
+    def get(self, timeout=None):
+        """
+        Remove and return the first item, waiting up to :attr:`timeout` seconds for one
+
+        :raises: :exc:`IndexError` if the queue is still empty after the timeout
+        """
+        with self._cond:
+            if timeout is None or timeout > 0:
+                deadline = time.time() + timeout if timeout is not None else None
+                while not self._length():
+                    remaining = deadline - time.time() if deadline is not None else None
+                    if remaining is not None and remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            if not self._length():
+                raise IndexError('get from an empty queue')
+            item, size = self._pop()
+            self.bytes -= size
+            changed = self.throttled and self._below_low()
+            if changed:
+                self.throttled = False
+                self._throttled_time += time.time() - self._throttled_since
+                self._throttled_since = None
+            self._cond.notify_all()
+        self._notify(changed)
+        return item
+
+    def has_room(self, sender=None):
+        """
+        Return ``True`` if a new item from the sender can be accepted
+        """
+        with self._cond:
+            return self._has_room(sender)
+
+    def wait_for_room(self, timeout=None, sender=None):
+        """
+        Wait until the queue has room for a new item from the sender
+
+        :param timeout: the maximum time to wait, in seconds, or ``None`` to wait forever
+        :param sender: the sender of the item
+        :return: ``True`` if the queue has room, ``False`` if it is still throttled after the timeout
+        """
+        with self._cond:
+            if self._has_room(sender):
+                return True
+            self.held += 1
+            deadline = time.time() + timeout if timeout is not None else None
+            while not self._has_room(sender):
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def reject(self):
+        """
+        Count a message refused because the queue is throttled
+        """
+        with self._cond:
+            self.rejected += 1
+
+    def qsize(self):
+        return self._length()
+
+    def empty(self):
+        return not self._length()
+
+    def stats(self):
+        """
+        Return a dictionary with the size of the queue and the throttling counters
+        """
+        with self._cond:
+            throttled_time = self._throttled_time
+            if self._throttled_since is not None:
+                throttled_time += time.time() - self._throttled_since
+            return {
+                'messages': self._length(),
+                'bytes': self.bytes,
+                'throttled': self.throttled,
+                'throttle_events': self.throttle_events,
+                'throttled_seconds': round(throttled_time, 3),
+                'held': self.held,
+                'rejected': self.rejected,
+            }
+
+
+class FairQueue(WatermarkQueue):
+    """
+    :class:`WatermarkQueue` with a FIFO for every sender, so that a sender with a large backlog doesn't delay
+    the items of the others. The senders are served in weighted round robin: every turn, a sender gives up to
+    its weight in items, 1 by default.
+
+    While the queue is throttled, a sender still has room as long as its backlog is below its fair share of
+    the high watermarks, i.e. the watermarks divided by the number of senders with a backlog. Only the senders
+    filling the queue are then held, and the size of the queue can exceed the high watermarks by the
+    shares of the others.
+
+    :param weights: a dictionary with the weight of the senders
+    :param default_weight: the weight of the senders not in :attr:`weights`
+    """
+    def __init__(self, weights=None, default_weight=1, **kwargs):
+        self.weights = weights or {}
+        self.default_weight = default_weight
+        # the backlog of every sender, in the order they are served, and the one being served
+        self._senders = collections.OrderedDict()
+        self._sender_bytes = collections.defaultdict(int)
+        self._count = 0
+        self._turn = None
+        self._credit = 0
+        WatermarkQueue.__init__(self, **kwargs)
+
+    def _length(self):
+        return self._count
+
+    def _push(self, item, size, sender):
+        backlog = self._senders.get(sender)
+        if backlog is None:
+            backlog = self._senders[sender] = collections.deque()
+        backlog.append((item, size, sender))
+        self._sender_bytes[sender] += size
+        self._count += 1
+
+    def _pop(self):
+        sender = next(iter(self._senders))
+        if self._turn != sender:
+            self._turn = sender
+            self._credit = max(self.weights.get(sender, self.default_weight), 1)
+        backlog = self._senders[sender]
+        item, size, sender = backlog.popleft()
+        self._sender_bytes[sender] -= size
+        self._count -= 1
+        self._credit -= 1
+        if not backlog:
+            del self._senders[sender]
+            del self._sender_bytes[sender]
+            self._turn = None
+        elif self._credit <= 0:
+            # the sender goes to the end of the round
+            self._senders[sender] = self._senders.pop(sender)
+            self._turn = None
+        return item, size
+
+    def _has_room(self, sender):
+        if not self.throttled:
+            return True
+        backlog = self._senders.get(sender)
+        senders = len(self._senders) + (backlog is None)
+        if self.high_messages and backlog is not None and len(backlog) >= max(self.high_messages // senders, 1):
+            return False
+        if self.high_bytes and self._sender_bytes.get(sender, 0) >= max(self.high_bytes // senders, 1):
+            return False
+        return True
+
+    def backlog(self):
+        """
+        Return a dictionary with the number of items waiting for every sender
+        """
+        with self._cond:
+            return dict((sender, len(backlog)) for sender, backlog in self._senders.items())
+
+
+class TokenBucket(object):
+    """
+    Token bucket limiting the rate of the items accepted from a sender: the bucket holds up to :attr:`burst`
+    tokens and is refilled with :attr:`rate` tokens per second.
+
+    :param rate: the number of tokens added every second
+    :param burst: the capacity of the bucket, defaults to :attr:`rate`
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, 1))
+        #: the number of times a token wasn't available
+        self.limited = 0
+        self._tokens = self.burst
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, tokens=1):
+        """
+        Take tokens from the bucket, if available
+
+        :param tokens: the number of tokens to take
+        :return: ``0`` if the tokens were taken, otherwise the time, in seconds, until they are available
+        """
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0
+            self.limited += 1
+            return (tokens - self._tokens) / self.rate
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+"""
+Suppression of the messages retransmitted by the senders. A message is identified by its sending application,
+sending facility and control id (MSH-3, MSH-4 and MSH-10): when a message with the same identity is received
+again, the acknowledgment sent the first time is returned without indexing it twice.
+"""
+
+from __future__ import absolute_import
+
+import collections
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+
+# magic, active generation, number of keys added to each generation
+_FILTER_HEADER = struct.Struct('>4sBxxxII')
+_FILTER_MAGIC = b'HL7B'
+
+
+class BloomFilter(object):
+    """
+    Bloom filter stored in a memory-mapped file, so that it survives the restarts of the modular input.
+
+    The filter has two generations: keys are added to the active one and looked up in both. When the active
+    generation holds :attr:`capacity` keys, the other one is cleared and becomes active, so the filter always
+    remembers at least the last :attr:`capacity` keys while its false positive rate stays below
+    :attr:`error_rate`.
+
+    :param path: the file of the filter, created if needed. A file made for a different size is replaced
+    :param capacity: the number of keys of a generation
+    :param error_rate: the false positive rate of a full generation, i.e. the probability of mistaking a new key
+        for one already added. The file takes about ``-2 * ln(error_rate) / ln(2) ** 2 / 8`` bytes per key,
+        8.4 at the default rate
+    """
+    def __init__(self, path, capacity=1000000, error_rate=0.0000001):
+        self.path = path
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.bits += -self.bits % 8
+        self.hashes = max(1, int(round(float(self.bits) / capacity * math.log(2))))
+        self._generation_size = self.bits // 8
+        size = _FILTER_HEADER.size + 2 * self._generation_size
+
+        if not os.path.exists(path) or os.path.getsize(path) != size:
+            with open(path, 'wb') as f:
+                f.write(_FILTER_HEADER.pack(_FILTER_MAGIC, 0, 0, 0))
+                f.truncate(size)
+        self._file = open(path, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), size)
+        magic, self._active, count0, count1 = _FILTER_HEADER.unpack_from(self._map, 0)
+        if magic != _FILTER_MAGIC or self._active not in (0, 1):
+            self._map[:size] = b'\0' * size
+            self._active, count0, count1 = 0, 0, 0
+        self._counts = [count0, count1]
+        self._write_header()
+
+    def _write_header(self):
+        _FILTER_HEADER.pack_into(self._map, 0, _FILTER_MAGIC, self._active, self._counts[0], self._counts[1])
+
+    def _positions(self, key):
+        # double hashing: the k positions are derived from two 64 bit hashes
+        h1, h2 = struct.unpack_from('>QQ', hashlib.sha256(key).digest())
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def _offset(self, generation, position):
+        return _FILTER_HEADER.size + generation * self._generation_size + position // 8
+
+    def _byte(self, offset):
+        return ord(self._map[offset:offset + 1])
+
+    def _test(self, generation, positions):
+        for position in positions:
+            if not self._byte(self._offset(generation, position)) & (1 << position % 8):
+                return False
+        return True
+
+    def __contains__(self, key):
+        positions = self._positions(key)
+        return self._test(self._active, positions) or self._test(1 - self._active, positions)
+
+    def add(self, key):
+        """
+        Add a key to the active generation
+        """
+        if self._counts[self._active] >= self.capacity:
+            self._active = 1 - self._active
+            start = _FILTER_HEADER.size + self._active * self._generation_size
+            self._map[start:start + self._generation_size] = b'\0' * self._generation_size
+            self._counts[self._active] = 0
+        for position in self._positions(key):
+            offset = self._offset(self._active, position)
+            self._map[offset:offset + 1] = struct.pack('B', self._byte(offset) | (1 << position % 8))
+        self._counts[self._active] += 1
+        self._write_header()
+
+    def close(self):
+        self._map.flush()
+        self._map.close()
+        self._file.close()
+
+
+class DuplicateFilter(object):
+    """
+    Remembers the identity of the last :attr:`cache_size` messages accepted, with the acknowledgment sent for
+    them, in a LRU cache. With a :attr:`bloom_filter`, the identities of older messages, and of the ones
+    accepted before a restart, are remembered too, but without their acknowledgment and with a probability of
+    mistaking a new message for a duplicate, and losing it, of :attr:`BloomFilter.error_rate`: see
+    :meth:`cached` to tell these apart.
+
+    The duplicates found are counted per sender in :attr:`duplicates`.
+
+    :param cache_size: the number of messages kept in the LRU cache
+    :type bloom_filter: :class:`BloomFilter`
+    :param bloom_filter: the persistent filter, or ``None``
+    """
+    def __init__(self, cache_size=10000, bloom_filter=None):
+        self.cache_size = cache_size
+        self.bloom_filter = bloom_filter
+        #: number of duplicates per sender, as ``"MSH-3|MSH-4"``
+        self.duplicates = collections.defaultdict(int)
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(header):
+        """
+        Return the identity of a message
+
+        :param header: the :class:`MSHHeader <hl7apy.mllp.MSHHeader>` of the message
+        """
+        return header.sending_application, header.sending_facility, header.control_id
+
+    @staticmethod
+    def _digest(key):
+        return '\r'.join(key).encode('utf-8')
+
+    def check(self, key):
+        """
+        Check whether a message has already been accepted and count it as a duplicate if it has
+
+        :param key: the identity of the message, see :func:`key() <DuplicateFilter.key>`
+        :return: a tuple with ``True`` if the message is a duplicate, and the acknowledgment sent the first time,
+            or ``None`` if it is no longer known
+        """
+        with self._lock:
+            if key in self._cache:
+                ack = self._cache.pop(key)
+                self._cache[key] = ack
+            elif self.bloom_filter is not None and self._digest(key) in self.bloom_filter:
+                ack = None
+            else:
+                return False, None
+            self.duplicates['%s|%s' % key[:2]] += 1
+            return True, ack
+
+    def cached(self, key):
+        """
+        Return whether a message is in the LRU cache, i.e. whether it is a duplicate for certain, without
+        counting it
+
+        :param key: the identity of the message, see :func:`key() <DuplicateFilter.key>`
+        """
+        with self._lock:
+            return key in self._cache
+
+    def remember(self, key, ack=None):
+        """
+        Remember an accepted message
+
+        :param key: the identity of the message, see :func:`key() <DuplicateFilter.key>`
+        :param ack: the acknowledgment sent for it
+        """
+        with self._lock:
+            self._cache.pop(key, None)
+            self._cache[key] = ack
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            if self.bloom_filter is not None:
+                self.bloom_filter.add(self._digest(key))
+
+    def stats(self):
+        """
+        Return a copy of the duplicate counters, per sender
+        """
+        with self._lock:
+            return dict(self.duplicates)
+
+    def close(self):
+        if self.bloom_filter is not None:
+            with self._lock:
+                self.bloom_filter.close()
+                self.bloom_filter = None
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2015, CRS4
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Streaming reader for HL7 batches, i.e. messages enclosed in the FHS/BHS ... BTS/FTS envelopes of the
+HL7 batch protocol.
+"""
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import codecs
+import re
+import time
+
+from hl7apy.exceptions import HL7apyException
+
+_SEGMENT_SEPARATOR = re.compile('\r\n|\r|\n')
+# MLLP start and end blocks, found when the batch was received or stored MLLP-framed
+_MLLP_CHARS = '\x0b\x1c'
+
+
+class InvalidBatch(HL7apyException):
+    """
+    Error that occurs when the envelope of a batch is malformed or its counts don't match its content
+    """
+
+
+class BatchHeader(object):
+    """
+    The fields of an FHS or BHS segment
+
+    :param segment: the ER7-encoded segment
+    :raises: :exc:`InvalidBatch` if the segment isn't a valid FHS or BHS segment
+    """
+    def __init__(self, segment):
+        if segment[:3] not in ('FHS', 'BHS') or len(segment) < 8:
+            raise InvalidBatch('Invalid batch header %s' % segment[:3])
+        self.segment = segment
+        self.fields = segment.split(segment[3])
+
+    def get(self, position):
+        """
+        Return the value of the field at the given position (e.g. ``11`` for BHS-11)
+
+        :param position: the position of the field in the segment
+        :return: the ER7 value of the field, or an empty string if the field is not present
+        """
+        if position == 1:
+            return self.segment[3]
+        try:
+            return self.fields[position - 1].strip()
+        except IndexError:
+            return ''
+
+    @property
+    def encoding_chars(self):
+        return self.fields[1]
+
+    @property
+    def sending_application(self):
+        return self.get(3)
+
+    @property
+    def sending_facility(self):
+        return self.get(4)
+
+    @property
+    def receiving_application(self):
+        return self.get(5)
+
+    @property
+    def receiving_facility(self):
+        return self.get(6)
+
+    @property
+    def name(self):
+        return self.get(9)
+
+    @property
+    def control_id(self):
+        return self.get(11)
+
+
+class BatchReader(object):
+    """
+    Iterate over the messages of an HL7 batch file or MLLP-framed batch, one message at a time: only the
+    message being read is kept in memory, whatever the size of the batch. The envelope is optional, so
+    a plain sequence of messages is read as well.
+
+    Segments can be separated by ``\\r``, ``\\n`` or ``\\r\\n`` and the MLLP encoding characters are ignored.
+    The messages are returned as ER7 strings with ``\\r`` as segment separator.
+
+    The counts in the BTS-1 (messages in the batch) and FTS-1 (batches in the file) segments are checked
+    when the trailers are read, and a BHS or FHS without its trailer is reported at the end of the data.
+    With :attr:`strict` the errors raise :exc:`InvalidBatch`, otherwise they are collected in :attr:`errors`.
+
+    >>> reader = BatchReader(open('batch.hl7', 'rb'))  # doctest: +SKIP
+    >>> for message in reader:  # doctest: +SKIP
+    ...     process(message)
+
+    :param source: a file-like object, opened in binary or text mode, or the content of the batch
+    :param encoding: the encoding of the batch, used if the source returns bytes
+    :param chunk_size: the number of bytes read from the source at once
+    :param strict: if ``True``, errors in the envelope raise :exc:`InvalidBatch`
+    """
+    def __init__(self, source, encoding='utf-8', chunk_size=65536, strict=True):
+        self.source = source
+        self.encoding = encoding
+        self.chunk_size = chunk_size
+        self.strict = strict
+        #: the :class:`BatchHeader` of the FHS segment, if present
+        self.file_header = None
+        #: the :class:`BatchHeader` of the BHS segment of the last batch, if present
+        self.batch_header = None
+        #: the number of messages read
+        self.messages = 0
+        #: the number of batches closed by a BTS segment
+        self.batches = 0
+        self.errors = []
+        self._batch_messages = 0
+        self._in_batch = False
+        self._in_file = False
+
+    def _chunks(self):
+        if not hasattr(self.source, 'read'):
+            yield self.source
+            return
+        while True:
+            chunk = self.source.read(self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def _segments(self):
+        decoder = codecs.getincrementaldecoder(self.encoding)()
+        pending = ''
+        for chunk in self._chunks():
+            if isinstance(chunk, bytes):
+                chunk = decoder.decode(chunk)
+            lines = _SEGMENT_SEPARATOR.split(pending + chunk)
+            pending = lines.pop()
+            for line in lines:
+                line = line.strip(_MLLP_CHARS)
+                if line.strip():
+                    yield line
+        pending = (pending + decoder.decode(b'', True)).strip(_MLLP_CHARS)
+        if pending.strip():
+            yield pending
+
+    def _error(self, text):
+        if self.strict:
+            raise InvalidBatch(text)
+        self.errors.append(text)
+
+    def _check_count(self, segment, expected, segment_id):
+        fields = segment.split(segment[3]) if len(segment) > 3 else []
+        count = fields[1].strip() if len(fields) > 1 else ''
+        if not count:
+            return
+        try:
+            count = int(count)
+        except ValueError:
+            self._error('Invalid %s-1 count %s' % (segment_id, count))
+            return
+        if count != expected:
+            self._error('%s-1 count is %d but %d were found' % (segment_id, count, expected))
+
+    def __iter__(self):
+        message = None
+        for segment in self._segments():
+            segment_id = segment[:3]
+            if segment_id == 'MSH':
+                if message is not None:
+                    yield self._message(message)
+                message = [segment]
+            elif segment_id in ('BHS', 'BTS', 'FHS', 'FTS'):
+                if message is not None:
+                    yield self._message(message)
+                    message = None
+                self._envelope(segment_id, segment)
+            elif message is not None:
+                message.append(segment)
+            else:
+                self._error('Segment %s outside of a message' % segment_id)
+        if message is not None:
+            yield self._message(message)
+        if self._in_batch:
+            self._error('Missing BTS segment')
+        if self._in_file:
+            self._error('Missing FTS segment')
+
+    def _message(self, segments):
+        self.messages += 1
+        self._batch_messages += 1
+        return '\r'.join(segments) + '\r'
+
+    def _envelope(self, segment_id, segment):
+        if segment_id == 'FHS':
+            if self._in_file:
+                self._error('Nested FHS segment')
+            self.file_header = BatchHeader(segment)
+            self._in_file = True
+        elif segment_id == 'BHS':
+            if self._in_batch:
+                self._error('Missing BTS segment before BHS')
+            self.batch_header = BatchHeader(segment)
+            self._in_batch = True
+            self._batch_messages = 0
+        elif segment_id == 'BTS':
+            self._check_count(segment, self._batch_messages, 'BTS')
+            self._in_batch = False
+            self._batch_messages = 0
+            self.batches += 1
+        else:
+            if self._in_batch:
+                self._error('Missing BTS segment before FTS')
+            self._check_count(segment, self.batches, 'FTS')
+            self._in_file = False
+
+
+def build_batch_ack(file_header=None, batch_header=None, comment=None, mllp=True):
+    """
+    Build the acknowledgment of a batch whose messages have all been accepted: following the HL7 batch
+    protocol, it is a batch without messages, whose headers reference the control ids of the received
+    ones. Sending and receiving application and facility are swapped.
+
+    :type file_header: :class:`BatchHeader`
+    :param file_header: the FHS segment of the batch, if present
+    :type batch_header: :class:`BatchHeader`
+    :param batch_header: the BHS segment of the batch, if present
+    :param comment: an optional comment, reported in BTS-2
+    :param mllp: if ``True``, the acknowledgment is wrapped with the MLLP encoding characters
+    :return: the acknowledgment string
+    """
+    timestamp = time.strftime('%Y%m%d%H%M%S')
+    segments = []
+
+    def header(segment_id, received):
+        fields = [segment_id, received.encoding_chars, received.receiving_application,
+                  received.receiving_facility, received.sending_application, received.sending_facility,
+                  timestamp, '', '', '', '', received.control_id]
+        return received.get(1).join(fields)
+
+    received = file_header or batch_header
+    field_sep = received.get(1) if received is not None else '|'
+    if file_header is not None:
+        segments.append(header('FHS', file_header))
+    if batch_header is not None:
+        segments.append(header('BHS', batch_header))
+    else:
+        segments.append('BHS' + field_sep + (file_header.encoding_chars if file_header else '^~\\&'))
+    segments.append('BTS' + field_sep + '0' + (field_sep + comment.replace(field_sep, ' ') if comment else ''))
+    if file_header is not None:
+        segments.append('FTS' + field_sep + '1')
+    ack = '\r'.join(segments) + '\r'
+    return '\x0b' + ack + '\x1c\r' if mllp else ack
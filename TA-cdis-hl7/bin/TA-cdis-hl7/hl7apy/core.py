@@ -26,6 +26,10 @@ HL7apy - core classes
 from __future__ import absolute_import
 import re
 import collections
+try:
+    from collections.abc import Sequence, MutableSequence, MutableMapping
+except ImportError:
+    from collections import Sequence, MutableSequence, MutableMapping
 import datetime
 from itertools import takewhile
 import importlib
@@ -112,7 +116,7 @@ def _valid_z_field_name(name):
     return re.match(regex, name, re.IGNORECASE) is not None
 
 
-class ElementProxy(collections.Sequence):
+class ElementProxy(Sequence):
     """
     It contains the results of a child traversal, and provides lazy child instantiation
     in order to support the following API:
@@ -189,7 +193,7 @@ class ElementProxy(collections.Sequence):
         return repr(self.list)
 
 
-class ElementList(collections.MutableSequence):
+class ElementList(MutableSequence):
     """
     Delegate for handling the children of a given Element.
 
@@ -534,7 +538,7 @@ class ElementFinder(object):
                 reference = load_reference(element.name, element.classname, element.version)
             except (ChildNotFound, KeyError):
                 raise InvalidName(element.classname, element.name)
-        if not isinstance(reference, collections.Sequence):
+        if not isinstance(reference, Sequence):
             raise Exception
         return ElementFinder._parse_structure(element, reference)
 
@@ -650,7 +654,7 @@ class Element(object):
 
     def find_child_reference(self, name):
         name = name.upper()
-        if isinstance(self.structure_by_name, collections.MutableMapping):
+        if isinstance(self.structure_by_name, MutableMapping):
             element = self.structure_by_name.get(name) or self.structure_by_longname.get(name)
         else:
             element = None
@@ -886,7 +890,7 @@ class SupportComplexDataType(Element):
 
     def find_child_reference(self, name):
         name = name.upper()
-        if isinstance(self.structure_by_name, collections.MutableMapping):
+        if isinstance(self.structure_by_name, MutableMapping):
             element = self.structure_by_name.get(name) or self.structure_by_longname.get(name)
         else:
             element = None
@@ -1788,7 +1792,7 @@ class Group(Element):
 
     def find_child_reference(self, name):
         name = name.upper()
-        if isinstance(self.structure_by_name, collections.MutableMapping):
+        if isinstance(self.structure_by_name, MutableMapping):
             element = self.structure_by_name.get(name) or self.structure_by_longname.get(name)
         else:
             element = None
@@ -1896,7 +1900,7 @@ class Message(Group):
 
     def find_child_reference(self, name):
         name = name.upper()
-        if isinstance(self.structure_by_name, collections.MutableMapping):
+        if isinstance(self.structure_by_name, MutableMapping):
             element = self.structure_by_name.get(name) or self.structure_by_longname.get(name)
         else:
             element = None
@@ -22,14 +22,31 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import fnmatch
+import mmap
+import multiprocessing
+import os
 import re
+import signal
 import socket
+import stat
+import tempfile
+import threading
+import time
 try:
     from SocketServer import StreamRequestHandler, TCPServer, ThreadingMixIn
 except ImportError:
     from socketserver import StreamRequestHandler, TCPServer, ThreadingMixIn
+try:
+    from Queue import Queue, Empty, Full
+except ImportError:
+    from queue import Queue, Empty, Full
+try:
+    import ssl
+except ImportError:
+    ssl = None
 
-from hl7apy.parser import get_message_type
+from hl7apy.parser import _split_msh
 from hl7apy.exceptions import HL7apyException, ParserError
 
 
@@ -52,7 +69,734 @@ class InvalidHL7Message(HL7apyException):
         return 'The string received is not a valid HL7 message'
 
 
-class _MLLPRequestHandler(StreamRequestHandler):
+class InvalidMLLPFrame(HL7apyException):
+    """
+    Error that occurs when a frame received by the :class:`MLLPServer` is not a valid MLLP frame
+
+    :param reason: why the frame was rejected, one of the :class:`MLLPFrameValidator` reasons
+    :param position: the offset in the frame where the error was found
+    """
+    def __init__(self, reason, position=0):
+        self.reason = reason
+        self.position = position
+
+    def __str__(self):
+        return 'Invalid MLLP frame: %s at offset %d' % (self.reason, self.position)
+
+
+if bytes is str:
+    # Python 2: the re module and str.decode() don't accept memoryviews
+    def _frame_data(frame):
+        if isinstance(frame, SpilledFrame):
+            return frame.data()
+        return frame.tobytes() if isinstance(frame, memoryview) else frame
+
+    def _decode(data, encoding):
+        return data.decode(encoding)
+else:
+    def _frame_data(frame):
+        if isinstance(frame, SpilledFrame):
+            return frame.data()
+        return frame
+
+    def _decode(data, encoding):
+        return str(data, encoding)
+
+
+class FrameLimits(object):
+    """
+    Size limits of the frames received by the MLLP servers.
+
+    A frame larger than :attr:`spill_size` is written to a temporary file while it is received, so that
+    the buffer of the connection doesn't grow with it, and it is returned as a :class:`SpilledFrame`.
+    A frame larger than :attr:`max_size` is discarded while it is received and returned as an
+    :class:`OversizedFrame`, which only keeps its first bytes: the server replies with a negative
+    acknowledgment with the :attr:`oversize_ack` code or, if it is ``None``, closes the connection.
+
+    :param max_size: the maximum size of a frame in bytes, or ``None`` for no limit
+    :param spill_size: the size above which frames are stored in a temporary file, or ``None`` to keep them in memory
+    :param spill_dir: the directory of the temporary files, or ``None`` for the default one
+    :param oversize_ack: the acknowledgment code (``AE`` or ``AR``) of the frames larger than :attr:`max_size`,
+        or ``None`` to close the connection
+    """
+    #: the number of bytes of a discarded frame kept to acknowledge it
+    header_size = 4096
+
+    def __init__(self, max_size=None, spill_size=None, spill_dir=None, oversize_ack=None):
+        if oversize_ack not in (None, 'AE', 'AR'):
+            raise ValueError('Invalid acknowledgment code %s' % oversize_ack)
+        self.max_size = max_size
+        self.spill_size = spill_size
+        self.spill_dir = spill_dir
+        self.oversize_ack = oversize_ack
+
+
+class SpilledFrame(object):
+    """
+    A frame received by :class:`MLLPFrameReader` and stored in a temporary file because it was larger than
+    :attr:`FrameLimits.spill_size`. The file is mapped in memory only when :func:`data() <SpilledFrame.data>`
+    is called, and its pages are read by the operating system as they are accessed.
+
+    :param file: the temporary file, with the frame from its start
+    :param size: the size of the frame
+    """
+    def __init__(self, file, size):
+        self.file = file
+        self.size = size
+        self._map = None
+        self._data = None
+
+    def __len__(self):
+        return self.size
+
+    def data(self):
+        """
+        Return the content of the frame, mapped in memory: a :class:`memoryview` on Python 3, an
+        :class:`mmap.mmap` on Python 2. It is valid until the frame is closed
+        """
+        if self._data is None:
+            self.file.flush()
+            self._map = mmap.mmap(self.file.fileno(), self.size, access=mmap.ACCESS_READ)
+            self._data = self._map if bytes is str else memoryview(self._map)
+        return self._data
+
+    def close(self):
+        """
+        Unmap and delete the temporary file
+        """
+        if self._map is not None:
+            if self._data is not self._map:
+                self._data.release()
+            try:
+                self._map.close()
+            except BufferError:
+                # slices of the data are still referenced, the map is closed when they are collected
+                pass
+            self._map = self._data = None
+        self.file.close()
+
+
+class OversizedFrame(object):
+    """
+    A frame larger than :attr:`FrameLimits.max_size`, discarded by :class:`MLLPFrameReader` while it was
+    received.
+
+    :param head: the first bytes of the frame, up to :attr:`FrameLimits.header_size`
+    :param size: the size of the frame
+    """
+    def __init__(self, head, size):
+        self.head = head
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+
+class MLLPFrameReader(object):
+    """
+    Buffered reader that splits an MLLP byte stream into frames.
+
+    Data is read from the socket with ``recv_into`` in chunks of :attr:`chunk_size` bytes, directly into a
+    buffer that is reused for the whole connection. The buffer grows when a frame doesn't fit and goes back
+    to its initial size once the large frame has been consumed. The end block (``\\x1c\\x0d``) is located
+    with a bytes search, so the cost of framing is linear in the size of the stream.
+
+    Frames are returned as :class:`memoryview` slices of the buffer, without copying them: a frame is only
+    valid until the next call to :func:`fill() <MLLPFrameReader.fill>` or :func:`feed() <MLLPFrameReader.feed>`,
+    and consumers that keep it longer must copy it with ``bytes(frame)`` (``frame.tobytes()`` on Python 2).
+
+    The reader can also be used without a socket: data obtained elsewhere can be passed to
+    :func:`feed() <MLLPFrameReader.feed>` and the complete frames collected with
+    :func:`next_frame() <MLLPFrameReader.next_frame>`.
+
+    With :attr:`limits`, frames larger than :attr:`FrameLimits.spill_size` are moved to a temporary file
+    while they are received and returned as :class:`SpilledFrame` objects, which must be closed by the
+    consumer; frames larger than :attr:`FrameLimits.max_size` are discarded and returned as
+    :class:`OversizedFrame` objects.
+
+    :param sock: the connected socket to read from, or ``None``
+    :param chunk_size: the maximum number of bytes requested to the socket on every read
+    :type limits: :class:`FrameLimits`
+    :param limits: the size limits of the frames, or ``None`` for no limit
+    """
+    end_seq = b"\x1c\x0d"
+
+    def __init__(self, sock=None, chunk_size=65536, limits=None):
+        self.sock = sock
+        self.chunk_size = chunk_size
+        self.limits = limits
+        self.eof = False
+        self.received = 0
+        self._capacity = 2 * chunk_size
+        self._buffer = bytearray(self._capacity)
+        self._view = memoryview(self._buffer)
+        # the buffer holds the bytes not yet returned in a frame between _start and _end,
+        # and the end block has already been searched up to _scanned
+        self._start = 0
+        self._end = 0
+        self._scanned = 0
+        # the part of a large frame already moved out of the buffer: written to _spill, or discarded
+        # keeping only its _head
+        self._spill = None
+        self._head = None
+        self._moved = 0
+
+    def _reserve(self, size):
+        # make room for size bytes after the received data by moving the pending bytes to the start of the
+        # buffer, or to a new one, which invalidates the frames already returned
+        if len(self._buffer) - self._end >= size:
+            return
+        pending = self._end - self._start
+        if pending + size <= self._capacity < len(self._buffer) // 2:
+            buffer = bytearray(self._capacity)
+        elif pending + size > len(self._buffer):
+            buffer = bytearray(max(2 * len(self._buffer), pending + size))
+        else:
+            buffer = self._buffer
+        if buffer is self._buffer:
+            # source and destination may overlap
+            buffer[:pending] = self._buffer[self._start:self._end]
+        else:
+            buffer[:pending] = self._view[self._start:self._end]
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+        self._scanned -= self._start
+        self._start = 0
+        self._end = pending
+
+    def feed(self, data):
+        """
+        Append the given bytes to the internal buffer
+
+        :param data: the bytes received from the peer
+        """
+        size = len(data)
+        self._reserve(size)
+        self._buffer[self._end:self._end + size] = data
+        self._end += size
+        self.received += size
+
+    def buffered(self):
+        """
+        Return the number of bytes received but not yet returned as part of a frame
+        """
+        return self._end - self._start
+
+    def next_frame(self):
+        """
+        Return the next complete frame already in the buffer, without reading from the socket.
+        The frame is returned with its start and end blocks.
+
+        :return: a :class:`memoryview` of the frame, a :class:`SpilledFrame` or an :class:`OversizedFrame`
+            if the frame exceeds the :attr:`limits`, or ``None`` if the buffer doesn't contain a complete frame
+        """
+        # the end block may be split across two reads, so restart one byte before the scanned data
+        end = self._buffer.find(self.end_seq, max(self._scanned - 1, self._start), self._end)
+        if end == -1:
+            self._scanned = self._end
+            if self.limits is not None:
+                self._move_large_frame()
+            return None
+        end += len(self.end_seq)
+        if self._spill is not None or self._head is not None:
+            frame = self._complete_large_frame(end)
+        elif self.limits is not None and self.limits.max_size and end - self._start > self.limits.max_size:
+            frame = OversizedFrame(self._read_head(self.limits.header_size, end), end - self._start)
+        else:
+            frame = self._view[self._start:end]
+        self._start = self._scanned = end
+        if self._start == self._end:
+            # nothing pending, the next read starts from the beginning of the buffer
+            self._start = self._end = self._scanned = 0
+            if len(self._buffer) > 2 * self._capacity:
+                # release the memory needed by a large frame
+                self._buffer = bytearray(self._capacity)
+                self._view = memoryview(self._buffer)
+        return frame
+
+    def _move_large_frame(self):
+        # move the partial frame out of the buffer once it exceeds a limit, keeping its last byte,
+        # which may be the first one of the end block
+        size = self._end - self._start - 1
+        if size <= 0:
+            return
+        total = self._moved + size
+        if self._head is None and self.limits.max_size and total > self.limits.max_size:
+            self._head = self._read_head(self.limits.header_size, self._end)
+        elif self._head is None and self._spill is None and \
+                (not self.limits.spill_size or total <= self.limits.spill_size):
+            return
+        if self._head is None:
+            if self._spill is None:
+                self._spill = tempfile.TemporaryFile(dir=self.limits.spill_dir)
+            self._spill.write(self._view[self._start:self._end - 1])
+        self._moved = total
+        self._start = self._end - 1
+
+    def _read_head(self, size, end):
+        # the first bytes of the frame, which ends at end in the buffer, then the file isn't needed anymore
+        head = b''
+        if self._spill is not None:
+            self._spill.seek(0)
+            head = self._spill.read(size)
+            self._spill.close()
+            self._spill = None
+        return head + self._view[self._start:min(end, self._start + size - len(head))].tobytes()
+
+    def _complete_large_frame(self, end):
+        size = self._moved + end - self._start
+        if self._head is None and self.limits.max_size and size > self.limits.max_size:
+            self._head = self._read_head(self.limits.header_size, end)
+        if self._head is not None:
+            frame = OversizedFrame(self._head, size)
+        else:
+            self._spill.write(self._view[self._start:end])
+            self._spill.seek(0)
+            frame = SpilledFrame(self._spill, size)
+        self._spill = self._head = None
+        self._moved = 0
+        return frame
+
+    def close(self):
+        """
+        Delete the temporary file of a frame being received, if any
+        """
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+    def read_frame(self):
+        """
+        Return the next complete frame, reading from the socket until one is available.
+        :exc:`socket.timeout <socket.timeout>` raised by the socket is propagated to the caller.
+
+        :return: a :class:`memoryview` of the frame or ``None`` if the peer closed the connection before
+            sending a complete frame
+        """
+        frame = self.next_frame()
+        while frame is None:
+            if not self.fill():
+                return None
+            frame = self.next_frame()
+        return frame
+
+    def fill(self):
+        """
+        Read a chunk of data from the socket and append it to the buffer.
+        :exc:`socket.timeout <socket.timeout>` raised by the socket is propagated to the caller.
+
+        :return: the number of bytes read, ``0`` if the peer closed the connection
+        """
+        if self.eof:
+            return 0
+        self._reserve(self.chunk_size)
+        size = self.sock.recv_into(self._view[self._end:], self.chunk_size)
+        if not size:
+            self.eof = True
+            return 0
+        self._end += size
+        self.received += size
+        return size
+
+    def __iter__(self):
+        frame = self.read_frame()
+        while frame is not None:
+            yield frame
+            frame = self.read_frame()
+
+
+class MLLPFrameValidator(object):
+    """
+    Single-pass validator of MLLP frames. A valid frame is a start block (``\\x0b``), a message made of
+    non-empty segments terminated by ``\\r`` (the terminator of the last one is optional) and an end block
+    (``\\x1c\\x0d``).
+
+    The checks look for fixed byte sequences, so the cost is linear in the size of the frame whatever its
+    content, unlike a regular expression with nested quantifiers, which backtracks on malformed frames.
+    The frame can be ``bytes``, a :class:`memoryview` returned by :class:`MLLPFrameReader` or the data of
+    a :class:`SpilledFrame`. On Python 2, whose ``re`` module doesn't accept memoryviews, the frame must be
+    converted first, as the servers do.
+
+    The validator has no state: a single instance, :data:`FRAME_VALIDATOR`, is shared by all the servers.
+    """
+    #: the frame doesn't begin with the start block
+    MISSING_START_BLOCK = 'missing start block'
+    #: the frame doesn't contain the end block
+    MISSING_END_BLOCK = 'missing end block'
+    #: there is nothing between the start and the end blocks
+    EMPTY_MESSAGE = 'empty message'
+    #: a segment terminator is not preceded by a segment
+    EMPTY_SEGMENT = 'empty segment'
+    #: the frame is larger than :attr:`FrameLimits.max_size`
+    FRAME_TOO_LARGE = 'frame too large'
+
+    start_block = b'\x0b'
+    _end_block = re.compile(b'\x1c\x0d')
+    _empty_segment = re.compile(b'\x0d\x0d')
+
+    def validate(self, data):
+        """
+        Validate a frame
+
+        :param data: the frame, with its start and end blocks
+        :return: a tuple with the start and end offsets of the message in the frame
+        :raises: :exc:`InvalidMLLPFrame` with the reason the frame was rejected
+        """
+        if data[:1] != self.start_block:
+            raise InvalidMLLPFrame(self.MISSING_START_BLOCK, 0)
+        end_block = self._end_block.search(data, 1)
+        if end_block is None:
+            raise InvalidMLLPFrame(self.MISSING_END_BLOCK, len(data))
+        end = end_block.start()
+        if end == 1:
+            raise InvalidMLLPFrame(self.EMPTY_MESSAGE, 1)
+        if data[1:2] == b'\x0d':
+            raise InvalidMLLPFrame(self.EMPTY_SEGMENT, 1)
+        empty = self._empty_segment.search(data, 1, end)
+        if empty is not None:
+            raise InvalidMLLPFrame(self.EMPTY_SEGMENT, empty.start() + 1)
+        return 1, end
+
+
+#: the validator used by the MLLP servers
+FRAME_VALIDATOR = MLLPFrameValidator()
+
+
+class MSHHeader(object):
+    """
+    The fields of the MSH segment of an ER7-encoded message, extracted without parsing the whole message.
+
+    :param message: the ER7-encoded message
+    :raises: :exc:`ParserError <hl7apy.exceptions.ParserError>` if the message doesn't start with a valid MSH segment
+    """
+    def __init__(self, message):
+        self.fields, self.encoding_chars = _split_msh(message)
+
+    def get(self, position):
+        """
+        Return the value of the MSH field at the given position (e.g. ``10`` for MSH-10)
+
+        :param position: the position of the field in the segment
+        :return: the ER7 value of the field, or an empty string if the field is not present
+        """
+        if position == 1:
+            return self.encoding_chars['FIELD']
+        try:
+            return self.fields[position - 1].strip()
+        except IndexError:
+            return ''
+
+    @property
+    def sending_application(self):
+        return self.get(3)
+
+    @property
+    def sending_facility(self):
+        return self.get(4)
+
+    @property
+    def receiving_application(self):
+        return self.get(5)
+
+    @property
+    def receiving_facility(self):
+        return self.get(6)
+
+    @property
+    def message_type(self):
+        return self.get(9)
+
+    @property
+    def control_id(self):
+        return self.get(10)
+
+    @property
+    def processing_id(self):
+        return self.get(11)
+
+    @property
+    def version(self):
+        return self.get(12)
+
+    @property
+    def version_number(self):
+        """
+        The version of the message (MSH-12.1) as a tuple of integers, e.g. ``(2, 5, 1)``, so that versions
+        are compared numerically (``2.10`` follows ``2.9``). It is empty if MSH-12 is not valued
+        """
+        version = self.version.split(self.encoding_chars['COMPONENT'], 1)[0]
+        return tuple(int(number) for number in re.findall(r'\d+', version))
+
+    @property
+    def accept_ack_type(self):
+        return self.get(15)
+
+    @property
+    def application_ack_type(self):
+        return self.get(16)
+
+    @property
+    def enhanced_mode(self):
+        """
+        ``True`` if the sender uses the enhanced acknowledgment mode, i.e. MSH-15 or MSH-16 is valued
+        """
+        return bool(self.accept_ack_type or self.application_ack_type)
+
+    def invalid_segment(self, message):
+        """
+        Look for a segment which doesn't begin with a segment id (an uppercase letter followed by two uppercase
+        letters or digits) and the field separator, e.g. a message truncated or mixed with other data.
+        It is a sanity check of the whole message, much cheaper than parsing it
+
+        :param message: the ER7-encoded message the header was read from
+        :return: the first invalid segment, or ``None`` if all the segments are well formed
+        """
+        separator = self.encoding_chars['FIELD']
+        for segment in message.split('\r'):
+            segment = segment.lstrip('\n')
+            if not segment:
+                continue
+            if _SEGMENT_ID.match(segment) is None or segment[3:4] not in ('', separator):
+                return segment
+        return None
+
+
+_SEGMENT_ID = re.compile(r'[A-Z][A-Z0-9]{2}')
+
+
+_ACK_TEMPLATE = '{sb}MSH{f}{msh_2}{f}{sending_app}{f}{sending_fac}{f}{receiving_app}{f}{receiving_fac}{f}' \
+                '{timestamp}{f}{f}ACK{f}{f}{processing_id}{f}{version}\rMSA{f}{code}{f}{control_id}{text}\r' \
+                '{err}{eb}{cr}'
+# ERR-1 was replaced by ERR-3 (HL7 error code) and ERR-8 (user message) in v2.5
+_ERR_TEMPLATE = 'ERR{f}{c}{c}{c}207{s}{text}{s}HL70357\r'
+_ERR_TEMPLATE_V25 = 'ERR{f}{f}{f}207{c}Application internal error{c}HL70357{f}E{f}{f}{f}{f}{text}\r'
+
+ACK_CODES = ('AA', 'AE', 'AR', 'CA', 'CE', 'CR')
+
+
+def _escape(text, encoding_chars):
+    escape = encoding_chars['ESCAPE']
+    text = text.replace(escape, '{0}E{0}'.format(escape))
+    for name, code in (('FIELD', 'F'), ('COMPONENT', 'S'), ('SUBCOMPONENT', 'T'), ('REPETITION', 'R')):
+        text = text.replace(encoding_chars[name], '{0}{1}{0}'.format(escape, code))
+    return text.replace('\r', '{0}X0D{0}'.format(escape))
+
+
+def ack_required(ack_type, code):
+    """
+    Tell whether an acknowledgment must be sent in the enhanced acknowledgment mode, according to the
+    acknowledgment type requested in MSH-15 (accept acknowledgment) or MSH-16 (application acknowledgment)
+
+    :param ack_type: ``AL`` (always), ``NE`` (never), ``ER`` (only on errors) or ``SU`` (only on success).
+        An empty or unknown type is treated as ``AL``
+    :param code: the acknowledgment code
+    """
+    ack_type = ack_type.upper()
+    if ack_type == 'NE':
+        return False
+    if ack_type == 'ER':
+        return code[1:] != 'A'
+    if ack_type == 'SU':
+        return code[1:] == 'A'
+    return True
+
+
+def build_ack(header, code='AA', text=None, error=None, mllp=True):
+    """
+    Build the ER7-encoded acknowledgment for a message, filling a template with the fields of the
+    message's MSH segment. Sending and receiving application and facility are swapped and the
+    message's encoding characters, processing id and version are used for the acknowledgment.
+
+    :type header: :class:`MSHHeader`
+    :param header: the header of the message to acknowledge
+    :param code: the acknowledgment code (MSA-1)
+    :param text: an optional text message (MSA-3)
+    :param error: an optional error description, reported in an ERR segment
+    :param mllp: if ``True``, the acknowledgment is wrapped with the MLLP encoding characters
+    :return: the acknowledgment string
+    """
+    if code not in ACK_CODES:
+        raise ValueError('Invalid acknowledgment code %s' % code)
+    enc = header.encoding_chars
+    err = ''
+    if error is not None:
+        template = _ERR_TEMPLATE_V25 if header.version_number >= (2, 5) else _ERR_TEMPLATE
+        err = template.format(f=enc['FIELD'], c=enc['COMPONENT'], s=enc['SUBCOMPONENT'],
+                              text=_escape(error, enc))
+    return _ACK_TEMPLATE.format(
+        sb='\x0b' if mllp else '', eb='\x1c' if mllp else '', cr='\r' if mllp else '',
+        f=enc['FIELD'], msh_2=header.fields[1],
+        sending_app=header.receiving_application, sending_fac=header.receiving_facility,
+        receiving_app=header.sending_application, receiving_fac=header.sending_facility,
+        timestamp=time.strftime('%Y%m%d%H%M%S'), processing_id=header.processing_id,
+        version=header.version, code=code, control_id=header.control_id,
+        text=enc['FIELD'] + _escape(text, enc) if text is not None else '', err=err)
+
+
+class MessageRouter(object):
+    """
+    Routing table that associates the message types (MSH-9) to their handlers. It is compiled once from the
+    :attr:`handlers` dictionary of the MLLP servers, so messages are dispatched without raising exceptions.
+
+    Besides exact message types (e.g. ``ORU^R01``), the keys of the dictionary can be patterns with the
+    ``*`` and ``?`` wildcards (e.g. ``ADT^A*`` or ``*``). Exact types are tried first, then the patterns,
+    from the one with the longest literal part to the catch-all ``*``. The ``ERR`` key specifies the error
+    handler. The result of the resolution of every message type is cached.
+
+    The number of messages dispatched to every key is available in :attr:`hits`.
+
+    :param handlers: the dictionary that specifies the handler classes for every kind of supported message.
+    :param cache_size: the maximum number of message types whose resolution is cached
+    """
+    ERR = 'ERR'
+
+    def __init__(self, handlers, cache_size=1024):
+        self.error_handler = None
+        self.cache_size = cache_size
+        self._exact = {}
+        self._patterns = []
+        for key, value in handlers.items():
+            route = (value[0], value[1:])
+            if key == self.ERR:
+                self.error_handler = route
+            elif '*' in key or '?' in key:
+                self._patterns.append((key, re.compile(fnmatch.translate(key)), route))
+            else:
+                self._exact[key] = (key, route)
+        self._patterns.sort(key=lambda p: (-len(p[0].replace('*', '').replace('?', '')), p[0]))
+        self._cache = {}
+        self._lock = threading.Lock()
+        self.hits = dict.fromkeys(handlers, 0)
+
+    def resolve(self, msg_type):
+        """
+        Return the handler for the given message type
+
+        :param msg_type: the message type (MSH-9)
+        :return: a tuple with the handler class and the additional arguments for its constructor,
+            or ``None`` if no key matches the message type
+        """
+        try:
+            key, route = self._cache[msg_type]
+        except KeyError:
+            key, route = self._match(msg_type)
+            if len(self._cache) < self.cache_size:
+                self._cache[msg_type] = (key, route)
+        if key is not None:
+            self.hit(key)
+        return route
+
+    def _match(self, msg_type):
+        if msg_type is None:
+            return None, None
+        try:
+            return self._exact[msg_type]
+        except KeyError:
+            pass
+        for key, regex, route in self._patterns:
+            if regex.match(msg_type):
+                return key, route
+        return None, None
+
+    def hit(self, key):
+        with self._lock:
+            self.hits[key] += 1
+
+    def stats(self):
+        """
+        Return a copy of the hit counters
+        """
+        with self._lock:
+            return dict(self.hits)
+
+
+# the peer of the connection whose message is being handled by the current thread
+_connection = threading.local()
+
+
+def current_peer():
+    """
+    Return the address of the peer that sent the message being handled, so that handlers can tell the
+    senders apart. It is ``None`` when called outside of :func:`reply() <AbstractHandler.reply>`.
+    """
+    return getattr(_connection, 'peer', None)
+
+
+class _MLLPDispatcherMixin(object):
+    """
+    Validation of the received frames and routing of the messages to the handlers. Classes using the mixin
+    must define the :attr:`router` attribute and the :attr:`peer` that sent the frames.
+
+    Invalid frames are counted in :attr:`rejected_frames` and the reason of the last one is kept
+    in :attr:`last_rejection`.
+    """
+    validator = FRAME_VALIDATOR
+    rejected_frames = 0
+    last_rejection = None
+    peer = None
+
+    def _extract_hl7_message(self, data):
+        # the frame is validated as bytes and only the message is decoded
+        try:
+            start, end = self.validator.validate(data)
+        except InvalidMLLPFrame as e:
+            self.rejected_frames += 1
+            self.last_rejection = e
+            return None
+        return _decode(data[start:end], self.encoding)
+
+    def _oversized_response(self, frame):
+        # the negative acknowledgment of a frame larger than the limit, or None to close the connection
+        limits = self.server.frame_limits
+        self.rejected_frames += 1
+        self.last_rejection = InvalidMLLPFrame(MLLPFrameValidator.FRAME_TOO_LARGE, limits.max_size)
+        if limits.oversize_ack is None or frame.head[:1] != b'\x0b':
+            return None
+        try:
+            header = MSHHeader(frame.head[1:].decode(self.encoding, 'replace'))
+        except ParserError:
+            return None
+        return build_ack(header, limits.oversize_ack,
+                         text='message too large (%d bytes, maximum %d)' % (frame.size, limits.max_size))
+
+    def _route_message(self, msg):
+        _connection.peer = self.peer
+        try:
+            return self._dispatch_message(msg)
+        finally:
+            _connection.peer = None
+
+    def _dispatch_message(self, msg):
+        try:
+            header = MSHHeader(msg)
+        except ParserError:
+            return self._route_error(InvalidHL7Message(), msg)
+        # None if MSH-9 is missing, like get_message_type
+        msg_type = header.message_type if len(header.fields) > 8 else None
+
+        route = self.router.resolve(msg_type)
+        if route is None:
+            return self._route_error(UnsupportedMessageType(msg_type), msg)
+
+        handler, args = route
+        try:
+            h = handler(msg, *args)
+            # the header is split once, for the routing and the handler
+            h._header = header
+            return h.reply()
+        except Exception as e:
+            return self._route_error(e, msg)
+
+    def _route_error(self, exc, msg):
+        if self.router.error_handler is None:
+            raise exc
+        self.router.hit(MessageRouter.ERR)
+        err_handler, args = self.router.error_handler
+        h = err_handler(exc, msg, *args)
+        return h.reply()
+
+
+class _MLLPRequestHandler(_MLLPDispatcherMixin, StreamRequestHandler):
     encoding = 'utf-8'
 
     def __init__(self, *args, **kwargs):
@@ -62,78 +806,391 @@ class _MLLPRequestHandler(StreamRequestHandler):
         self.sb = b"\x0b"
         self.eb = b"\x1c"
         self.cr = b"\x0d"
-        self.validator = re.compile(
-            ''.join([self.sb.decode('ascii'), r"(([^\r]+\r)*([^\r]+\r?))", self.eb.decode('ascii'), self.cr.decode('ascii')]))
         self.handlers = self.server.handlers
+        self.router = self.server.router
         self.timeout = self.server.timeout
 
+        self.peer = self.client_address
+
         StreamRequestHandler.setup(self)
+        self.reader = MLLPFrameReader(self.request, limits=self.server.frame_limits)
+        self.frames = 0
+        self.writes = 0
+        self.bytes_sent = 0
 
     def handle(self):
-        end_seq = self.eb + self.cr
         try:
-            line = self.request.recv(3)
+            line = self.reader.read_frame()
         except socket.timeout:
             self.request.close()
             return
 
-        if line[:1] != self.sb:  # First MLLP char
-            self.request.close()
-            return
+        if line is not None:
+            # a single read: the frames received later on this connection are not answered, see _process_frames
+            responses = self._process_frames(line)[0]
+            self._write_responses(responses)
+        self.request.close()
+
+    def finish(self):
+        StreamRequestHandler.finish(self)
+        self.reader.close()
+
+    def _process_frames(self, frame):
+        """
+        Process the given frame and every complete frame already received after it, so that senders
+        pipelining their messages get all the responses with a single write.
+
+        The stock handler calls it once, for the frames received with the first read, and then closes the
+        connection: frames still on their way are lost and the sender sees the connection reset. Senders
+        pipelining on a persistent connection need the handler of the ``mllp2`` module, which calls it after
+        every read.
+
+        :return: a tuple with the list of the encoded responses, in the order of the frames, and ``False``
+            if the connection must be closed because of an invalid frame or a routing error
+        """
+        responses = []
+        while frame is not None:
+            self.frames += 1
+            if isinstance(frame, OversizedFrame):
+                response = self._oversized_response(frame)
+                if response is None:
+                    return responses, False
+                responses.append(response.encode(self.encoding))
+                frame = self.reader.next_frame()
+                continue
 
-        while line[-2:] != end_seq:
             try:
-                char = self.rfile.read(1)
-                if not char:
-                    break
-                line += char
-            except socket.timeout:
-                self.request.close()
+                data = _frame_data(frame)
+                if data[:1] != self.sb:  # First MLLP char
+                    return responses, False
+
+                message = self._extract_hl7_message(data)
+                data = None
+            finally:
+                if isinstance(frame, SpilledFrame):
+                    frame.close()
+            if message is not None:
+                try:
+                    response = self._route_message(message)
+                except Exception:
+                    return responses, False
+                # encode the response, if any
+                if response is not None:
+                    responses.append(response.encode(self.encoding))
+            frame = self.reader.next_frame()
+        return responses, True
+
+    def _write_responses(self, responses):
+        if responses:
+            data = b''.join(responses)
+            self.wfile.write(data)
+            self.writes += 1
+            self.bytes_sent += len(data)
+
+
+class _ReusePortMixin(object):
+    """
+    Sets ``SO_REUSEPORT`` on the listening socket when the :attr:`reuse_port` attribute is ``True``, so that
+    several processes can bind the same port and the kernel balances the connections among them.
+    """
+    reuse_port = False
+
+    def server_bind(self):
+        if self.reuse_port:
+            if not hasattr(socket, 'SO_REUSEPORT'):
+                raise ValueError('SO_REUSEPORT is not supported on this platform')
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        TCPServer.server_bind(self)
+
+
+class _UnixSocketMixin(object):
+    """
+    Listens on the Unix domain socket :attr:`unix_path`, when set, instead of the TCP port, e.g. for senders
+    running on the same host. A socket file left by a server that is no longer running is replaced, and the
+    file is removed when the server is closed. Access to the socket is controlled by the permissions of
+    its directory.
+    """
+    unix_path = None
+    _unix_bound = False
+
+    def _server_address(self, host, port, unix_path):
+        self.unix_path = unix_path
+        if unix_path is None:
+            return host, port
+        if not hasattr(socket, 'AF_UNIX'):
+            raise ValueError('Unix domain sockets are not supported on this platform')
+        self.address_family = socket.AF_UNIX
+        return unix_path
+
+    def _remove_stale_socket(self):
+        try:
+            if not stat.S_ISSOCK(os.stat(self.unix_path).st_mode):
                 return
+        except OSError:
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.unix_path)
+        except socket.error:
+            # nobody is listening
+            os.unlink(self.unix_path)
+        finally:
+            probe.close()
+
+    def server_bind(self):
+        if self.unix_path is None:
+            _ReusePortMixin.server_bind(self)
+            return
+        if self.reuse_port:
+            raise ValueError('A Unix domain socket can\'t be shared with reuse_port')
+        self._remove_stale_socket()
+        TCPServer.server_bind(self)
+        self._unix_bound = True
 
-        message = self._extract_hl7_message(line.decode(self.encoding))
-        if message is not None:
+    def _remove_socket_file(self):
+        if self._unix_bound:
+            self._unix_bound = False
             try:
-                response = self._route_message(message)
-            except Exception:
-                self.request.close()
-            else:
-                # encode the response
-                self.wfile.write(response.encode(self.encoding))
-        self.request.close()
+                os.unlink(self.unix_path)
+            except OSError:
+                pass
 
-    def _extract_hl7_message(self, msg):
-        message = None
-        matched = self.validator.match(msg)
-        if matched is not None:
-            message = matched.groups()[0]
-        return message
 
-    def _route_message(self, msg):
+def create_tls_context(certfile, keyfile=None, password=None, cafile=None, require_client_cert=False):
+    """
+    Create the server-side :class:`ssl.SSLContext` for :class:`MLLPServer` and :class:`PooledMLLPServer`.
+    TLS 1.2 or later is required.
+
+    Reconnecting senders resume their sessions with session tickets, whose keys belong to the context:
+    create it once and share it among the servers and, by creating it before forking, among the listener
+    processes, so that a session can be resumed by any of them.
+
+    :param certfile: the PEM file with the certificate of the server, and optionally its private key
+    :param keyfile: the PEM file with the private key, if not in :attr:`certfile`
+    :param password: the password of the private key
+    :param cafile: the PEM file with the certificates of the CAs used to verify the client certificates
+    :param require_client_cert: if ``True``, clients without a valid certificate are refused
+    :return: the :class:`ssl.SSLContext`
+    """
+    if ssl is None:
+        raise ValueError('TLS is not supported: the ssl module is not available')
+    context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23))
+    if hasattr(context, 'minimum_version'):
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+    else:
+        for option in ('OP_NO_SSLv2', 'OP_NO_SSLv3', 'OP_NO_TLSv1', 'OP_NO_TLSv1_1'):
+            context.options |= getattr(ssl, option, 0)
+    context.options |= getattr(ssl, 'OP_NO_COMPRESSION', 0)
+    context.load_cert_chain(certfile, keyfile, password)
+    if cafile:
+        context.load_verify_locations(cafile)
+    if require_client_cert:
+        context.verify_mode = ssl.CERT_REQUIRED
+    elif cafile:
+        context.verify_mode = ssl.CERT_OPTIONAL
+    return context
+
+
+# SSLSocket.session_reused is available since Python 3.6
+_SESSION_REUSE_KNOWN = ssl is not None and hasattr(ssl.SSLSocket, 'session_reused')
+
+
+class _TLSMixin(object):
+    """
+    Optional TLS for the MLLP servers. The handshakes are done by a small pool of :attr:`handshake_workers`
+    threads, so that slow or stalled handshakes don't hold the threads processing the frames: a connection
+    is passed to the server's request processing only once it is secured. At most
+    :attr:`max_pending_handshakes` connections wait for a handshake thread, the others are closed.
+    """
+    ssl_context = None
+    max_pending_handshakes = 128
+
+    def _init_tls(self, ssl_context, handshake_workers, handshake_timeout):
+        self.ssl_context = ssl_context
+        self.handshake_timeout = handshake_timeout
+        self.handshakes = 0
+        self.resumed_handshakes = 0
+        self.failed_handshakes = 0
+        self.refused_handshakes = 0
+        self._tls_lock = threading.Lock()
+        self._handshakes = Queue(self.max_pending_handshakes)
+        self._handshake_workers = []
+        self._handshake_worker_count = handshake_workers
+
+    def _start_handshakes(self):
+        # called once the socket is bound, so that a server failing to bind leaves no threads behind
+        if self.ssl_context is None:
+            return
+        for i in range(self._handshake_worker_count):
+            worker = threading.Thread(target=self._handshake_loop, name='mllp-handshake-%d' % i)
+            worker.daemon = True
+            worker.start()
+            self._handshake_workers.append(worker)
+
+    def _secure_request(self, request, client_address, process):
+        if self.ssl_context is None:
+            process(request, client_address)
+            return
         try:
+            self._handshakes.put_nowait((request, client_address, process))
+        except Full:
+            with self._tls_lock:
+                self.refused_handshakes += 1
+            self.shutdown_request(request)
+
+    def _handshake_loop(self):
+        while True:
+            item = self._handshakes.get()
+            if item is None:
+                return
+            request, client_address, process = item
+            try:
+                request.settimeout(self.handshake_timeout)
+                secured = self.ssl_context.wrap_socket(request, server_side=True)
+                secured.settimeout(None)
+                # Python 2 doesn't detach the wrapped socket, whose descriptor would stay open as long
+                # as this reference
+                request.close()
+            except socket.error:
+                with self._tls_lock:
+                    self.failed_handshakes += 1
+                self.shutdown_request(request)
+                continue
+            with self._tls_lock:
+                self.handshakes += 1
+                if getattr(secured, 'session_reused', False):
+                    self.resumed_handshakes += 1
             try:
-                msg_type = get_message_type(msg)
-            except ParserError:
-                raise InvalidHL7Message
+                process(secured, client_address)
+            except Exception:
+                self.handle_error(secured, client_address)
+                self.shutdown_request(secured)
+
+    def _stop_handshakes(self):
+        for _ in self._handshake_workers:
+            self._handshakes.put(None)
+        self._handshake_workers = []
+
+    def tls_stats(self):
+        """
+        Return a dictionary with the counters of the TLS handshakes: ``handshakes`` completed, of which
+        ``resumed`` from a previous session, ``failed``, ``refused`` because too many were pending and
+        ``pending``. ``resumed`` is missing on Python 2, whose ``ssl`` module doesn't tell whether a session
+        was resumed
+        """
+        with self._tls_lock:
+            stats = {
+                'handshakes': self.handshakes,
+                'failed': self.failed_handshakes,
+                'refused': self.refused_handshakes,
+                'pending': self._handshakes.qsize(),
+            }
+            if _SESSION_REUSE_KNOWN:
+                stats['resumed'] = self.resumed_handshakes
+            return stats
+
+
+class _DrainMixin(object):
+    """
+    Tracking of the connections being served, so that the server can be stopped without interrupting them
+    with :func:`drain() <_DrainMixin.drain>`.
+    """
+    draining = False
+    _serving = False
+
+    def _init_drain(self):
+        #: the connections completed while the server was draining
+        self.drained = 0
+        #: the connections closed because they didn't complete before the drain deadline
+        self.abandoned = 0
+        self._served = set()
+        self._served_cond = threading.Condition(threading.Lock())
+
+    def serve_forever(self, poll_interval=0.5):
+        self._serving = True
+        try:
+            TCPServer.serve_forever(self, poll_interval)
+        finally:
+            self._serving = False
+
+    def _track_request(self, request):
+        with self._served_cond:
+            self._served.add(request)
+
+    def finish_request(self, request, client_address):
+        self._track_request(request)
+        try:
+            TCPServer.finish_request(self, request, client_address)
+        finally:
+            with self._served_cond:
+                # a connection abandoned by the drain has already been counted
+                if request in self._served:
+                    self._served.discard(request)
+                    if self.draining:
+                        self.drained += 1
+                self._served_cond.notify_all()
+
+    def _busy(self):
+        # the connections being served or waiting for it, called with _served_cond held
+        return len(self._served) + self._handshakes.qsize()
 
+    def _stop_idle_connections(self):
+        # called when the drain starts, for servers that keep idle connections open
+        pass
+
+    def _pending_requests(self):
+        # remove and return the connections still waiting to be served, once the drain deadline has passed
+        pending = []
+        while True:
             try:
-                handler, args = self.handlers[msg_type][0], self.handlers[msg_type][1:]
-            except KeyError:
-                raise UnsupportedMessageType(msg_type)
+                item = self._handshakes.get_nowait()
+            except Empty:
+                return pending
+            if item is not None:
+                pending.append(item[0])
 
-            h = handler(msg, *args)
-            return h.reply()
-        except Exception as e:
+    def drain(self, timeout=10):
+        """
+        Stop the server gracefully: stop accepting connections, wait up to :attr:`timeout` seconds for the
+        connections being served to receive their frames and send their responses, then close the ones still
+        open and the server. It must not be called from the thread running
+        :func:`serve_forever() <socketserver.BaseServer.serve_forever>`, which takes up to its poll interval
+        to stop, in addition to :attr:`timeout`.
+
+        :param timeout: the maximum time to wait for the connections, in seconds
+        :return: a dictionary with the number of connections ``drained`` and ``abandoned``
+        """
+        deadline = time.time() + timeout
+        self.draining = True
+        if self._serving:
+            self.shutdown()
+        # the connections not yet accepted are refused by the operating system
+        self.socket.close()
+        self._stop_idle_connections()
+        with self._served_cond:
+            while self._busy():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._served_cond.wait(min(remaining, 0.1))
+            active = list(self._served)
+            self._served.clear()
+        pending = self._pending_requests()
+        self.abandoned += len(active) + len(pending)
+        for request in active:
             try:
-                err_handler, args = self.handlers['ERR'][0], self.handlers['ERR'][1:]
-            except KeyError:
-                raise e
-            else:
-                h = err_handler(e, msg, *args)
-                return h.reply()
+                request.shutdown(socket.SHUT_RDWR)
+            except (socket.error, ValueError):
+                pass
+        for request in pending:
+            self.shutdown_request(request)
+        # the threads of the abandoned connections may still be in a handler, don't wait for them
+        self.block_on_close = False
+        self.server_close()
+        return {'drained': self.drained, 'abandoned': self.abandoned}
 
 
-class MLLPServer(ThreadingMixIn, TCPServer):
+class MLLPServer(ThreadingMixIn, _TLSMixin, _DrainMixin, _UnixSocketMixin, _ReusePortMixin, TCPServer):
     """
         A :class:`TCPServer <SocketServer.TCPServer>` subclass that implements an MLLP server.
         It receives MLLP-encoded HL7 and redirects them to the correct handler, according to the
@@ -142,7 +1199,8 @@ class MLLPServer(ThreadingMixIn, TCPServer):
         The :attr:`handlers` dictionary is structured as follows. Every key represents a message type (i.e.,
         the MSH.9) to handle, and the associated value is a tuple containing a subclass of
         :class:`AbstractHandler` for that message type and additional arguments to pass to its
-        constructor.
+        constructor. Keys can also be patterns with wildcards, like ``ADT^A*`` or ``*``
+        (see :class:`MessageRouter`).
 
         It is possible to specify a special handler for errors using the ``ERR`` key.
         In this case the handler should subclass :class:`AbstractErrorHandler`,
@@ -151,19 +1209,327 @@ class MLLPServer(ThreadingMixIn, TCPServer):
 
         The class allows to specify the timeout to wait before closing the connection.
 
+        The connection is closed once the frames received with its first read are answered, so a sender
+        must wait for the ACK before sending the next message. Senders pipelining their messages on a
+        persistent connection need the server of the ``mllp2`` module.
+
+        With an :attr:`ssl_context` (see :func:`create_tls_context`) the connections are secured with TLS
+        before any frame is read. With a :attr:`unix_path` the server listens on a Unix domain socket
+        instead of :attr:`host` and :attr:`port`.
+
+        :func:`drain() <MLLPServer.drain>` stops the server letting the connections being served complete.
+
         :param host: the address of the listener
         :param port: the port of the listener
         :param handlers: the dictionary that specifies the handler classes for every kind of supported message.
         :param timeout: the timeout for the requests
+        :param reuse_port: if ``True``, the port can be bound by other processes too (see :class:`WorkerSupervisor`)
+        :param ssl_context: the :class:`ssl.SSLContext` of the TLS connections, or ``None`` for plain TCP
+        :param handshake_workers: the number of threads doing the TLS handshakes
+        :param handshake_timeout: the time, in seconds, allowed to complete a TLS handshake
+        :type frame_limits: :class:`FrameLimits`
+        :param frame_limits: the size limits of the received frames, or ``None`` for no limit
+        :param unix_path: the path of the Unix domain socket to listen on, or ``None`` to listen on the TCP port
     """
     allow_reuse_address = True
+    handler_class = _MLLPRequestHandler
 
-    def __init__(self, host, port, handlers, timeout=10):
+    def __init__(self, host, port, handlers, timeout=10, reuse_port=False, ssl_context=None, handshake_workers=4,
+                 handshake_timeout=10, frame_limits=None, unix_path=None):
         self.host = host
         self.port = port
         self.handlers = handlers
+        self.router = MessageRouter(handlers)
         self.timeout = timeout
-        TCPServer.__init__(self, (host, port), _MLLPRequestHandler)
+        self.reuse_port = reuse_port
+        self.frame_limits = frame_limits
+        self._init_tls(ssl_context, handshake_workers, handshake_timeout)
+        self._init_drain()
+        TCPServer.__init__(self, self._server_address(host, port, unix_path), self.handler_class)
+        self._start_handshakes()
+
+    def process_request(self, request, client_address):
+        self._secure_request(request, client_address, self._start_thread)
+
+    def _start_thread(self, request, client_address):
+        # tracked before the thread starts, so that a drain doesn't miss it
+        self._track_request(request)
+        try:
+            ThreadingMixIn.process_request(self, request, client_address)
+        except Exception:
+            with self._served_cond:
+                self._served.discard(request)
+            raise
+
+    def server_close(self):
+        TCPServer.server_close(self)
+        self._remove_socket_file()
+        self._stop_handshakes()
+
+
+class PooledMLLPServer(_TLSMixin, _DrainMixin, _UnixSocketMixin, _ReusePortMixin, TCPServer):
+    """
+        An MLLP server that serves the connections with a fixed pool of worker threads instead of
+        starting a new thread for every connection. The :attr:`handlers` dictionary has the same structure
+        used by :class:`MLLPServer` and, like it, every connection is closed once the frames received with
+        its first read are answered.
+
+        At most :attr:`max_workers` connections are served at the same time. When all the workers are busy,
+        new connections are handled according to the :attr:`overflow` policy:
+
+        * ``queue``: the connection waits for a free worker, up to :attr:`max_queued` waiting connections;
+          further connections are refused
+        * ``refuse``: the connection is closed immediately
+
+        The number of active, queued and refused connections is available through
+        :func:`stats() <PooledMLLPServer.stats>`. :func:`drain() <PooledMLLPServer.drain>` stops the server
+        letting the active and queued connections complete. With a :attr:`unix_path` the server listens on
+        a Unix domain socket instead of :attr:`host` and :attr:`port`.
+
+        :param host: the address of the listener
+        :param port: the port of the listener
+        :param handlers: the dictionary that specifies the handler classes for every kind of supported message.
+        :param timeout: the timeout for the requests
+        :param max_workers: the number of worker threads
+        :param max_queued: the maximum number of accepted connections waiting for a worker
+        :param overflow: the policy for the connections received when all the workers are busy
+        :param backlog: the size of the listen queue of the socket
+        :param reuse_port: if ``True``, the port can be bound by other processes too (see :class:`WorkerSupervisor`)
+        :param ssl_context: the :class:`ssl.SSLContext` of the TLS connections, or ``None`` for plain TCP.
+            The handshakes are done before the connection is admitted, so they never occupy a worker
+        :param handshake_workers: the number of threads doing the TLS handshakes
+        :param handshake_timeout: the time, in seconds, allowed to complete a TLS handshake
+        :type frame_limits: :class:`FrameLimits`
+        :param frame_limits: the size limits of the received frames, or ``None`` for no limit
+        :param unix_path: the path of the Unix domain socket to listen on, or ``None`` to listen on the TCP port
+    """
+    allow_reuse_address = True
+    handler_class = _MLLPRequestHandler
+
+    QUEUE = 'queue'
+    REFUSE = 'refuse'
+
+    def __init__(self, host, port, handlers, timeout=10, max_workers=16, max_queued=64, overflow=QUEUE,
+                 backlog=5, reuse_port=False, ssl_context=None, handshake_workers=4, handshake_timeout=10,
+                 frame_limits=None, unix_path=None):
+        if overflow not in (self.QUEUE, self.REFUSE):
+            raise ValueError('Unknown overflow policy %s' % overflow)
+        self.host = host
+        self.port = port
+        self.handlers = handlers
+        self.router = MessageRouter(handlers)
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.max_queued = max_queued if overflow == self.QUEUE else 0
+        self.overflow = overflow
+        self.request_queue_size = backlog
+        self.reuse_port = reuse_port
+        self.frame_limits = frame_limits
+
+        self.accepted = 0
+        self.active = 0
+        self.queued = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._requests = Queue()
+        self._workers = []
+        self._init_tls(ssl_context, handshake_workers, handshake_timeout)
+        self._init_drain()
+
+        TCPServer.__init__(self, self._server_address(host, port, unix_path), self.handler_class)
+        self._start_handshakes()
+
+        for i in range(max_workers):
+            worker = threading.Thread(target=self._work, name='mllp-worker-%d' % i)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def process_request(self, request, client_address):
+        self._secure_request(request, client_address, self._admit_request)
+
+    def _admit_request(self, request, client_address):
+        with self._lock:
+            admitted = self.active + self.queued < self.max_workers + self.max_queued
+            if admitted:
+                self.accepted += 1
+                self.queued += 1
+            else:
+                self.rejected += 1
+        if admitted:
+            self._requests.put((request, client_address))
+        else:
+            self.shutdown_request(request)
+
+    def _work(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            with self._lock:
+                self.queued -= 1
+                self.active += 1
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                with self._lock:
+                    self.active -= 1
+
+    def _busy(self):
+        with self._lock:
+            return self.active + self.queued + self._handshakes.qsize()
+
+    def _pending_requests(self):
+        pending = _DrainMixin._pending_requests(self)
+        while True:
+            try:
+                item = self._requests.get_nowait()
+            except Empty:
+                return pending
+            if item is not None:
+                with self._lock:
+                    self.queued -= 1
+                pending.append(item[0])
+
+    def stats(self):
+        """
+        Return a dictionary with the counters of the connections: ``accepted``, ``active``, ``queued``
+        and ``rejected``
+        """
+        with self._lock:
+            return {
+                'accepted': self.accepted,
+                'active': self.active,
+                'queued': self.queued,
+                'rejected': self.rejected,
+            }
+
+    def server_close(self):
+        TCPServer.server_close(self)
+        self._remove_socket_file()
+        self._stop_handshakes()
+        for _ in self._workers:
+            self._requests.put(None)
+
+
+class WorkerSupervisor(object):
+    """
+    Runs a fixed number of worker processes and restarts the ones that exit. It is meant for servers
+    created with ``reuse_port=True``: every worker binds the same port, so the kernel balances the
+    connections among the processes and the messages are handled on more than one core.
+
+    A worker that exits within :attr:`min_uptime` seconds from its start is restarted after a delay
+    that doubles at every consecutive failure, up to :attr:`max_restart_delay` seconds.
+
+    The workers are not daemonic, so that they can start processes of their own, e.g. a
+    :class:`multiprocessing.Pool`. They aren't killed when the supervisor dies, so :attr:`target` must
+    return once its parent process changes, i.e. when :func:`os.getppid` is no longer the pid of the
+    supervisor.
+
+    :param target: the callable run by the workers. It receives the index of the worker followed by :attr:`args`
+    :param workers: the number of worker processes
+    :param args: additional arguments for :attr:`target`
+    :param min_uptime: the minimum lifetime of a worker to consider it healthy
+    :param restart_delay: the initial delay before restarting a worker that failed
+    :param max_restart_delay: the maximum delay before restarting a worker
+    """
+    def __init__(self, target, workers, args=(), min_uptime=5.0, restart_delay=1.0, max_restart_delay=60.0):
+        self.target = target
+        self.workers = workers
+        self.args = tuple(args)
+        self.min_uptime = min_uptime
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.restarts = 0
+        self._processes = [None] * workers
+        self._started_at = [0.0] * workers
+        self._failures = [0] * workers
+        self._restart_at = [0.0] * workers
+        self._stopped = threading.Event()
+        # set by terminate(), without the lock of the event, as it may run in a signal handler
+        self._terminated = False
+
+    def _spawn(self, index):
+        process = multiprocessing.Process(target=self.target, args=(index,) + self.args,
+                                          name='mllp-worker-%d' % index)
+        process.start()
+        self._processes[index] = process
+        self._started_at[index] = time.time()
+
+    def start(self):
+        """
+        Start all the workers
+        """
+        for index in range(self.workers):
+            self._spawn(index)
+
+    def check(self):
+        """
+        Restart the workers that exited, once their restart delay is over
+        """
+        if self._terminated or self._stopped.is_set():
+            return
+        now = time.time()
+        for index, process in enumerate(self._processes):
+            if process is None or process.is_alive():
+                continue
+            if not self._restart_at[index]:
+                if now - self._started_at[index] < self.min_uptime:
+                    self._failures[index] += 1
+                else:
+                    self._failures[index] = 0
+                delay = min(self.restart_delay * 2 ** max(self._failures[index] - 1, 0), self.max_restart_delay)
+                self._restart_at[index] = now + delay if self._failures[index] else now
+            if now >= self._restart_at[index]:
+                self._restart_at[index] = 0.0
+                self.restarts += 1
+                self._spawn(index)
+
+    def alive(self):
+        """
+        Return the number of workers currently running
+        """
+        return sum(1 for p in self._processes if p is not None and p.is_alive())
+
+    def supervise(self, poll_interval=1.0):
+        """
+        Check the workers every :attr:`poll_interval` seconds until :func:`stop() <WorkerSupervisor.stop>`
+        or :func:`terminate() <WorkerSupervisor.terminate>` is called
+        """
+        while not self._stopped.is_set() and not self._terminated:
+            self.check()
+            self._stopped.wait(poll_interval)
+
+    def terminate(self):
+        """
+        Stop supervising and send ``SIGTERM`` to the workers without waiting for them to exit, so that it can
+        be called from a signal handler. :func:`supervise() <WorkerSupervisor.supervise>` returns within its
+        poll interval, and :func:`stop() <WorkerSupervisor.stop>` waits for the workers
+        """
+        self._terminated = True
+        for process in self._processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+
+    def stop(self, timeout=5.0):
+        """
+        Stop supervising, terminate the workers and wait for them to exit. The workers still running after
+        the timeout are killed, as the exit of this process would wait for them
+
+        :param timeout: the time to wait for every worker to exit
+        """
+        self._stopped.set()
+        self.terminate()
+        for process in self._processes:
+            if process is not None:
+                process.join(timeout)
+                if process.is_alive():
+                    os.kill(process.pid, signal.SIGKILL)
+                    process.join()
 
 
 class AbstractHandler(object):
@@ -174,12 +1540,27 @@ class AbstractHandler(object):
 
         :param message: the ER7-formatted HL7 message to handle
     """
+    _header = None
+
     def __init__(self, message):
         self.incoming_message = message
 
+    @property
+    def header(self):
+        """
+        The :class:`MSHHeader` of the incoming message. The servers pass the one split to route the message
+
+        :raises: :exc:`ParserError <hl7apy.exceptions.ParserError>` if the message doesn't start with a valid
+            MSH segment
+        """
+        if self._header is None:
+            self._header = MSHHeader(self.incoming_message)
+        return self._header
+
     def reply(self):
         """
-            Abstract method. It should implement the handling of the request message and return the response.
+            Abstract method. It should implement the handling of the request message and return the response,
+            or ``None`` if no response must be sent (e.g. when the sender doesn't want acknowledgments).
         """
         raise NotImplementedError("The method reply() must be implemented in subclasses")
 
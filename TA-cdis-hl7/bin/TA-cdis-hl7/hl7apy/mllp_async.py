@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2015, CRS4
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+asyncio implementation of the MLLP server. It requires Python 3.7 or later, so it lives in its own module
+and :mod:`hl7apy.mllp` can still be imported by older interpreters.
+"""
+
+import asyncio
+import functools
+
+from hl7apy.mllp import MLLPFrameReader, MessageRouter, OversizedFrame, SpilledFrame, _MLLPDispatcherMixin, \
+    _UnixSocketMixin, _frame_data
+
+
+class _AsyncMLLPConnection(_MLLPDispatcherMixin):
+    """
+    A single connection accepted by :class:`AsyncMLLPServer`. Frames are processed in the order they arrive
+    and the connection stays open until the peer closes it, the idle timeout expires or the server is drained.
+    """
+    encoding = 'utf-8'
+    sb = b"\x0b"
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.handlers = server.handlers
+        self.router = server.router
+        self.timeout = server.timeout
+        self.reader = reader
+        self.writer = writer
+        self.peer = writer.get_extra_info('peername')
+        self.frames = MLLPFrameReader(chunk_size=server.chunk_size, limits=server.frame_limits)
+        # waiting for a new frame, with nothing buffered
+        self.idle = True
+
+    async def handle(self):
+        try:
+            while not self.server.draining or self.frames.buffered():
+                self.idle = not self.frames.buffered()
+                try:
+                    data = await asyncio.wait_for(self.reader.read(self.frames.chunk_size), self.timeout)
+                except asyncio.TimeoutError:
+                    return
+                finally:
+                    self.idle = False
+                if not data:
+                    return
+                self.frames.feed(data)
+
+                frame = self.frames.next_frame()
+                while frame is not None:
+                    if isinstance(frame, OversizedFrame):
+                        response = self._oversized_response(frame)
+                        if response is None:
+                            return
+                        self.writer.write(response.encode(self.encoding))
+                        frame = self.frames.next_frame()
+                        continue
+                    try:
+                        data = _frame_data(frame)
+                        if data[:1] != self.sb:  # First MLLP char
+                            return
+                        message = self._extract_hl7_message(data)
+                        data = None
+                    finally:
+                        if isinstance(frame, SpilledFrame):
+                            frame.close()
+                    if message is not None:
+                        try:
+                            response = await self._dispatch(message)
+                        except Exception:
+                            return
+                        if response is not None:
+                            self.writer.write(response.encode(self.encoding))
+                    frame = self.frames.next_frame()
+                await self.writer.drain()
+        finally:
+            self.frames.close()
+            self.writer.close()
+
+    def interrupt(self):
+        """
+        Stop waiting for new frames, if the connection is idle
+        """
+        if self.idle:
+            # the pending read returns what was already received, then the end of the stream
+            self.reader.feed_eof()
+
+    async def _dispatch(self, message):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.server.executor, functools.partial(self._route_message, message))
+
+
+class AsyncMLLPServer(_UnixSocketMixin):
+    """
+        An asyncio implementation of :class:`MLLPServer <hl7apy.mllp.MLLPServer>`. All the connections are served
+        by a single event loop, so a large number of long-lived connections doesn't need one thread each.
+
+        The :attr:`handlers` dictionary has the same structure used by :class:`MLLPServer <hl7apy.mllp.MLLPServer>`
+        and the handlers are subclasses of :class:`AbstractHandler <hl7apy.mllp.AbstractHandler>` and
+        :class:`AbstractErrorHandler <hl7apy.mllp.AbstractErrorHandler>`.
+        Unlike :class:`MLLPServer <hl7apy.mllp.MLLPServer>`, the connection is kept open after the response is sent,
+        and it is closed when the peer closes it or when no data is received for :attr:`timeout` seconds.
+
+        The handlers' :func:`reply() <hl7apy.mllp.AbstractHandler.reply>` method is called in the
+        :attr:`executor`, by default the one of the event loop, so a slow handler doesn't stop the other
+        connections. The frames of a connection are still handled one at a time, in order.
+
+        With an :attr:`ssl_context` (see :func:`create_tls_context <hl7apy.mllp.create_tls_context>`) the
+        connections are secured with TLS, and with a :attr:`unix_path` the server listens on a Unix domain
+        socket instead of :attr:`host` and :attr:`port`. :func:`drain() <AsyncMLLPServer.drain>` stops the
+        server letting the connections being served complete.
+
+        :param host: the address of the listener
+        :param port: the port of the listener
+        :param handlers: the dictionary that specifies the handler classes for every kind of supported message.
+        :param timeout: the idle timeout of the connections, or ``None`` to wait forever
+        :param executor: the :class:`concurrent.futures.Executor` running the handlers, or ``None`` for the
+            default executor of the event loop
+        :param chunk_size: the maximum number of bytes read from a connection at once
+        :param frame_limits: the size limits of the received frames, a :class:`FrameLimits
+            <hl7apy.mllp.FrameLimits>` or ``None`` for no limit
+        :param ssl_context: the :class:`ssl.SSLContext` of the TLS connections, or ``None`` for plain TCP
+        :param handshake_timeout: the time, in seconds, allowed to complete a TLS handshake
+        :param unix_path: the path of the Unix domain socket to listen on, or ``None`` to listen on the TCP port
+    """
+    def __init__(self, host, port, handlers, timeout=10, executor=None, chunk_size=65536, frame_limits=None,
+                 ssl_context=None, handshake_timeout=10, unix_path=None):
+        self.host = host
+        self.port = port
+        self.handlers = handlers
+        self.router = MessageRouter(handlers)
+        self.timeout = timeout
+        self.executor = executor
+        self.chunk_size = chunk_size
+        self.frame_limits = frame_limits
+        self.ssl_context = ssl_context
+        self.handshake_timeout = handshake_timeout
+        self.unix_path = unix_path
+        self.active_connections = 0
+        self.draining = False
+        #: the connections completed while the server was draining
+        self.drained = 0
+        #: the connections closed because they didn't complete before the drain deadline
+        self.abandoned = 0
+        self._connections = {}
+        self._drain_done = None
+        self._server = None
+        self._loop = None
+
+    @property
+    def server_address(self):
+        """
+        The address the server is bound to. It is available after :func:`start() <AsyncMLLPServer.start>`
+        """
+        return self._server.sockets[0].getsockname()
+
+    async def start(self):
+        """
+        Bind the listener and start accepting connections in the running event loop
+        """
+        self._loop = asyncio.get_event_loop()
+        tls = {}
+        if self.ssl_context is not None:
+            tls = {'ssl': self.ssl_context, 'ssl_handshake_timeout': self.handshake_timeout}
+        if self.unix_path is None:
+            self._server = await asyncio.start_server(self._handle_connection, self.host, self.port,
+                                                      reuse_address=True, **tls)
+        else:
+            self._remove_stale_socket()
+            self._server = await asyncio.start_unix_server(self._handle_connection, self.unix_path, **tls)
+            self._unix_bound = True
+
+    async def _handle_connection(self, reader, writer):
+        connection = _AsyncMLLPConnection(self, reader, writer)
+        self._connections[asyncio.current_task()] = connection
+        self.active_connections += 1
+        try:
+            await connection.handle()
+        finally:
+            self.active_connections -= 1
+            del self._connections[asyncio.current_task()]
+
+    async def serve(self):
+        """
+        Start the server, if needed, and serve until :func:`shutdown() <AsyncMLLPServer.shutdown>` or
+        :func:`drain() <AsyncMLLPServer.drain>` is called
+        """
+        if self._server is None:
+            await self.start()
+        try:
+            await self._server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self._server.close()
+            if self._drain_done is not None:
+                await self._drain_done.wait()
+            await self._server.wait_closed()
+            self._remove_socket_file()
+
+    def serve_forever(self):
+        """
+        Run a new event loop in the current thread and serve until :func:`shutdown() <AsyncMLLPServer.shutdown>`
+        is called
+        """
+        asyncio.run(self.serve())
+
+    def shutdown(self):
+        """
+        Stop accepting connections. It can be called from any thread
+        """
+        if self._loop is not None and self._server is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._server.close)
+            except RuntimeError:
+                # the event loop has already stopped
+                pass
+
+    async def drain_connections(self, timeout=10):
+        """
+        Coroutine version of :func:`drain() <AsyncMLLPServer.drain>`, to run in the event loop of the server
+        """
+        self.draining = True
+        # serve() returns once the connections are drained
+        self._drain_done = asyncio.Event()
+        self._server.close()
+        try:
+            for connection in list(self._connections.values()):
+                connection.interrupt()
+            tasks = list(self._connections)
+            if tasks:
+                done, pending = await asyncio.wait(tasks, timeout=timeout)
+                self.drained += len(done)
+                self.abandoned += len(pending)
+                for task in pending:
+                    task.cancel()
+                if pending:
+                    await asyncio.wait(pending)
+        finally:
+            self._drain_done.set()
+        return {'drained': self.drained, 'abandoned': self.abandoned}
+
+    def drain(self, timeout=10):
+        """
+        Stop the server gracefully: stop accepting connections, close the idle ones and wait up to
+        :attr:`timeout` seconds for the others to answer the frames they are receiving, then close the ones
+        still open. It must be called from a thread other than the one running the event loop.
+
+        :param timeout: the maximum time to wait for the connections, in seconds
+        :return: a dictionary with the number of connections ``drained`` and ``abandoned``
+        """
+        return asyncio.run_coroutine_threadsafe(self.drain_connections(timeout), self._loop).result()
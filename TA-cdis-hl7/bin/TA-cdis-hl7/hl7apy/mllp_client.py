@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012-2015, CRS4
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import collections
+import socket
+import threading
+import time
+
+from hl7apy.exceptions import HL7apyException
+from hl7apy.mllp import MLLPFrameReader, _frame_data, _decode
+
+
+class MLLPClientError(HL7apyException):
+    """
+    Error that occurs when a message can't be delivered by the :class:`MLLPClient` or its response can't be read
+    """
+
+
+class MLLPTimeout(MLLPClientError):
+    """
+    Error that occurs when the response to a message is not received in time
+    """
+    def __str__(self):
+        return 'Timeout waiting for the MLLP response'
+
+
+class MLLPFuture(object):
+    """
+    The pending response to a message sent with :class:`MLLPClient`
+    """
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exception = None
+        self.sent_at = None
+
+    def done(self):
+        """
+        Return ``True`` if the response has been received or the message has failed
+        """
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """
+        Wait for the response and return it
+
+        :param timeout: the maximum time to wait, in seconds, or ``None`` to wait forever
+        :return: the ER7-encoded response
+        :raises: :exc:`MLLPTimeout` if the response doesn't arrive in time,
+            or the exception that made the message fail
+        """
+        if not self._event.wait(timeout):
+            raise MLLPTimeout()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+        Wait for the response and return the exception that made the message fail, or ``None``
+        """
+        if not self._event.wait(timeout):
+            raise MLLPTimeout()
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """
+        Call ``fn(future)`` when the response is received or the message fails. If that already happened,
+        ``fn`` is called immediately
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _complete(self, result, exception):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._result = result
+            self._exception = exception
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                pass
+
+    def set_result(self, result):
+        self._complete(result, None)
+
+    def set_exception(self, exception):
+        self._complete(None, exception)
+
+
+class _MLLPConnection(object):
+    """
+    A connection to an MLLP server. Up to :attr:`max_in_flight` messages are sent without waiting for
+    their responses, which are matched to the messages in the order they arrive. A reader thread
+    completes the futures; if the oldest message doesn't get its response within :attr:`timeout` seconds,
+    the connection is closed and all its pending messages fail. Without :attr:`expect_responses`, the
+    futures are completed once the messages are written and the responses received, if any, are discarded.
+    """
+    encoding = 'utf-8'
+
+    def __init__(self, address, timeout, connect_timeout, max_in_flight, chunk_size, ssl_context=None,
+                 server_hostname=None, session=None, expect_responses=True):
+        self.address = address
+        self.timeout = timeout
+        self.max_in_flight = max_in_flight
+        self.expect_responses = expect_responses
+        self.closed = False
+        self.session = None
+        self._pending = collections.deque()
+        self._cond = threading.Condition(threading.Lock())
+        self._send_lock = threading.Lock()
+
+        self.sock = socket.create_connection(address, connect_timeout)
+        if ssl_context is not None:
+            kwargs = {'server_hostname': server_hostname or address[0]}
+            if session is not None:
+                kwargs['session'] = session
+            try:
+                self.sock = ssl_context.wrap_socket(self.sock, **kwargs)
+            except socket.error:
+                self.sock.close()
+                raise
+        self.sock.settimeout(timeout)
+        self.reader = MLLPFrameReader(self.sock, chunk_size)
+        self._thread = threading.Thread(target=self._read_responses, name='mllp-client-%s:%s' % address)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def in_flight(self):
+        return len(self._pending)
+
+    def send(self, message):
+        if not isinstance(message, bytes):
+            message = message.encode(self.encoding)
+        data = b'\x0b' + message + b'\x1c\x0d'
+        future = MLLPFuture()
+        # the futures must be queued in the same order the messages are written to the socket, but the
+        # reader thread must not wait for a blocked sendall() to complete the futures
+        with self._send_lock:
+            with self._cond:
+                deadline = time.time() + self.timeout if self.timeout is not None else None
+                while len(self._pending) >= self.max_in_flight and not self.closed:
+                    remaining = deadline - time.time() if deadline is not None else None
+                    if remaining is not None and remaining <= 0:
+                        raise MLLPTimeout()
+                    self._cond.wait(remaining)
+                if self.closed:
+                    raise MLLPClientError('Connection to %s:%s closed' % self.address)
+                if self.expect_responses:
+                    future.sent_at = time.time()
+                    self._pending.append(future)
+            try:
+                self.sock.sendall(data)
+            except socket.error as e:
+                self.close(MLLPClientError(str(e)))
+                raise MLLPClientError(str(e))
+        if not self.expect_responses:
+            future.set_result(None)
+        return future
+
+    def _read_responses(self):
+        while not self.closed:
+            try:
+                frame = self.reader.read_frame()
+            except socket.timeout:
+                with self._cond:
+                    if self._pending and time.time() - self._pending[0].sent_at >= self.timeout:
+                        self._close_locked(MLLPTimeout())
+                        return
+                continue
+            except socket.error as e:
+                self.close(MLLPClientError(str(e)))
+                return
+            if frame is None:
+                self.close(MLLPClientError('Connection to %s:%s closed by the server' % self.address))
+                return
+            # with TLS 1.3 the session tickets arrive after the handshake
+            self.session = getattr(self.sock, 'session', None)
+            with self._cond:
+                future = self._pending.popleft() if self._pending else None
+                self._cond.notify()
+            if future is not None:
+                future.set_result(_decode(_frame_data(frame)[1:-2], self.encoding))
+
+    def _close_locked(self, exception):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+        pending, self._pending = self._pending, collections.deque()
+        self._cond.notify_all()
+        for future in pending:
+            future.set_exception(exception)
+
+    def close(self, exception=None):
+        with self._cond:
+            self._close_locked(exception or MLLPClientError('Connection closed'))
+
+
+class MLLPClient(object):
+    """
+        An MLLP client that keeps a pool of persistent connections for every server it sends messages to.
+
+        Every connection can have up to :attr:`max_in_flight` messages waiting for their responses
+        (pipelining). A message is sent on the pooled connection with the fewest messages in flight, and a new
+        connection is opened when all of them are busy and the pool has less than :attr:`pool_size`
+        connections. :func:`send() <MLLPClient.send>` blocks only when all the connections of the pool are full.
+
+        Responses are returned as :class:`MLLPFuture` objects, which also accept callbacks.
+        A connection closed by the server, or whose oldest message doesn't get a response within
+        :attr:`timeout` seconds, fails all its pending messages and is replaced by a new one on the next send.
+
+        With an :attr:`ssl_context` the connections use TLS, and new connections resume the last TLS session
+        established with the same server. Connections are opened without blocking the messages sent to the
+        other servers or on the connections already open.
+
+        The servers of :mod:`hl7apy.mllp` close the connection once they have answered, so the client opens a
+        new connection, and does a new TLS handshake, for almost every message sent to them; a message written
+        just before the close is noticed fails with :exc:`MLLPClientError`. Pipelining needs a server that
+        keeps the connections open, like the one of the ``mllp2`` module.
+
+        >>> client = MLLPClient(max_in_flight=8, pool_size=2)  # doctest: +SKIP
+        >>> ack = client.send('localhost', 2575, message).result(timeout=10)  # doctest: +SKIP
+
+        :param timeout: the time, in seconds, to wait for a response
+        :param connect_timeout: the time, in seconds, to wait for a connection to be established
+        :param max_in_flight: the maximum number of messages waiting for a response on a connection
+        :param pool_size: the maximum number of connections to every server
+        :param retries: the number of times a message is sent again on a new connection when sending fails
+        :param chunk_size: the maximum number of bytes read from a connection at once
+        :param ssl_context: the client-side :class:`ssl.SSLContext` of the TLS connections, or ``None`` for plain TCP
+        :param server_hostname: the host name checked against the server certificate, if different from
+            the address passed to :func:`send() <MLLPClient.send>`
+        :param expect_responses: if ``False``, the messages are sent without waiting for a response, e.g. the
+            application ACKs of the enhanced acknowledgment mode: their futures are completed with ``None`` once
+            they are written, and the responses received anyway are discarded
+    """
+    def __init__(self, timeout=10, connect_timeout=10, max_in_flight=1, pool_size=1, retries=1, chunk_size=65536,
+                 ssl_context=None, server_hostname=None, expect_responses=True):
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_in_flight = max_in_flight
+        self.pool_size = pool_size
+        self.retries = retries
+        self.chunk_size = chunk_size
+        self.ssl_context = ssl_context
+        self.server_hostname = server_hostname
+        self.expect_responses = expect_responses
+        self.reconnects = 0
+        self._pools = {}
+        self._sessions = {}
+        # connections being opened to every server, counted in the pool size
+        self._connecting = {}
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+
+    def _alive(self, address):
+        # drop the closed connections of the pool, keeping the last TLS session they established
+        pool = self._pools.get(address, [])
+        for c in pool:
+            if c.session is not None:
+                self._sessions[address] = c.session
+        alive = [c for c in pool if not c.closed]
+        self.reconnects += len(pool) - len(alive)
+        self._pools[address] = alive
+        return alive
+
+    def _connection(self, address):
+        with self._cond:
+            while True:
+                pool = self._alive(address)
+                connecting = self._connecting.get(address, 0)
+                if pool:
+                    best = min(pool, key=lambda c: c.in_flight())
+                    if best.in_flight() < self.max_in_flight or len(pool) + connecting >= self.pool_size:
+                        return best
+                if len(pool) + connecting < self.pool_size:
+                    break
+                # all the slots are taken by connections being opened
+                self._cond.wait()
+            # the slot is reserved, so that the connection and its TLS handshake don't hold the lock
+            self._connecting[address] = connecting + 1
+            session = self._sessions.get(address)
+        connection = None
+        try:
+            connection = _MLLPConnection(address, self.timeout, self.connect_timeout, self.max_in_flight,
+                                         self.chunk_size, self.ssl_context, self.server_hostname, session,
+                                         self.expect_responses)
+        finally:
+            with self._cond:
+                self._connecting[address] -= 1
+                if connection is not None:
+                    self._pools.setdefault(address, []).append(connection)
+                self._cond.notify_all()
+        return connection
+
+    def send(self, host, port, message, callback=None):
+        """
+        Send an ER7-encoded message
+
+        :param host: the address of the server
+        :param port: the port of the server
+        :param message: the ER7-encoded message, without the MLLP encoding characters
+        :param callback: an optional callable, called with the future when the response arrives or the message fails
+        :return: an :class:`MLLPFuture` for the ER7-encoded response
+        """
+        attempts = 0
+        while True:
+            try:
+                future = self._connection((host, port)).send(message)
+            except (MLLPClientError, socket.error) as e:
+                if isinstance(e, MLLPTimeout) or attempts >= self.retries:
+                    if isinstance(e, MLLPClientError):
+                        raise
+                    raise MLLPClientError(str(e))
+                attempts += 1
+            else:
+                break
+        if callback is not None:
+            future.add_done_callback(callback)
+        return future
+
+    def close(self):
+        """
+        Close all the connections. Messages waiting for a response fail
+        """
+        with self._lock:
+            pools, self._pools = self._pools, {}
+        for pool in pools.values():
+            for connection in pool:
+                connection.close()
@@ -19,192 +19,184 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+"""
+A variant of :mod:`hl7apy.mllp` whose handler keeps the connection open after sending the response,
+for senders that deliver all their messages on a persistent connection.
+"""
+
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
-import re
 import socket
-try:
-    from SocketServer import StreamRequestHandler, TCPServer, ThreadingMixIn
-except ImportError:
-    from socketserver import StreamRequestHandler, TCPServer, ThreadingMixIn
-
-from hl7apy.parser import get_message_type
-from hl7apy.exceptions import HL7apyException, ParserError
-
-
-class UnsupportedMessageType(HL7apyException):
-    """
-    Error that occurs when the :class:`MLLPServer` receives a message without an associated handler
-    """
-    def __init__(self, msg_type):
-        self.msg_type = msg_type
+import threading
+import time
 
-    def __str__(self):
-        return 'Unsupported message type %s' % self.msg_type
+from hl7apy import mllp
+from hl7apy.mllp import UnsupportedMessageType, InvalidHL7Message, AbstractHandler, AbstractErrorHandler
 
 
-class InvalidHL7Message(HL7apyException):
+class CONNECTION_STATE(object):
     """
-    Error that occurs when the :class:`MLLPServer` receives a string which doesn't represent an ER7-encoded HL7 message
+    States of a persistent connection
     """
-    def __str__(self):
-        return 'The string received is not a valid HL7 message'
+    #: Accepted, nothing received yet
+    OPEN = 'open'
+    #: Part of a frame has been received, waiting for the rest
+    READING = 'reading'
+    #: Waiting for a new frame
+    IDLE = 'idle'
+    #: Processing the received frames and sending the responses
+    DRAINING = 'draining'
+    #: The connection has been closed
+    CLOSED = 'closed'
 
 
-class _MLLPRequestHandler(StreamRequestHandler):
-    encoding = 'utf-8'
-
-    def __init__(self, *args, **kwargs):
-        StreamRequestHandler.__init__(self, *args, **kwargs)
+class _MLLPRequestHandler(mllp._MLLPRequestHandler):
 
     def setup(self):
-        self.sb = b"\x0b"
-        self.eb = b"\x1c"
-        self.cr = b"\x0d"
-        self.validator = re.compile(
-            ''.join([self.sb.decode('ascii'), r"(([^\r]+\r)*([^\r]+\r?))", self.eb.decode('ascii'), self.cr.decode('ascii')]))
-        self.handlers = self.server.handlers
-        self.timeout = self.server.timeout
-
-        StreamRequestHandler.setup(self)
+        mllp._MLLPRequestHandler.setup(self)
+        self.state = CONNECTION_STATE.OPEN
+        self.opened_at = time.time()
+        self.closed_at = None
+        self.close_reason = None
+        self.errors = 0
+        self.idle_timeout = self.server.idle_timeout
+        self.server.connection_opened(self)
 
     def handle(self):
-        while 1:
+        while self.state != CONNECTION_STATE.CLOSED:
             try:
                 self.handle0()
             except Exception:
-                self.request.close()
-
-        self.request.close()
-
+                self.errors += 1
+                self._close('error')
 
     def handle0(self):
-        end_seq = self.eb + self.cr
-        try:
-            line = self.request.recv(3)
-        except socket.timeout:
-            self.request.close()
-            return
-
-        if line[:1] != self.sb:  # First MLLP char
-            self.request.close()
-            return
-
-        while line[-2:] != end_seq:
-            try:
-                char = self.rfile.read(1)
-                if not char:
-                    break
-                line += char
-            except socket.timeout:
-                self.request.close()
+        frame = self.reader.next_frame()
+        while frame is None:
+            if self.reader.buffered():
+                self.state = CONNECTION_STATE.READING
+                self.request.settimeout(self.timeout)
+            elif self.server.draining:
+                # all the frames received have been answered
+                self._close('drain')
                 return
-
-        message = self._extract_hl7_message(line.decode(self.encoding))
-        if message is not None:
-            try:
-                response = self._route_message(message)
-            except Exception:
-                self.request.close()
             else:
-                # encode the response
-                self.wfile.write(response.encode(self.encoding))
-        #self.request.close()
-
-    def _extract_hl7_message(self, msg):
-        message = None
-        matched = self.validator.match(msg)
-        if matched is not None:
-            message = matched.groups()[0]
-        return message
-
-    def _route_message(self, msg):
-        try:
+                self.state = CONNECTION_STATE.IDLE
+                self.request.settimeout(self.idle_timeout)
             try:
-                msg_type = get_message_type(msg)
-            except ParserError:
-                raise InvalidHL7Message
+                received = self.reader.fill()
+            except socket.timeout:
+                self._close('timeout')
+                return
+            if not received:
+                self._close('drain' if self.server.draining else 'eof')
+                return
+            frame = self.reader.next_frame()
 
-            try:
-                handler, args = self.handlers[msg_type][0], self.handlers[msg_type][1:]
-            except KeyError:
-                raise UnsupportedMessageType(msg_type)
+        self.state = CONNECTION_STATE.DRAINING
+        responses, keep_open = self._process_frames(frame)
+        self._write_responses(responses)
+        if not keep_open:
+            self.errors += 1
+            self._close('invalid frame')
 
-            h = handler(msg, *args)
-            return h.reply()
-        except Exception as e:
-            try:
-                err_handler, args = self.handlers['ERR'][0], self.handlers['ERR'][1:]
-            except KeyError:
-                raise e
-            else:
-                h = err_handler(e, msg, *args)
-                return h.reply()
+    def _close(self, reason):
+        if self.state == CONNECTION_STATE.CLOSED:
+            return
+        self.state = CONNECTION_STATE.CLOSED
+        self.close_reason = reason
+        self.closed_at = time.time()
+        self.request.close()
+        self.server.connection_closed(self)
 
+    def interrupt(self):
+        """
+        Stop waiting for new frames: the connection is closed once the frame being received, if any,
+        has been answered
+        """
+        try:
+            # SSLSocket.shutdown() would also stop encrypting the responses
+            socket.socket.shutdown(self.request, socket.SHUT_RD)
+        except (socket.error, ValueError):
+            pass
 
-class MLLPServer(ThreadingMixIn, TCPServer):
-    """
-        A :class:`TCPServer <SocketServer.TCPServer>` subclass that implements an MLLP server.
-        It receives MLLP-encoded HL7 and redirects them to the correct handler, according to the
-        :attr:`handlers` dictionary passed in.
-
-        The :attr:`handlers` dictionary is structured as follows. Every key represents a message type (i.e.,
-        the MSH.9) to handle, and the associated value is a tuple containing a subclass of
-        :class:`AbstractHandler` for that message type and additional arguments to pass to its
-        constructor.
-
-        It is possible to specify a special handler for errors using the ``ERR`` key.
-        In this case the handler should subclass :class:`AbstractErrorHandler`,
-        which receives, in addition to other parameters, the raised exception as the first argument.
-        If the special handler is not specified the server will just close the connection.
-
-        The class allows to specify the timeout to wait before closing the connection.
-
-        :param host: the address of the listener
-        :param port: the port of the listener
-        :param handlers: the dictionary that specifies the handler classes for every kind of supported message.
-        :param timeout: the timeout for the requests
+    def stats(self):
+        """
+        Return a dictionary with the statistics of the connection
+        """
+        end = self.closed_at if self.closed_at is not None else time.time()
+        return {
+            'peer': self.client_address,
+            'state': self.state,
+            'bytes_received': self.reader.received,
+            'bytes_sent': self.bytes_sent,
+            'frames': self.frames,
+            'errors': self.errors,
+            'rejected_frames': self.rejected_frames,
+            'last_rejection': self.last_rejection.reason if self.last_rejection is not None else None,
+            'lifetime': end - self.opened_at,
+            'close_reason': self.close_reason,
+        }
+
+
+class MLLPServer(mllp.MLLPServer):
     """
-    allow_reuse_address = True
+        A :class:`MLLPServer <hl7apy.mllp.MLLPServer>` that keeps the connections open, serving all the
+        messages a sender delivers on the same connection. See :class:`hl7apy.mllp.MLLPServer` for the other
+        parameters.
 
-    def __init__(self, host, port, handlers, timeout=10):
-        self.host = host
-        self.port = port
-        self.handlers = handlers
-        self.timeout = timeout
-        TCPServer.__init__(self, (host, port), _MLLPRequestHandler)
+        A connection waiting for a new message is closed after :attr:`idle_timeout` seconds, while
+        :attr:`timeout` applies when part of a message has been received. The handler thread exits as soon as
+        the connection is closed.
 
+        :func:`drain() <MLLPServer.drain>` closes the idle connections at once and the others as soon as
+        the frames they are receiving have been answered.
 
-class AbstractHandler(object):
-    """
-        Abstract transaction handler. Handlers should implement the
-        :func:`reply() <AbstractHandler.reply>` method which handle the incoming message.
-        The incoming message is accessible using the attribute :attr:`incoming_message`
+        The statistics of the open connections are returned by :func:`connection_stats()
+        <MLLPServer.connection_stats>`. When a connection is closed its final statistics are passed to
+        :func:`connection_closed() <MLLPServer.connection_closed>` and added to :attr:`closed_totals`.
 
-        :param message: the ER7-formatted HL7 message to handle
+        :param idle_timeout: the timeout for idle connections, or ``None`` to use :attr:`timeout`
     """
-    def __init__(self, message):
-        self.incoming_message = message
+    handler_class = _MLLPRequestHandler
+
+    def __init__(self, host, port, handlers, timeout=10, idle_timeout=None, reuse_port=False, ssl_context=None,
+                 handshake_workers=4, handshake_timeout=10, frame_limits=None, unix_path=None):
+        self.idle_timeout = idle_timeout if idle_timeout is not None else timeout
+        self.connections = set()
+        self.closed_totals = {'connections': 0, 'bytes_received': 0, 'bytes_sent': 0, 'frames': 0, 'errors': 0}
+        self._connections_lock = threading.Lock()
+        mllp.MLLPServer.__init__(self, host, port, handlers, timeout, reuse_port, ssl_context, handshake_workers,
+                                 handshake_timeout, frame_limits, unix_path)
+
+    def _stop_idle_connections(self):
+        with self._connections_lock:
+            idle = [c for c in self.connections if c.state in (CONNECTION_STATE.OPEN, CONNECTION_STATE.IDLE)]
+        for connection in idle:
+            connection.interrupt()
+
+    def connection_opened(self, handler):
+        with self._connections_lock:
+            self.connections.add(handler)
+
+    def connection_closed(self, handler):
+        """
+        Called when a connection is closed. It can be overridden to report the statistics of the connection
 
-    def reply(self):
+        :param handler: the handler of the connection
         """
-            Abstract method. It should implement the handling of the request message and return the response.
+        stats = handler.stats()
+        with self._connections_lock:
+            self.connections.discard(handler)
+            self.closed_totals['connections'] += 1
+            for key in ('bytes_received', 'bytes_sent', 'frames', 'errors'):
+                self.closed_totals[key] += stats[key]
+
+    def connection_stats(self):
         """
-        raise NotImplementedError("The method reply() must be implemented in subclasses")
-
-
-class AbstractErrorHandler(AbstractHandler):
-    """
-    Abstract transaction handler for errors. It receives also the instance of the exception occurred, which will be
-    accessible through the :attr:`exc` attribute.
-    Specific exceptions that can be handled are :exc:`UnsupportedMessageType` and :exc:`InvalidHL7Message`
-
-    :param exc: the :exc:`Exception` occurred
-    """
-    def __init__(self, exc, message):
-        super(AbstractErrorHandler, self).__init__(message)
-        self.exc = exc
-
-    def reply(self):
-        super(AbstractErrorHandler, self).reply()
+        Return a list with the statistics of the open connections
+        """
+        with self._connections_lock:
+            connections = list(self.connections)
+        return [c.stats() for c in connections]
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+"""
+Parallel processing of the messages that keeps the order of the messages of every connection: the messages
+are parsed by a pool of processes, so that a busy sender can use more than one core, and their results are
+released in the order the messages were received, so that e.g. an A08 update is never indexed before the A01
+it follows. The messages can be processed by any worker or, to keep the messages of a sender on the same
+worker, spread on the workers by a hash of the sender.
+"""
+
+from __future__ import absolute_import
+
+import collections
+import threading
+import time
+import zlib
+
+
+class OrderedPipeline(object):
+    """
+    Apply :attr:`function` to items in a :class:`multiprocessing.Pool`, releasing the results of the items of
+    a stream in the order they were submitted. Streams are independent: a slow item only delays the items
+    submitted after it in its own stream.
+
+    The items submitted wait in a reorder buffer, a FIFO per stream, until their result and the results of the
+    items before them are ready. :func:`submit() <OrderedPipeline.submit>` must not be called while the buffer
+    is :func:`full() <OrderedPipeline.full>`. The result of an item not ready after :attr:`task_timeout`
+    seconds, e.g. because its worker died, is computed again in this process.
+
+    :param pool: the :class:`multiprocessing.Pool` running the function
+    :param function: the function applied to the items, which must be picklable
+    :param max_pending: the size of the reorder buffer, i.e. the number of items submitted and not yet released
+    :param task_timeout: the time, in seconds, after which the result of an item is computed in this process
+    """
+    def __init__(self, pool, function, max_pending=100, task_timeout=60):
+        self.pool = pool
+        self.function = function
+        self.max_pending = max_pending
+        self.task_timeout = task_timeout
+        #: number of items whose result was computed again in this process
+        self.timeouts = 0
+        self._streams = collections.OrderedDict()
+        self._pending = 0
+        self._done = threading.Event()
+
+    def __len__(self):
+        return self._pending
+
+    def full(self):
+        return self._pending >= self.max_pending
+
+    def _completed(self, result):
+        # called by the result handler thread of the pool
+        self._done.set()
+
+    def _pool(self, stream):
+        return self.pool
+
+    def submit(self, stream, context, *args):
+        """
+        Apply the function to the arguments in a worker process
+
+        :param stream: the stream of the item, whose order is kept
+        :param context: the data released together with the result, which stays in this process
+        :param args: the arguments of the function
+        """
+        result = self._pool(stream).apply_async(self.function, args, callback=self._completed)
+        pending = self._streams.get(stream)
+        if pending is None:
+            pending = self._streams[stream] = collections.deque()
+        pending.append((context, args, result, time.time()))
+        self._pending += 1
+
+    def _release_ready(self):
+        released = []
+        for stream in list(self._streams):
+            pending = self._streams[stream]
+            while pending:
+                context, args, result, submitted = pending[0]
+                if result.ready():
+                    try:
+                        value = result.get()
+                    except Exception:
+                        value = self.function(*args)
+                elif time.time() - submitted >= self.task_timeout:
+                    self.timeouts += 1
+                    value = self.function(*args)
+                else:
+                    break
+                pending.popleft()
+                self._pending -= 1
+                released.append((context, value))
+            if not pending:
+                del self._streams[stream]
+        return released
+
+    def release(self, timeout=0):
+        """
+        Return the items whose turn has come, waiting up to :attr:`timeout` seconds for one
+
+        :return: a list of tuples with the context of the items and their result, in the order of every stream
+        """
+        deadline = time.time() + timeout
+        while True:
+            self._done.clear()
+            released = self._release_ready()
+            remaining = deadline - time.time()
+            if released or not self._pending or remaining <= 0:
+                return released
+            # the callback isn't called for the items that fail, so the timeouts are checked meanwhile
+            self._done.wait(min(remaining, 0.5))
+
+    def flush(self, timeout):
+        """
+        Return the results of all the items submitted, waiting up to :attr:`timeout` seconds for them
+
+        :return: a list of tuples with the context of the items and their result, without the items still
+            being processed after the timeout
+        """
+        deadline = time.time() + timeout
+        released = []
+        while self._pending and time.time() < deadline:
+            released.extend(self.release(deadline - time.time()))
+        return released
+
+    def close(self):
+        """
+        Stop the worker processes. The items not yet released are lost
+        """
+        self.pool.terminate()
+        self._streams.clear()
+        self._pending = 0
+
+
+class ShardedPipeline(OrderedPipeline):
+    """
+    :class:`OrderedPipeline` where the items of a stream are always processed by the same worker: the streams are
+    spread on :attr:`pools`, each with a single process, by a hash of their key. A worker processes the items of
+    its streams one at a time, so a slow item only delays the streams of its shard, and the total throughput
+    grows with the number of shards as long as the streams are spread evenly.
+
+    :param pools: the :class:`multiprocessing.Pool` of every shard
+    :param function: the function applied to the items, which must be picklable
+    :param max_pending: the size of the reorder buffer, i.e. the number of items submitted and not yet released
+    :param task_timeout: the time, in seconds, after which the result of an item is computed in this process
+    """
+    def __init__(self, pools, function, max_pending=100, task_timeout=60):
+        OrderedPipeline.__init__(self, pools[0], function, max_pending, task_timeout)
+        self.pools = pools
+
+    def _pool(self, stream):
+        return self.pools[(zlib.crc32(repr(stream).encode('utf-8')) & 0xffffffff) % len(self.pools)]
+
+    def close(self):
+        for pool in self.pools[1:]:
+            pool.terminate()
+        OrderedPipeline.close(self)
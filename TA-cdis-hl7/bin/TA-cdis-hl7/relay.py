@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+"""
+Forwarding of the accepted messages to downstream MLLP servers. Every destination has its own queue and
+thread, so a slow or unreachable destination delays neither the others nor the indexing in Splunk: when its
+queue is full, the new messages are dropped for that destination only.
+"""
+
+from __future__ import absolute_import
+
+import collections
+import threading
+import time
+
+from hl7apy.mllp_client import MLLPClient
+
+
+class RelayDestination(object):
+    """
+    A downstream MLLP server receiving a copy of the messages, in the order they are queued, over a persistent
+    connection. A message that can't be delivered is sent again at once on a new connection, as the connection
+    may have been closed by the server after its last answer. After that, and after a negative
+    acknowledgment, it is sent again after a delay that doubles at every attempt, from :attr:`initial_backoff`
+    up to :attr:`max_backoff` seconds. The
+    delivery failures are retried until the destination is back, while a message refused
+    :attr:`max_attempts` times by the destination is dropped.
+
+    Up to :attr:`max_in_flight` messages are written to the connection without waiting for their
+    acknowledgments. When one of them fails, it is sent again together with the messages that follow it,
+    to keep their order, so the destination may receive some messages twice. The servers of
+    :mod:`hl7apy.mllp` close the connection once they have answered: with them, keep :attr:`max_in_flight`
+    to 1, and expect a new connection, and at most one message per round trip, for every message.
+
+    :param host: the address of the destination
+    :param port: the port of the destination
+    :param max_queued: the maximum number of messages waiting for the destination
+    :param max_in_flight: the maximum number of messages sent and waiting for their acknowledgment
+    :param max_attempts: the number of negative acknowledgments after which a message is dropped
+    :param initial_backoff: the delay, in seconds, before the first retry
+    :param max_backoff: the maximum delay, in seconds, between two retries
+    :param timeout: the time, in seconds, to wait for the acknowledgment of a message
+    :param logger: the logger of the delivery errors, or ``None``
+    """
+    def __init__(self, host, port, max_queued=10000, max_attempts=5, initial_backoff=1, max_backoff=60, timeout=30,
+                 logger=None, max_in_flight=1):
+        self.host = host
+        self.port = port
+        self.max_queued = max_queued
+        self.max_in_flight = max_in_flight
+        self.max_attempts = max_attempts
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.logger = logger
+        #: number of messages delivered
+        self.sent = 0
+        #: number of messages dropped because the queue was full
+        self.dropped = 0
+        #: number of messages dropped after :attr:`max_attempts` negative acknowledgments
+        self.rejected = 0
+        #: number of times a message was sent again
+        self.retries = 0
+        # a single connection, so that the messages in flight arrive in order
+        self.client = MLLPClient(timeout=timeout, connect_timeout=timeout, max_in_flight=max_in_flight, pool_size=1)
+        self._queue = collections.deque()
+        self._cond = threading.Condition(threading.Lock())
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='relay-%s:%s' % (host, port))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __str__(self):
+        return '%s:%s' % (self.host, self.port)
+
+    def put(self, message):
+        """
+        Queue a message for the destination, without waiting
+
+        :return: ``False`` if the message was dropped because the queue is full
+        """
+        with self._cond:
+            if len(self._queue) >= self.max_queued:
+                self.dropped += 1
+                return False
+            self._queue.append(message)
+            self._cond.notify()
+            return True
+
+    def pending(self):
+        """
+        Return the number of messages not yet delivered
+        """
+        with self._cond:
+            return len(self._queue)
+
+    def _log(self, text, *args):
+        if self.logger is not None:
+            self.logger.warning(text, *args)
+
+    def _deliver(self, messages):
+        # the acknowledgment codes of the messages, None for the ones that couldn't be delivered
+        futures = []
+        for message in messages:
+            try:
+                futures.append(self.client.send(self.host, self.port, message))
+            except Exception as e:
+                self._log("Unable to relay a message to %s: %s", self, e)
+                break
+        codes = []
+        for future in futures:
+            try:
+                ack = future.result(self.timeout)
+            except Exception as e:
+                if None not in codes:
+                    self._log("Unable to relay a message to %s: %s", self, e)
+                codes.append(None)
+                continue
+            code = ''
+            for segment in ack.split('\r'):
+                if segment[:3] == 'MSA':
+                    code = segment[4:6]
+                    break
+            codes.append(code)
+        return codes + [None] * (len(messages) - len(codes))
+
+    def _run(self):
+        backoff = self.initial_backoff
+        refused = 0
+        failed = False
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                # the messages stay queued until delivered
+                messages = [self._queue[i] for i in range(min(len(self._queue), self.max_in_flight))]
+
+            codes = self._deliver(messages)
+            delivered = 0
+            for code in codes:
+                if code is None or code[1:] != 'A':
+                    break
+                delivered += 1
+            if delivered:
+                self.sent += delivered
+                backoff = self.initial_backoff
+                refused = 0
+                failed = False
+
+            code = codes[delivered] if delivered < len(codes) else None
+            dropped = False
+            if code is not None:
+                refused += 1
+                if refused >= self.max_attempts:
+                    self._log("Message refused %d times by %s with %s, dropped", refused, self, code or 'no ACK')
+                    self.rejected += 1
+                    delivered += 1
+                    dropped = True
+
+            with self._cond:
+                for i in range(delivered):
+                    self._queue.popleft()
+            if dropped:
+                backoff = self.initial_backoff
+                refused = 0
+                failed = False
+            if delivered == len(messages) or dropped:
+                continue
+
+            # the first message not delivered is sent again, followed by the ones after it
+            self.retries += 1
+            if code is None and not failed:
+                failed = True
+                continue
+            with self._cond:
+                self._cond.wait(backoff)
+                if self._closed:
+                    return
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def stats(self):
+        """
+        Return a dictionary with the delivery counters of the destination
+        """
+        return {
+            'pending': self.pending(),
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'rejected': self.rejected,
+            'retries': self.retries,
+        }
+
+    def close(self):
+        """
+        Stop the delivery. The messages not yet delivered are lost
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self.client.close()
+
+
+class Relay(object):
+    """
+    Forwards a copy of every message to a list of :class:`RelayDestination`
+
+    :param destinations: the list of ``(host, port)`` addresses of the destinations
+    :param kwargs: the parameters of the destinations, see :class:`RelayDestination`
+    """
+    def __init__(self, destinations, **kwargs):
+        self.destinations = [RelayDestination(host, port, **kwargs) for host, port in destinations]
+
+    def forward(self, message):
+        """
+        Queue a message for all the destinations, without waiting
+        """
+        for destination in self.destinations:
+            destination.put(message)
+
+    def stats(self):
+        """
+        Return the delivery counters of every destination, by ``host:port``
+        """
+        return dict((str(destination), destination.stats()) for destination in self.destinations)
+
+    def close(self, timeout=0):
+        """
+        Stop the delivery, waiting up to :attr:`timeout` seconds for the queued messages to be delivered
+
+        :return: the number of messages not delivered
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline and any(destination.pending() for destination in self.destinations):
+            time.sleep(0.05)
+        left = sum(destination.pending() for destination in self.destinations)
+        for destination in self.destinations:
+            destination.close()
+        return left
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+
+"""
+Durable spool for the messages received by the MLLP server. A message is appended to the spool before it
+is acknowledged to the sender, and it is removed once it has been written to Splunk, so that a crash of the
+modular input doesn't lose the messages already acknowledged.
+"""
+
+from __future__ import absolute_import
+
+import errno
+import os
+import struct
+import threading
+import time
+import zlib
+
+# length and CRC32 of the record
+_RECORD_HEADER = struct.Struct('>II')
+# offset of an acknowledged record
+_ACK_RECORD = struct.Struct('>Q')
+
+_SEGMENT_SUFFIX = '.seg'
+_ACK_SUFFIX = '.ack'
+
+
+class _Segment(object):
+
+    def __init__(self, number, path):
+        self.number = number
+        self.path = path
+        self.ack_path = path[:-len(_SEGMENT_SUFFIX)] + _ACK_SUFFIX
+        self.written = 0
+        self.acked = 0
+        self.sealed = False
+        self.ack_file = None
+
+    def drained(self):
+        return self.sealed and self.acked >= self.written
+
+
+class MessageSpool(object):
+    """
+    Append-only spool made of segment files. Every record is checksummed, so a record partially written
+    during a crash is discarded when the spool is opened again.
+
+    :func:`append() <MessageSpool.append>` returns when the record is on disk. The appends of concurrent
+    threads are made durable with a single ``fsync`` (group commit): the first thread waiting for its
+    record syncs the records written so far by everybody, optionally waiting :attr:`commit_delay` seconds
+    to collect more of them.
+
+    Records are acknowledged with :func:`ack() <MessageSpool.ack>` once they have been processed.
+    Acknowledgments are recorded in a file next to the segment, and the files of a segment are removed when
+    all its records have been acknowledged and the spool has moved on to a new segment.
+
+    The records not acknowledged before the spool was closed are available in :attr:`recovered`, as a list of
+    ``(entry_id, data)`` tuples in the order they were appended.
+
+    :param directory: the directory of the segment files, created if needed
+    :param segment_size: the size, in bytes, after which a new segment is started
+    :param commit_delay: the time, in seconds, to wait for other appends before syncing the records to disk
+    """
+    def __init__(self, directory, segment_size=64 * 1024 * 1024, commit_delay=0.0):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.commit_delay = commit_delay
+
+        self.appended = 0
+        self.commits = 0
+        self.reclaimed = 0
+
+        self._lock = threading.Lock()
+        self._commit_cond = threading.Condition(threading.Lock())
+        self._syncing = False
+        self._written_seq = 0
+        self._synced_seq = 0
+        self._retired_fds = []
+        self._segments = {}
+
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        self.recovered = self._recover()
+        last = max(self._segments) if self._segments else 0
+        self._open_segment(last + 1)
+
+    def _segment_path(self, number):
+        return os.path.join(self.directory, '%020d%s' % (number, _SEGMENT_SUFFIX))
+
+    def _recover(self):
+        recovered = []
+        numbers = sorted(int(name[:-len(_SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                         if name.endswith(_SEGMENT_SUFFIX))
+        for number in numbers:
+            segment = _Segment(number, self._segment_path(number))
+            segment.sealed = True
+            acked = self._read_acks(segment)
+            for offset, data in self._read_records(segment):
+                segment.written += 1
+                if offset in acked:
+                    segment.acked += 1
+                else:
+                    recovered.append(((number, offset), data))
+            self._segments[number] = segment
+            if segment.drained():
+                self._reclaim(segment)
+        return recovered
+
+    @staticmethod
+    def _read_acks(segment):
+        acked = set()
+        try:
+            with open(segment.ack_path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return acked
+        for pos in range(0, len(data) - _ACK_RECORD.size + 1, _ACK_RECORD.size):
+            acked.add(_ACK_RECORD.unpack_from(data, pos)[0])
+        return acked
+
+    @staticmethod
+    def _read_records(segment):
+        with open(segment.path, 'rb') as f:
+            data = f.read()
+        offset = 0
+        while offset + _RECORD_HEADER.size <= len(data):
+            length, crc = _RECORD_HEADER.unpack_from(data, offset)
+            start = offset + _RECORD_HEADER.size
+            payload = data[start:start + length]
+            if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                # the tail of the segment was not completely written
+                break
+            yield offset, payload
+            offset = start + length
+
+    def _open_segment(self, number):
+        segment = _Segment(number, self._segment_path(number))
+        self._fd = os.open(segment.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        self._segments[number] = segment
+        self._current = segment
+        self._size = 0
+
+    def _rotate(self):
+        # the old descriptor is synced and closed by the next commit
+        self._retired_fds.append(self._fd)
+        old = self._current
+        old.sealed = True
+        self._open_segment(old.number + 1)
+        if old.drained():
+            self._reclaim(old)
+
+    def append(self, data):
+        """
+        Append a record to the spool and return when it is on disk
+
+        :param data: the bytes to store
+        :return: the id of the entry, to pass to :func:`ack() <MessageSpool.ack>`
+        """
+        record = _RECORD_HEADER.pack(len(data), zlib.crc32(data) & 0xffffffff) + data
+        with self._lock:
+            if self._size >= self.segment_size:
+                self._rotate()
+            segment = self._current
+            offset = self._size
+            written = 0
+            while written < len(record):
+                written += os.write(self._fd, record[written:])
+            self._size += len(record)
+            segment.written += 1
+            self._written_seq += 1
+            seq = self._written_seq
+            self.appended += 1
+        self._commit(seq)
+        return segment.number, offset
+
+    def _commit(self, seq):
+        with self._commit_cond:
+            while self._synced_seq < seq:
+                if self._syncing:
+                    self._commit_cond.wait()
+                    continue
+                self._syncing = True
+                self._commit_cond.release()
+                target = None
+                try:
+                    if self.commit_delay:
+                        time.sleep(self.commit_delay)
+                    with self._lock:
+                        target = self._written_seq
+                        fd = self._fd
+                        retired, self._retired_fds = self._retired_fds, []
+                    for old_fd in retired:
+                        os.fsync(old_fd)
+                        os.close(old_fd)
+                    os.fsync(fd)
+                finally:
+                    self._commit_cond.acquire()
+                    self._syncing = False
+                    self._commit_cond.notify_all()
+                self._synced_seq = max(self._synced_seq, target)
+                self.commits += 1
+
+    def ack(self, entry_id):
+        """
+        Mark an entry as processed. The segment files are removed once all their entries are processed
+
+        :param entry_id: the id returned by :func:`append() <MessageSpool.append>` or found in
+            :attr:`recovered`
+        """
+        number, offset = entry_id
+        with self._lock:
+            segment = self._segments.get(number)
+            if segment is None:
+                return
+            if segment.ack_file is None:
+                segment.ack_file = open(segment.ack_path, 'ab')
+            segment.ack_file.write(_ACK_RECORD.pack(offset))
+            segment.ack_file.flush()
+            segment.acked += 1
+            if segment.drained():
+                self._reclaim(segment)
+
+    def _reclaim(self, segment):
+        if segment.ack_file is not None:
+            segment.ack_file.close()
+            segment.ack_file = None
+        for path in (segment.path, segment.ack_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        del self._segments[segment.number]
+        self.reclaimed += 1
+
+    def pending(self):
+        """
+        Return the number of entries not acknowledged yet
+        """
+        with self._lock:
+            return sum(s.written - s.acked for s in self._segments.values())
+
+    def close(self):
+        """
+        Sync the pending records and close the files. Closing a closed spool does nothing
+        """
+        with self._lock:
+            if self._fd is None:
+                return
+            for fd in self._retired_fds:
+                os.fsync(fd)
+                os.close(fd)
+            self._retired_fds = []
+            os.fsync(self._fd)
+            os.close(self._fd)
+            self._fd = None
+            for segment in self._segments.values():
+                if segment.ack_file is not None:
+                    segment.ack_file.close()
+                    segment.ack_file = None
@@ -0,0 +1,237 @@
+"""
+MLLP load generator. Replays the sample messages over concurrent connections to an MLLP server and
+reports the throughput and the ACK latency percentiles.
+
+    python hl7_loadgen.py --local                            # against a local test server on port 2575
+    python hl7_loadgen.py -c 8 -n 50000 hl7-host 2575        # max throughput, 8 connections
+    python hl7_loadgen.py -c 4 --rate 500 -d 60 hl7-host 2575
+
+Splunk is not needed: with --local the messages are acknowledged by an hl7apy MLLP server started in
+a separate process.
+"""
+
+import os
+import sys
+import glob
+import math
+import re
+import threading
+import time
+import argparse
+import multiprocessing
+
+APP_NAME = "TA-cdis-hl7"
+
+path_to_python_packages = os.path.join(os.path.dirname(os.path.abspath(__file__)), APP_NAME)
+sys.path.insert(0, path_to_python_packages)
+
+from hl7apy.mllp import AbstractHandler, MSHHeader, build_ack
+from hl7apy.mllp_client import MLLPClient
+
+DEFAULT_SAMPLES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'samples')
+
+SEGMENT = re.compile(r'^[A-Z][A-Z0-9]{2}\|')
+
+
+def load_samples(directory):
+    """
+    Load the *.msg files of a directory as ER7 messages. The files use newlines as segment separators
+    and may end with lines that aren't segments, which are dropped.
+    """
+    messages = []
+    for path in sorted(glob.glob(os.path.join(directory, '*.msg'))):
+        with open(path, 'rb') as f:
+            lines = f.read().decode('utf-8', 'replace').replace('\r\n', '\n').replace('\r', '\n').split('\n')
+        segments = [line for line in lines if SEGMENT.match(line)]
+        if segments and segments[0].startswith('MSH'):
+            messages.append('\r'.join(segments) + '\r')
+    return messages
+
+
+def set_control_id(message, control_id):
+    """
+    Replace the MSH-10 of an ER7 message
+    """
+    end = message.index('\r')
+    fields = message[:end].split(message[3])
+    while len(fields) < 10:
+        fields.append('')
+    fields[9] = control_id
+    return message[3].join(fields) + message[end:]
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile of a sorted list
+    """
+    if not values:
+        return 0.0
+    rank = max(int(math.ceil(p / 100.0 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.acked = 0
+        self.nak = 0
+        self.mismatched = 0
+        self.errors = 0
+        self.latencies = []
+
+    def record(self, future, control_id, started):
+        latency = time.time() - started
+        exc = future.exception()
+        with self.lock:
+            if exc is not None:
+                self.errors += 1
+                return
+            self.latencies.append(latency)
+            msa = [s for s in future.result().split('\r') if s.startswith('MSA')]
+            fields = msa[0].split(msa[0][3]) if msa else []
+            if len(fields) < 3 or fields[1] not in ('AA', 'CA'):
+                self.nak += 1
+            elif fields[2] != control_id:
+                self.mismatched += 1
+            else:
+                self.acked += 1
+
+
+class Sender(threading.Thread):
+    """
+    Sends messages on a single connection, keeping up to `in_flight` of them waiting for the ACK.
+    With a rate, every message is scheduled at a fixed interval and its latency is measured from the
+    scheduled time, so that a slow server can't hide its delays by slowing down the sender.
+    """
+    def __init__(self, index, args, messages, stats, deadline, quota):
+        threading.Thread.__init__(self, name='sender-%d' % index)
+        self.daemon = True
+        self.index = index
+        self.args = args
+        self.messages = messages
+        self.stats = stats
+        self.deadline = deadline
+        self.quota = quota
+        self.client = MLLPClient(timeout=args.timeout, max_in_flight=args.in_flight, pool_size=1)
+
+    def run(self):
+        interval = float(self.args.connections) / self.args.rate if self.args.rate else 0
+        start = time.time()
+        prefix = '%s%02d' % (self.args.run_id, self.index)
+        pending = []
+        seq = 0
+        while seq < self.quota and time.time() < self.deadline:
+            scheduled = start + seq * interval if interval else time.time()
+            wait = scheduled - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            control_id = '%s%07d' % (prefix, seq)
+            message = set_control_id(self.messages[(seq * self.args.connections + self.index) % len(self.messages)],
+                                     control_id)
+            seq += 1
+            try:
+                future = self.client.send(self.args.host, self.args.port, message)
+            except Exception:
+                with self.stats.lock:
+                    self.stats.errors += 1
+                continue
+            with self.stats.lock:
+                self.stats.sent += 1
+            future.add_done_callback(lambda f, c=control_id, s=scheduled: self.stats.record(f, c, s))
+            pending.append(future)
+        for future in pending:
+            future.exception(self.args.timeout + 1)
+        self.client.close()
+
+
+class AckHandler(AbstractHandler):
+
+    def reply(self):
+        return build_ack(MSHHeader(self.incoming_message), 'AA')
+
+
+def serve_local(port, status):
+    """
+    Serve on the port, sending on the :attr:`status` connection ``None`` once listening, or the error that
+    prevented binding the port
+    """
+    from mllp2 import MLLPServer
+
+    try:
+        server = MLLPServer('127.0.0.1', port, {'*': (AckHandler,)}, idle_timeout=60)
+    except Exception as e:
+        status.send(str(e))
+        return
+    server.daemon_threads = True
+    status.send(None)
+    server.serve_forever()
+
+
+def report(stats, elapsed):
+    latencies = sorted(stats.latencies)
+    print('sent        %d' % stats.sent)
+    print('acked       %d' % stats.acked)
+    print('nak         %d' % stats.nak)
+    print('mismatched  %d' % stats.mismatched)
+    print('errors      %d' % stats.errors)
+    print('elapsed     %.2f s' % elapsed)
+    print('throughput  %.1f msg/s' % (len(latencies) / elapsed if elapsed else 0))
+    for label, p in (('p50', 50), ('p95', 95), ('p99', 99), ('max', 100)):
+        print('%-11s %.2f ms' % (label, percentile(latencies, p) * 1000))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay HL7 messages to an MLLP server and measure the ACK latency')
+    parser.add_argument('host', nargs='?', default='127.0.0.1')
+    parser.add_argument('port', type=int, nargs='?', default=2575)
+    parser.add_argument('-c', '--connections', type=int, default=1, help='number of concurrent connections')
+    parser.add_argument('-i', '--in-flight', type=int, default=1, help='messages waiting for the ACK per connection')
+    parser.add_argument('-n', '--messages', type=int, default=1000, help='total number of messages to send, ignored with --duration')
+    parser.add_argument('-d', '--duration', type=float, default=None, help='stop after this many seconds')
+    parser.add_argument('-r', '--rate', type=float, default=0, help='messages per second, 0 for max throughput')
+    parser.add_argument('-t', '--timeout', type=float, default=10, help='ACK timeout in seconds')
+    parser.add_argument('-s', '--samples', default=DEFAULT_SAMPLES, help='directory of the *.msg files to replay')
+    parser.add_argument('--run-id', default=time.strftime('%H%M%S'), help='prefix of the generated control ids')
+    parser.add_argument('--local', action='store_true', help='start a local MLLP server on the port')
+    args = parser.parse_args(argv)
+
+    messages = load_samples(args.samples)
+    if not messages:
+        parser.error('no messages found in %s' % args.samples)
+
+    server = None
+    if args.local:
+        status, child_status = multiprocessing.Pipe(False)
+        server = multiprocessing.Process(target=serve_local, args=(args.port, child_status))
+        server.daemon = True
+        server.start()
+        # the server is listening once the constructor returns
+        error = status.recv() if status.poll(10) else 'not listening after 10 seconds'
+        if error is not None:
+            server.terminate()
+            parser.error('unable to start the local server on port %d: %s' % (args.port, error))
+
+    stats = Stats()
+    deadline = time.time() + args.duration if args.duration else float('inf')
+    quotas = [args.messages // args.connections + (1 if i < args.messages % args.connections else 0)
+              for i in range(args.connections)]
+    if args.duration:
+        quotas = [float('inf')] * args.connections
+    senders = [Sender(i, args, messages, stats, deadline, quotas[i]) for i in range(args.connections)]
+    start = time.time()
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        while sender.is_alive():
+            sender.join(0.5)
+    report(stats, time.time() - start)
+
+    if server is not None:
+        server.terminate()
+    return 0 if stats.errors == stats.nak == stats.mismatched == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,9 @@
 import os
 import sys
+import hashlib
+import signal
 import threading
-from Queue import Queue
+import multiprocessing
 
 APP_NAME="TA-cdis-hl7"
 
@@ -11,17 +13,30 @@ sys.path.insert(0, path_to_python_packages)
 path_to_mod_input_lib = os.path.join(os.path.dirname(os.path.abspath(__file__)), APP_NAME,  'modular_input.zip')
 sys.path.insert(0, path_to_mod_input_lib)
 
-from modular_input import Field, BooleanField, ListField, IntegerField
+from modular_input import Field, BooleanField, ListField, IntegerField, FieldValidationException
 
-from hl7apy.core import Message
-from hl7apy.mllp import MLLPServer
+from hl7apy.mllp import MLLPServer, PooledMLLPServer, WorkerSupervisor, FrameLimits, create_tls_context
 #from mllp2 import MLLPServer
 
-from hl7apy.mllp import AbstractErrorHandler
+from hl7apy.mllp import AbstractHandler, AbstractErrorHandler, MSHHeader, build_ack, ack_required, current_peer
+from hl7apy.mllp import UnsupportedMessageType, InvalidHL7Message
+from hl7apy.mllp_client import MLLPClient
 from hl7apy.parser import parse_message
+from hl7apy.batch import BatchReader, InvalidBatch, build_batch_ack
+
+from spool import MessageSpool
+from backpressure import FairQueue, TokenBucket
+from dedupe import BloomFilter, DuplicateFilter
+from pipeline import OrderedPipeline, ShardedPipeline
+from relay import Relay
+import mllp2
 
 import time
 import calendar
+try:
+    from Queue import Queue, Full
+except ImportError:
+    from queue import Queue, Full
 
 
 
@@ -37,7 +52,12 @@ class ModularInput(modular_input.ModularInput):
                                           unbroken, close,
                                           encapsulate_value_in_double_quotes=encapsulate_value_in_double_quotes)
         self.logger.debug("the xml file looks like \n %s", output)
+        self.write_event(output, out)
 
+    def write_event(self, output, out=sys.stdout):
+        """
+        Write an event built by create_event_string
+        """
         with self.lock:
             out.write(output)
             out.flush()
@@ -129,7 +149,8 @@ class SocketPortField(Field):
 
         Field.to_python(self, value, session_key)
 
-        if value is not None:
+        # the port is empty when the input listens on unix_socket
+        if value is not None and str(value).strip():
             try:
                 port=int(value)
                 import socket
@@ -173,11 +194,46 @@ class MyInput(ModularInput):
 
         args = [
             Field("title", "Title", "A short description of the input", empty_allowed=False),
-            SocketPortField("port", "Port", "The Port to listen at", empty_allowed=False),
+            SocketPortField("port", "Port", "The Port to listen at, not needed with unix_socket", empty_allowed=True, none_allowed=True),
+            Field("unix_socket", "Unix socket", "Path of a Unix domain socket to listen at instead of the port, for senders on the same host", empty_allowed=True, required_on_create=False),
             BooleanField("output_kvp", "Output key value pair", "Output key value pair instead", empty_allowed=True),
             BooleanField("remove_phi", "Remove PHI", "Whether to remove common PHI segments", empty_allowed=True),
             ListField("fields_to_remove", "Fields to remove", "Extra segments or fields to remove", empty_allowed=True, required_on_create=False),
-            IntegerField("max_long_segment","Max bytes for segments", "segment longer than this number of bytes will be removed", empty_allowed=True, none_allowed=True)
+            IntegerField("max_long_segment","Max bytes for segments", "segment longer than this number of bytes will be removed", empty_allowed=True, none_allowed=True),
+            IntegerField("max_connections", "Max connections", "Number of connections served at the same time, unlimited if empty", empty_allowed=True, none_allowed=True),
+            IntegerField("max_queued_connections", "Max queued connections", "Connections waiting for a free slot when max_connections is reached, 0 to refuse them", empty_allowed=True, none_allowed=True),
+            BooleanField("persistent_connections", "Persistent connections", "Keep the connections open after every ACK, for senders pipelining their messages on one connection", empty_allowed=True),
+            IntegerField("idle_timeout", "Idle timeout", "Seconds after which an idle persistent connection is closed, 10 if empty", empty_allowed=True, none_allowed=True),
+            IntegerField("listener_processes", "Listener processes", "Number of processes sharing the port with SO_REUSEPORT, 1 if empty", empty_allowed=True, none_allowed=True),
+            BooleanField("durable_spool", "Durable spool", "Store the messages on disk before acknowledging them", empty_allowed=True),
+            Field("tls_certfile", "TLS certificate", "PEM file with the server certificate, enables MLLP over TLS", empty_allowed=True, required_on_create=False),
+            Field("tls_keyfile", "TLS private key", "PEM file with the private key, if not in the certificate file", empty_allowed=True, required_on_create=False),
+            Field("tls_cafile", "TLS CA certificates", "PEM file with the CAs used to verify the client certificates", empty_allowed=True, required_on_create=False),
+            BooleanField("tls_require_client_cert", "Require client certificate", "Refuse senders without a valid client certificate", empty_allowed=True),
+            Field("batch_directory", "Batch directory", "Directory polled for HL7 batch files, which are moved to its processed or failed subdirectory once read", empty_allowed=True, required_on_create=False),
+            IntegerField("queue_high_messages", "Queue high watermark", "Messages waiting for Splunk above which new messages are throttled", empty_allowed=True, none_allowed=True),
+            IntegerField("queue_low_messages", "Queue low watermark", "Messages waiting for Splunk below which throttling stops", empty_allowed=True, none_allowed=True),
+            IntegerField("queue_high_bytes", "Queue high watermark (bytes)", "Size of the messages waiting for Splunk above which new messages are throttled", empty_allowed=True, none_allowed=True),
+            IntegerField("queue_low_bytes", "Queue low watermark (bytes)", "Size of the messages waiting for Splunk below which throttling stops", empty_allowed=True, none_allowed=True),
+            Field("backpressure", "Backpressure", "hold, AE or AR: hold the ACK or send a negative ACK when throttled", empty_allowed=True, required_on_create=False),
+            IntegerField("max_message_size", "Max message size", "Messages larger than this many bytes are refused according to oversize_policy", empty_allowed=True, none_allowed=True),
+            IntegerField("spill_message_size", "Spill message size", "Messages larger than this many bytes are written to a temporary file while received and are indexed without parsing", empty_allowed=True, none_allowed=True),
+            Field("oversize_policy", "Oversize policy", "close, AE or AR: close the connection or send a negative ACK when a message exceeds max_message_size", empty_allowed=True, required_on_create=False),
+            IntegerField("dedupe_cache_size", "Duplicate cache size", "Number of recent messages whose ACK is replayed when a sender retransmits them, empty to disable duplicate suppression", empty_allowed=True, none_allowed=True),
+            BooleanField("dedupe_persistent", "Persistent duplicate filter", "Also remember older messages, and messages received before a restart, in a probabilistic filter on disk", empty_allowed=True),
+            IntegerField("dedupe_filter_size", "Duplicate filter size", "Number of messages remembered by the persistent duplicate filter", empty_allowed=True, none_allowed=True),
+            Field("dedupe_filter_error_rate", "Duplicate filter error rate", "Probability of the persistent duplicate filter mistaking a new message for a duplicate, which is then not indexed, 0.0000001 if empty", empty_allowed=True, required_on_create=False),
+            IntegerField("drain_timeout", "Drain timeout", "Seconds allowed, when the input is stopped, to acknowledge the messages being received and write the queued ones to Splunk", empty_allowed=True, none_allowed=True),
+            Field("fair_queue_by", "Fair queueing key", "facility or peer: give every sending facility (MSH-4) or peer address its own queue, served in round robin", empty_allowed=True, required_on_create=False),
+            Field("sender_weights", "Sender weights", "Messages taken from a sender at every round, e.g. LAB=4,*=1", empty_allowed=True, required_on_create=False),
+            Field("sender_rate_limits", "Sender rate limits", "Maximum messages per second accepted from a sender, e.g. ADT=50,*=200", empty_allowed=True, required_on_create=False),
+            IntegerField("parse_workers", "Parse workers", "Number of processes validating the messages in parallel, keeping the order of every connection; validated by the output loop if empty", empty_allowed=True, none_allowed=True),
+            IntegerField("parse_buffer_size", "Parse buffer size", "Messages being parsed or waiting for the messages received before them", empty_allowed=True, none_allowed=True),
+            Field("parse_sharding", "Parse sharding", "sender or peer: always parse the messages of a sender (MSH-3 and MSH-4) or of a peer address with the same worker", empty_allowed=True, required_on_create=False),
+            Field("application_ack_destinations", "Application ACK destinations", "Where the application ACKs requested with MSH-16 are sent, by sending facility, e.g. LAB=lab-engine:2576,*=engine:2576", empty_allowed=True, required_on_create=False),
+            Field("relay_destinations", "Relay destinations", "MLLP servers receiving a copy of every accepted message, e.g. engine1:2575,engine2:2575", empty_allowed=True, required_on_create=False),
+            IntegerField("relay_queue_size", "Relay queue size", "Messages waiting for a relay destination above which new messages are not relayed to it", empty_allowed=True, none_allowed=True),
+            IntegerField("relay_max_in_flight", "Relay messages in flight", "Messages sent to a relay destination without waiting for their ACKs, 1 if empty. Keep 1 for destinations closing the connection after every ACK", empty_allowed=True, none_allowed=True)
         ]
 
         # the mllp server
@@ -186,9 +242,65 @@ class MyInput(ModularInput):
         #    server will be recreated every interval?
         self.mllp = None
 
+        # write-ahead spool of the messages acknowledged but not yet sent to splunk, see open_spool
+        self.spool = None
+
+        # the messages already accepted, to suppress retransmissions, see open_dedupe
+        self.dedupe = None
+
+        # shared by the listener processes, so that they can resume each other's TLS sessions
+        self.ssl_context = None
+
         self.sleep_interval = 5
 
-        self._queue = Queue()
+        # messages acknowledged and waiting for the output loop, one FIFO per sender, see configure_queue
+        self._queue = FairQueue(listener=self.queue_throttled)
+
+        # how the senders are told apart: "facility" (MSH-4), "peer" (address of the connection), or None
+        # to queue all the messages together
+        self.fair_queue_by = None
+
+        # token buckets limiting the rate of the messages accepted from every sender, see rate_limit
+        self.rate_limits = {}
+        self._buckets = {}
+        self._buckets_lock = threading.Lock()
+
+        # what to do with new messages while the queue is throttled: "hold" delays the ACK, up to
+        # backpressure_hold_timeout seconds, "AE" and "AR" refuse the message with that ACK code
+        self.backpressure = "hold"
+        self.backpressure_hold_timeout = 30
+
+        # messages read from a batch file wait while the queue is longer than this, so that a large
+        # batch isn't loaded in memory
+        self.batch_queue_limit = 1000
+        # the number of messages read from a batch file is saved every this many messages, so that a file
+        # interrupted by a crash is resumed with at most as many duplicates
+        self.batch_checkpoint_interval = 100
+
+        # messages larger than this are indexed as received, without building their parse tree
+        self.parse_size_limit = None
+
+        # the application ACKs of the enhanced acknowledgment mode, sent to the address configured for the
+        # sending facility by a background thread, see send_application_ack
+        self.ack_destinations = {}
+        self.ack_client = None
+        self.enhanced_mode_refused = False
+        self._application_acks = Queue(10000)
+
+        # forwards the accepted messages to the relay destinations, see configure_relay
+        self.relay = None
+
+        # the pool of processes parsing the messages in parallel, if configured, see start_parse_pool
+        self.pipeline = None
+        self.parse_sharding = None
+
+        # set on SIGTERM: the output loop stops the server and writes the queued messages within
+        # drain_timeout seconds, see drain
+        self.stop_requested = False
+        self.drain_timeout = 10
+        self.batch_thread = None
+        self.batch_file = None
+        self.supervisor = None
 
         ModularInput.__init__(self, scheme_args, args, logger_name='hl7_modular_input')
 
@@ -203,9 +315,728 @@ class MyInput(ModularInput):
             self.mllp=None
             self.logger.info("Some error occured: %s", e)
 
-    def en_queue(self, data):
-        self._queue.put(data)
+    def install_stop_handler(self):
+        # Splunk stops the input with SIGTERM, e.g. every time its configuration changes
+        try:
+            signal.signal(signal.SIGTERM, self.request_stop)
+        except ValueError:
+            # signal handlers can only be set in the main thread
+            pass
+
+    def request_stop(self, signum=None, frame=None):
+        self.stop_requested = True
+        if self.supervisor is not None:
+            # the listener processes get SIGTERM and drain like a single listener, run_listener_processes
+            # waits for them: a signal handler must not block
+            self.supervisor.terminate()
 
+    def drain(self, write):
+        """
+        Stop the MLLP server letting the messages being received get their ACKs, and write the queued messages
+        to Splunk, within drain_timeout seconds. The messages left in the queue are still in the spool, if
+        enabled, and are replayed at the next start
+
+        :param write: the callable writing a queued message to Splunk
+        """
+        deadline = time.time() + self.drain_timeout
+        connections = {}
+        server = None
+        if self.mllp is not None:
+            # the server drains in its own thread, as the ACKs sent meanwhile may wait for room in the queue
+            server = threading.Thread(target=lambda: connections.update(self.mllp.drain(self.drain_timeout)))
+            server.daemon = True
+            server.start()
+
+        written = 0
+        left = 0
+        if self.pipeline is not None:
+            # the messages being parsed come before the ones left in the queue
+            for item, result in self.pipeline.flush(deadline - time.time()):
+                write(item, result)
+                written += 1
+            left = len(self.pipeline)
+            self.pipeline.close()
+
+        while time.time() < deadline:
+            try:
+                item = self._queue.get(0.1)
+            except IndexError:
+                if (server is None or not server.is_alive()) and self.batch_file is None:
+                    break
+                continue
+            write(item)
+            written += 1
+
+        self.logger.info("MLLP listener drained, connections drained=%d abandoned=%d, messages written=%d left=%d",
+                         connections.get("drained", 0), connections.get("abandoned", 0), written,
+                         self._queue.qsize() + left)
+        if self.batch_file is not None:
+            self.logger.warning("Batch file %s not completed, it will be resumed at the next start",
+                                self.batch_file)
+        if self.relay is not None:
+            left_relayed = self.relay.close(max(deadline - time.time(), 0))
+            self.logger.info("Relay stopped, messages not relayed=%d, destinations: %s", left_relayed,
+                             self.relay.stats())
+        if self.ack_client is not None:
+            while self._application_acks.unfinished_tasks and time.time() < deadline:
+                time.sleep(0.05)
+            if self._application_acks.unfinished_tasks:
+                self.logger.warning("%d application ACKs not sent", self._application_acks.unfinished_tasks)
+            self.ack_client.close()
+        if self.dedupe is not None:
+            self.logger.info("Duplicate messages per sender: %s", self.dedupe.stats())
+            self.dedupe.close()
+        if self._buckets:
+            self.logger.info("Rate limited messages per sender: %s",
+                             dict((sender, bucket.limited) for sender, bucket in self._buckets.items()))
+
+    def en_queue(self, data, sender=None):
+        self._queue.put(data, len(data[0]), sender)
+
+    def parse_sender_map(self, value, name, convert=None):
+        """
+        Parse a comma separated list of sender=value pairs, where the sender * applies to the senders not listed
+
+        :param convert: the function converting the values, raising ValueError if invalid. Positive numbers
+            are expected by default
+        """
+        result = {}
+        for entry in (value or "").split(","):
+            if not entry.strip():
+                continue
+            sender, _, setting = entry.partition("=")
+            try:
+                setting = (convert or positive_number)(setting.strip())
+            except ValueError:
+                setting = None
+            if not sender.strip() or setting is None:
+                self.logger.warning("Invalid %s entry %s, ignored", name, entry.strip())
+                continue
+            result[sender.strip()] = setting
+        return result
+
+    def configure_queue(self, cleaned_params):
+        self._queue.set_watermarks(high_messages=cleaned_params.get("queue_high_messages", None),
+                                   low_messages=cleaned_params.get("queue_low_messages", None),
+                                   high_bytes=cleaned_params.get("queue_high_bytes", None),
+                                   low_bytes=cleaned_params.get("queue_low_bytes", None))
+        backpressure = (cleaned_params.get("backpressure", None) or "hold").strip()
+        if backpressure.upper() in ("AE", "AR"):
+            backpressure = backpressure.upper()
+        elif backpressure != "hold":
+            self.logger.warning("Unknown backpressure policy %s, using hold", backpressure)
+            backpressure = "hold"
+        self.backpressure = backpressure
+
+        fair_queue_by = (cleaned_params.get("fair_queue_by", None) or "").strip().lower() or None
+        if fair_queue_by not in (None, "facility", "peer"):
+            self.logger.warning("Unknown fair_queue_by %s, using facility", fair_queue_by)
+            fair_queue_by = "facility"
+        self.fair_queue_by = fair_queue_by
+        weights = self.parse_sender_map(cleaned_params.get("sender_weights", None), "sender_weights")
+        self._queue.default_weight = int(weights.pop("*", 1))
+        self._queue.weights = dict((sender, int(weight)) for sender, weight in weights.items())
+        self.rate_limits = self.parse_sender_map(cleaned_params.get("sender_rate_limits", None),
+                                                 "sender_rate_limits")
+        with self._buckets_lock:
+            self._buckets = {}
+
+    def configure_application_acks(self, cleaned_params):
+        self.ack_destinations = self.parse_sender_map(cleaned_params.get("application_ack_destinations", None),
+                                                      "application_ack_destinations", mllp_address)
+        if self.ack_destinations and self.ack_client is None:
+            # the destinations don't have to answer the application ACKs, see deliver_application_acks
+            self.ack_client = MLLPClient(expect_responses=False)
+            ack_thread = threading.Thread(target=self.deliver_application_acks)
+            ack_thread.daemon = True
+            ack_thread.start()
+
+    def configure_relay(self, cleaned_params):
+        if self.relay is not None:
+            return
+        destinations = []
+        for entry in (cleaned_params.get("relay_destinations", None) or "").split(","):
+            if not entry.strip():
+                continue
+            try:
+                destinations.append(mllp_address(entry.strip()))
+            except ValueError:
+                self.logger.warning("Invalid relay_destinations entry %s, ignored", entry.strip())
+        if destinations:
+            self.relay = Relay(destinations, max_queued=cleaned_params.get("relay_queue_size", None) or 10000,
+                               max_in_flight=max(cleaned_params.get("relay_max_in_flight", None) or 1, 1),
+                               logger=self.logger)
+            self.logger.info("Relaying the messages to %s", ", ".join("%s:%s" % d for d in destinations))
+
+    def send_application_ack(self, header, code, text=None):
+        """
+        Queue the application ACK of a message written to Splunk, if the sender asked for it in MSH-16
+        """
+        if not ack_required(header.application_ack_type, code):
+            return
+        address = self.ack_destinations.get(header.sending_facility, self.ack_destinations.get("*"))
+        if address is None:
+            self.logger.debug("No application_ack_destinations for sending_facility=%s, ACK of message %s not sent",
+                              header.sending_facility, header.control_id)
+            return
+        try:
+            self._application_acks.put_nowait((address, header.control_id, build_ack(header, code, text=text,
+                                                                                     mllp=False)))
+        except Full:
+            self.logger.warning("Too many application ACKs waiting, ACK of message %s not sent", header.control_id)
+
+    def deliver_application_acks(self):
+        # the ACKs are written without waiting for an answer, as their MSH-15 and MSH-16 are empty: an ACK is
+        # only lost if the connection was closed by the destination without our noticing
+        while True:
+            address, control_id, ack = self._application_acks.get()
+            try:
+                self.ack_client.send(address[0], address[1], ack,
+                                     callback=lambda future, control_id=control_id, address=address:
+                                     self.application_ack_sent(future, control_id, address))
+            except Exception as e:
+                self.logger.warning("Unable to send the application ACK of message %s to %s:%s: %s", control_id,
+                                    address[0], address[1], e)
+                self._application_acks.task_done()
+
+    def application_ack_sent(self, future, control_id, address):
+        exception = future.exception()
+        if exception is not None:
+            self.logger.warning("Unable to send the application ACK of message %s to %s:%s: %s", control_id,
+                                address[0], address[1], exception)
+        # the ACK is done once written, see drain
+        self._application_acks.task_done()
+
+    def enhanced_mode(self, header):
+        """
+        Return whether a message is acknowledged in the enhanced acknowledgment mode it requested. A commit ACK
+        tells the sender that the message is safely stored, so it needs durable_spool: without it, the messages
+        are acknowledged in the original mode and a configuration error is logged once
+
+        :param header: the MSH header of the message
+        """
+        if not header.enhanced_mode:
+            return False
+        if self.spool is None:
+            if not self.enhanced_mode_refused:
+                self.enhanced_mode_refused = True
+                self.logger.error("Message control_id=%s from sending_facility=%s requests the enhanced "
+                                  "acknowledgment mode, which needs durable_spool: messages are acknowledged in "
+                                  "the original mode", header.control_id, header.sending_facility)
+            return False
+        return True
+
+    def sender_of(self, header):
+        """
+        Return the sender of a message, according to fair_queue_by: the sending facility, the address of the peer
+        or, if messages aren't queued per sender, the sending facility when rate limits are set and ``None``
+        otherwise
+
+        :param header: the MSH header of the message, or ``None``
+        """
+        if self.fair_queue_by == "peer":
+            return peer_host()
+        if header is not None and (self.fair_queue_by == "facility" or self.rate_limits):
+            return header.sending_facility
+        return None
+
+    def rate_limit(self, sender):
+        """
+        Return the token bucket of a sender, or ``None`` if its rate isn't limited
+        """
+        rate = self.rate_limits.get(sender, self.rate_limits.get("*"))
+        if rate is None:
+            return None
+        with self._buckets_lock:
+            bucket = self._buckets.get(sender)
+            if bucket is None:
+                bucket = self._buckets[sender] = TokenBucket(rate)
+            return bucket
+
+    def queue_throttled(self, queue):
+        stats = queue.stats()
+        if queue.throttled:
+            self.logger.warning("Output queue throttled, policy=%s messages=%d bytes=%d throttle_events=%d held=%d rejected=%d",
+                                self.backpressure, stats["messages"], stats["bytes"], stats["throttle_events"],
+                                stats["held"], stats["rejected"])
+        else:
+            self.logger.info("Output queue released, messages=%d bytes=%d throttled_seconds=%s held=%d rejected=%d",
+                             stats["messages"], stats["bytes"], stats["throttled_seconds"], stats["held"],
+                             stats["rejected"])
+
+    def admit_message(self, sender=None):
+        """
+        Check whether a new message can be accepted, holding the sender while it exceeds its rate limit or
+        the queue has no room for it, if the backpressure policy is hold
+
+        :param sender: the sender of the message, see sender_of
+        :return: ``True`` if the message can be accepted, ``False`` if it must be refused
+        """
+        bucket = self.rate_limit(sender)
+        if bucket is not None:
+            deadline = time.time() + self.backpressure_hold_timeout
+            wait = bucket.consume()
+            while wait:
+                if self.backpressure != "hold" or time.time() + wait > deadline:
+                    self.logger.debug("Message from sender=%s refused, above %s messages per second",
+                                      sender, bucket.rate)
+                    return False
+                time.sleep(wait)
+                wait = bucket.consume()
+
+        if self._queue.has_room(sender):
+            return True
+        if self.backpressure == "hold" and self._queue.wait_for_room(self.backpressure_hold_timeout, sender):
+            return True
+        self._queue.reject()
+        return False
+
+    def wait_for_rate(self, sender):
+        """
+        Wait until a message of a batch is within the rate limit of its sender. Batch messages can't be refused one
+        by one, so they wait whatever the backpressure policy, until the input is stopping
+
+        :param sender: the sender of the message, see sender_of
+        :return: ``True`` if the message can be accepted, ``False`` if the input is stopping
+        """
+        bucket = self.rate_limit(sender)
+        if bucket is None:
+            return True
+        wait = bucket.consume()
+        while wait:
+            if self.stop_requested:
+                return False
+            time.sleep(min(wait, 0.5))
+            wait = bucket.consume()
+        return True
+
+    def wait_for_batch_room(self):
+        """
+        Wait until the queue has room for the messages of an MLLP batch, which can't be refused one by one:
+        up to backpressure_hold_timeout seconds, or drain_timeout seconds once the input is stopping
+
+        :return: ``True`` if the batch can be accepted, ``False`` if the queue is still throttled
+        """
+        timeout = self.drain_timeout if self.stop_requested else self.backpressure_hold_timeout
+        if self._queue.wait_for_room(timeout):
+            return True
+        self._queue.reject()
+        return False
+
+    def open_spool(self, checkpoint_dir, stanza, worker=None):
+        name = hashlib.sha224(stanza).hexdigest()
+        if worker is not None:
+            name += "-%d" % worker
+        spool = MessageSpool(os.path.join(checkpoint_dir, "spool", name))
+
+        # messages acknowledged before the last shutdown but never sent to splunk
+        if spool.recovered:
+            self.logger.info("Replaying %d spooled messages for stanza=%s", len(spool.recovered), stanza)
+        for entry_id, data in spool.recovered:
+            message = data.decode("utf-8")
+            try:
+                header = MSHHeader(message)
+            except Exception:
+                header = None
+            self.en_queue((message, header, entry_id, None), self.sender_of(header))
+        return spool
+
+    def open_dedupe(self, cleaned_params, checkpoint_dir, stanza, worker=None):
+        cache_size = cleaned_params.get("dedupe_cache_size", None)
+        if not cache_size:
+            return None
+        bloom_filter = None
+        if cleaned_params.get("dedupe_persistent", False):
+            directory = os.path.join(checkpoint_dir, "dedupe")
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            name = hashlib.sha224(stanza).hexdigest()
+            if worker is not None:
+                name += "-%d" % worker
+            bloom_filter = BloomFilter(os.path.join(directory, name + ".bloom"),
+                                       capacity=cleaned_params.get("dedupe_filter_size", None) or 1000000,
+                                       error_rate=float(cleaned_params.get("dedupe_filter_error_rate", None)
+                                                        or 0.0000001))
+        return DuplicateFilter(cache_size, bloom_filter)
+
+    def find_duplicate(self, header):
+        """
+        Look up a message among the ones already accepted
+
+        :return: a tuple with the identity of the message, or ``None`` if duplicates aren't suppressed for it,
+            ``True`` if it is a duplicate and the ACK sent the first time, if still known
+        """
+        if self.dedupe is None or not header.control_id:
+            return None, False, None
+        key = DuplicateFilter.key(header)
+        duplicate, ack = self.dedupe.check(key)
+        if duplicate and ack is None and not self.dedupe.cached(key):
+            # only the persistent filter knows the message, which may be a new one mistaken for a duplicate
+            self.logger.warning("Probable duplicate message control_id=%s from sending_application=%s "
+                                "sending_facility=%s found in the persistent filter, not indexed, error rate=%s",
+                                header.control_id, header.sending_application, header.sending_facility,
+                                self.dedupe.bloom_filter.error_rate)
+        elif duplicate:
+            self.logger.info("Duplicate message control_id=%s from sending_application=%s sending_facility=%s, "
+                             "duplicates from this sender=%d", header.control_id, header.sending_application,
+                             header.sending_facility, self.dedupe.duplicates["%s|%s" % key[:2]])
+        return key, duplicate, ack
+
+    def accept_new_message(self, message):
+        """
+        Accept a message of a batch unless it has already been accepted, once its sender is within its rate limit
+
+        :return: ``False`` if the message wasn't accepted because the input is stopping
+        """
+        header = MSHHeader(message)
+        key, duplicate, ack = self.find_duplicate(header)
+        if duplicate:
+            return True
+        sender = self.sender_of(header)
+        if not self.wait_for_rate(sender):
+            return False
+        self.accept_message(message, header, sender)
+        if key is not None:
+            self.dedupe.remember(key)
+        return True
+
+    def spool_message(self, message):
+        """
+        Store the message in the spool, if enabled, and return the id of the spool entry
+        """
+        if self.spool is None:
+            return None
+        return self.spool.append(message.encode("utf-8"))
+
+    def accept_message(self, message, header=None, sender=None):
+        """
+        Accept a message received from a sender or read from a batch file: store it in the spool and queue it
+        for the output loop
+
+        :param sender: the sender of the message, see sender_of
+        :return: the MSH header of the message
+        """
+        # only the header is needed to ACK, the message is parsed later by the output loop
+        if header is None:
+            header = MSHHeader(message)
+
+        # the message must be on disk before it is acknowledged
+        spool_id = self.spool_message(message)
+
+        # put the message into the queue and don't wait for splunking. The messages of a sender keep their
+        # order if parsed in parallel, even if it opens a connection for each of them
+        self.en_queue((message, header, spool_id, peer_host()), sender)
+
+        # the copies for the relay destinations are queued without waiting for them
+        if self.relay is not None:
+            self.relay.forward(message)
+        return header
+
+    def ingest_batch_file(self, path):
+        """
+        Stream the messages of a batch file through :meth:`accept_new_message`. The file is read twice: its envelope
+        and message headers are checked first, so that nothing is accepted from an invalid file. The number of
+        messages accepted is saved every batch_checkpoint_interval messages and when the input stops, and those
+        messages are skipped when the file is read again
+
+        :return: the :class:`BatchReader` used to read the file, or ``None`` if the input stopped before its end
+        :raises InvalidBatch: if the BTS/FTS counts don't match
+        """
+        with open(path, 'rb') as f:
+            for message in BatchReader(f):
+                if self.stop_requested:
+                    return None
+                MSHHeader(message)
+
+        checkpoint = batch_checkpoint(path)
+        accepted = read_batch_checkpoint(checkpoint)
+        if accepted:
+            self.logger.info("Resuming batch file %s after %d messages", path, accepted)
+        self.batch_file = path
+        try:
+            with open(path, 'rb') as f:
+                reader = BatchReader(f)
+                for message in reader:
+                    if reader.messages <= accepted:
+                        continue
+                    while not self.stop_requested and (self._queue.throttled or
+                                                       self._queue.qsize() > self.batch_queue_limit):
+                        time.sleep(0.05)
+                    if self.stop_requested or not self.accept_new_message(message):
+                        write_batch_checkpoint(checkpoint, reader.messages - 1)
+                        return None
+                    if reader.messages % self.batch_checkpoint_interval == 0:
+                        write_batch_checkpoint(checkpoint, reader.messages)
+        finally:
+            self.batch_file = None
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        return reader
+
+    def poll_batch_directory(self, stanza, directory):
+        processed = os.path.join(directory, "processed")
+        failed = os.path.join(directory, "failed")
+        for d in (processed, failed):
+            if not os.path.isdir(d):
+                os.makedirs(d)
+
+        while not self.stop_requested:
+            for name in sorted(os.listdir(directory)):
+                if self.stop_requested:
+                    return
+                path = os.path.join(directory, name)
+                if not os.path.isfile(path) or name.startswith("."):
+                    continue
+                # the sender may still be writing the file
+                if time.time() - os.path.getmtime(path) < self.sleep_interval:
+                    continue
+                try:
+                    reader = self.ingest_batch_file(path)
+                except Exception as e:
+                    self.logger.warning("Invalid batch file %s for stanza=%s: %s", path, stanza, e)
+                    os.rename(path, os.path.join(failed, name))
+                else:
+                    if reader is None:
+                        # left in place with its checkpoint, it is resumed at the next start
+                        self.logger.info("Batch file %s interrupted for stanza=%s", path, stanza)
+                        return
+                    self.logger.info("Read %d messages in %d batches from %s for stanza=%s",
+                                     reader.messages, reader.batches, path, stanza)
+                    os.rename(path, os.path.join(processed, name))
+            time.sleep(self.sleep_interval)
+
+    def start_batch_thread(self, stanza, directory):
+        self.batch_thread = threading.Thread(target=self.poll_batch_directory, args=(stanza, directory))
+        self.batch_thread.daemon = True
+        self.logger.info("Polling %s for batch files for stanza=%s", directory, stanza)
+        self.batch_thread.start()
+
+
+    def create_ssl_context(self, cleaned_params):
+        certfile = cleaned_params.get("tls_certfile", None)
+        if not certfile:
+            return None
+        keyfile = cleaned_params.get("tls_keyfile", None)
+        cafile = cleaned_params.get("tls_cafile", None)
+        return create_tls_context(os.path.expandvars(certfile),
+                                  keyfile=os.path.expandvars(keyfile) if keyfile else None,
+                                  cafile=os.path.expandvars(cafile) if cafile else None,
+                                  require_client_cert=cleaned_params.get("tls_require_client_cert", False))
+
+    def create_frame_limits(self, cleaned_params):
+        max_size = cleaned_params.get("max_message_size", None)
+        spill_size = cleaned_params.get("spill_message_size", None)
+        if not max_size and not spill_size:
+            return None
+        policy = (cleaned_params.get("oversize_policy", None) or "close").strip()
+        if policy.upper() in ("AE", "AR"):
+            oversize_ack = policy.upper()
+        else:
+            if policy != "close":
+                self.logger.warning("Unknown oversize policy %s, using close", policy)
+            oversize_ack = None
+        self.parse_size_limit = spill_size
+        return FrameLimits(max_size=max_size or None, spill_size=spill_size or None, oversize_ack=oversize_ack)
+
+    def create_mllp_server(self, cleaned_params, reuse_port=False):
+        port = cleaned_params.get("port", None)
+        unix_path = cleaned_params.get("unix_socket", None) or None
+        if unix_path is not None:
+            unix_path = os.path.expandvars(unix_path)
+        max_connections = cleaned_params.get("max_connections", None)
+        max_queued_connections = cleaned_params.get("max_queued_connections", None)
+
+        handlers = {
+            '*': (MessageHandler, self),
+            'ERR': (CatchAllHandler,self)
+        }
+        frame_limits = self.create_frame_limits(cleaned_params)
+
+        persistent = cleaned_params.get("persistent_connections", False)
+        if persistent and max_connections:
+            # a pooled worker would be taken by every idle connection
+            self.logger.warning("persistent_connections is ignored with max_connections")
+            persistent = False
+
+        if persistent:
+            return mllp2.MLLPServer('0.0.0.0', port, handlers, idle_timeout=cleaned_params.get("idle_timeout", None),
+                                    reuse_port=reuse_port, ssl_context=self.ssl_context, frame_limits=frame_limits,
+                                    unix_path=unix_path)
+        elif max_connections:
+            pool_args = {'max_workers': max_connections, 'reuse_port': reuse_port, 'ssl_context': self.ssl_context,
+                         'frame_limits': frame_limits, 'unix_path': unix_path}
+            if max_queued_connections == 0:
+                pool_args['overflow'] = PooledMLLPServer.REFUSE
+            elif max_queued_connections is not None:
+                pool_args['max_queued'] = max_queued_connections
+            return PooledMLLPServer('0.0.0.0', port, handlers, **pool_args)
+        else:
+            return MLLPServer('0.0.0.0', port, handlers, reuse_port=reuse_port, ssl_context=self.ssl_context,
+                              frame_limits=frame_limits, unix_path=unix_path)
+
+    def start_mllp_thread(self, stanza):
+        self.mllp_thread = threading.Thread(target=self.start_mllp_server)
+        self.mllp_thread.daemon = True
+        self.logger.info("Starting MLLP Server for stanza=%s", stanza)
+        self.mllp_thread.start()
+
+    def run_listener_processes(self, stanza, cleaned_params, listener_processes, checkpoint_dir):
+        # the workers share stdout, so their events must not interleave
+        self.lock = multiprocessing.RLock()
+        supervisor = WorkerSupervisor(self.run_listener_worker, listener_processes,
+                                      args=(stanza, cleaned_params, checkpoint_dir, os.getpid()))
+        self.logger.info("Starting %d MLLP listener processes for stanza=%s", listener_processes, stanza)
+        supervisor.start()
+        self.supervisor = supervisor
+        try:
+            supervisor.supervise()
+        finally:
+            self.supervisor = None
+            supervisor.stop(self.drain_timeout + 1)
+
+    def run_listener_worker(self, worker, stanza, cleaned_params, checkpoint_dir, parent_pid):
+        # the restarted workers are forked with the supervisor
+        self.supervisor = None
+        self.configure_queue(cleaned_params)
+        self.configure_application_acks(cleaned_params)
+        self.configure_relay(cleaned_params)
+        if cleaned_params.get("durable_spool", False):
+            self.spool = self.open_spool(checkpoint_dir, stanza, worker)
+        self.dedupe = self.open_dedupe(cleaned_params, checkpoint_dir, stanza, worker)
+        self.start_parse_pool(cleaned_params)
+        self.mllp = self.create_mllp_server(cleaned_params, reuse_port=True)
+        self.start_mllp_thread(stanza)
+        if worker == 0 and cleaned_params.get("batch_directory", None):
+            self.start_batch_thread(stanza, os.path.expandvars(cleaned_params["batch_directory"]))
+        self.logger.info("MLLP listener process %d started for stanza=%s", worker, stanza)
+        self.output_loop(stanza, cleaned_params, parent_pid=parent_pid)
+
+    def start_parse_pool(self, cleaned_params):
+        """
+        Start the processes validating the messages and building their events in parallel, if configured. They
+        must be forked before the threads of the MLLP server are started
+        """
+        global _parse_input
+
+        workers = cleaned_params.get("parse_workers", None)
+        if not workers or workers < 1 or self.pipeline is not None:
+            return
+        sharding = (cleaned_params.get("parse_sharding", None) or "").strip().lower() or None
+        if sharding not in (None, "sender", "peer"):
+            self.logger.warning("Unknown parse_sharding %s, using sender", sharding)
+            sharding = "sender"
+        self.parse_sharding = sharding
+        max_pending = cleaned_params.get("parse_buffer_size", None) or 100 * workers
+
+        # the workers are forked with their copy of the input, which builds the events, see render_event
+        _parse_input = self
+        if sharding:
+            pools = [multiprocessing.Pool(1, initializer=reset_signals) for _ in range(workers)]
+            self.pipeline = ShardedPipeline(pools, render_event, max_pending=max_pending)
+        else:
+            pool = multiprocessing.Pool(workers, initializer=reset_signals)
+            self.pipeline = OrderedPipeline(pool, render_event, max_pending=max_pending)
+        self.logger.info("Validating messages with %d processes, sharding=%s, reorder buffer of %d messages", workers,
+                         sharding, max_pending)
+
+    def parse_stream(self, item):
+        """
+        Return the stream of a queued message, i.e. the messages whose order is kept when parsed in parallel:
+        the messages of the same sender, by MSH-3 and MSH-4 if sharded by sender, by peer address otherwise
+        """
+        header = item[1]
+        if self.parse_sharding == "sender" and header is not None:
+            return "%s|%s" % (header.sending_application, header.sending_facility)
+        return item[3]
+
+    def write_message(self, item, stanza, sourcetype, host, index, result=None):
+        """
+        Write a message taken from the queue to Splunk and remove it from the spool
+
+        :param result: the result of :func:`render_event` for the message, if built by a parse worker
+        """
+        t0, header, spool_id = item[:3]
+        if result is None:
+            error = validate_message(t0, self.parse_size_limit)
+            event = None
+        else:
+            event, error = result
+        if error is not None:
+            self.logger.warning("unable to parse message %s: %s", header.control_id if header else "", error)
+
+        if event is None:
+            self.logger.info("about to send this to splunk\n %s", t0)
+            self.output_event(t0, stanza, _time=calendar.timegm(time.gmtime()), sourcetype=sourcetype, host=host, index=index)
+        else:
+            self.logger.info("about to send this to splunk\n %s", t0)
+            self.write_event(event)
+
+        if spool_id is not None:
+            self.spool.ack(spool_id)
+
+        # in the enhanced acknowledgment mode the sender got a commit ACK, this tells it the message is processed
+        if header is not None and self.enhanced_mode(header):
+            if error is None:
+                self.send_application_ack(header, "AA", text="indexed by splunk")
+            else:
+                self.send_application_ack(header, "AE", text="unable to parse message: %s" % error)
+
+    def output_loop(self, stanza, cleaned_params, parent_pid=None):
+        host = cleaned_params.get("host", None)
+        index = cleaned_params.get("index", "default")
+        sourcetype = cleaned_params.get("sourcetype", "hl7")
+
+        def write(item, result=None):
+            self.write_message(item, stanza, sourcetype, host, index, result)
+
+        while True:
+            while not self._queue.empty() and not self.stop_requested:
+                if self.pipeline is None:
+                    write(self._queue.get())
+                elif self.pipeline.full():
+                    break
+                else:
+                    item = self._queue.get()
+                    self.pipeline.submit(self.parse_stream(item), item, item[0], self.parse_size_limit, stanza,
+                                         sourcetype, host, index)
+
+            if self.pipeline is not None and len(self.pipeline):
+                for item, result in self.pipeline.release(0.1):
+                    write(item, result)
+
+            if self.stop_requested:
+                self.drain(write)
+                return
+
+            # a listener process exits together with the supervisor
+            if parent_pid is not None and os.getppid() != parent_pid:
+                self.logger.info("The supervisor process exited, stopping listener process")
+                if self.pipeline is not None:
+                    self.pipeline.close()
+                return
+
+            if self.pipeline is None or not len(self.pipeline):
+                time.sleep(0.1)
+
+    def validate_parameters(self, stanza, parameters, session_key=None):
+        cleaned_params = ModularInput.validate_parameters(self, stanza, parameters, session_key)
+
+        listener_processes = cleaned_params.get("listener_processes", None)
+        if cleaned_params.get("dedupe_cache_size", None) and listener_processes and listener_processes > 1 \
+                and not cleaned_params.get("unix_socket", None):
+            # every listener process only knows the messages it received, so a retransmission received by
+            # another one would be indexed twice
+            raise FieldValidationException("dedupe_cache_size can't be used with listener_processes")
+
+        error_rate = cleaned_params.get("dedupe_filter_error_rate", None)
+        if error_rate:
+            try:
+                valid = 0 < float(error_rate) < 1
+            except ValueError:
+                valid = False
+            if not valid:
+                raise FieldValidationException("dedupe_filter_error_rate must be between 0 and 1")
+        return cleaned_params
 
     def run(self, stanza, cleaned_params, input_config):
         #interval = cleaned_params["interval"]
@@ -215,61 +1046,63 @@ class MyInput(ModularInput):
         index = cleaned_params.get("index", "default")
         sourcetype = cleaned_params.get("sourcetype", "hl7")
 
-        port = cleaned_params["port"]
+        port = cleaned_params.get("port", None)
         output_kvp = cleaned_params.get("output_kvp", False)
         remove_phi = cleaned_params.get("remove_phi", False)
         fields_to_remove = cleaned_params.get("fields_to_remove", [])
         max_long_segment = cleaned_params.get("max_long_segment", 0)
-
+        listener_processes = cleaned_params.get("listener_processes", None)
+
+        if self.ssl_context is None:
+            self.ssl_context = self.create_ssl_context(cleaned_params)
+
+        self.drain_timeout = cleaned_params.get("drain_timeout", None) or self.drain_timeout
+        self.install_stop_handler()
+
+        if not port and not cleaned_params.get("unix_socket", None):
+            self.logger.error("Neither port nor unix_socket is set for stanza=%s", stanza)
+            return
+        if cleaned_params.get("unix_socket", None) and listener_processes and listener_processes > 1:
+            # a Unix socket can't be bound by several processes
+            self.logger.warning("listener_processes is ignored with unix_socket for stanza=%s", stanza)
+            listener_processes = None
+
+        if listener_processes and listener_processes > 1:
+            # every worker process binds the port with SO_REUSEPORT and runs its own server and
+            # output loop, this process only restarts the workers that die
+            self.run_listener_processes(stanza, cleaned_params, listener_processes, input_config.checkpoint_dir)
+            if self.stop_requested:
+                sys.exit(0)
+            return
+
+        self.configure_queue(cleaned_params)
+        self.configure_application_acks(cleaned_params)
+        self.configure_relay(cleaned_params)
 
         # because we are forcing multiple instances,  we need to keep it running
         # otherwise the main thread will exit and the spawned mllp server will die with it
         # The first option is doing a forever loop here.
         # The second option is making the mllp server run in another daemon thread
 
-        if self.mllp is None:
-            handlers = {
-                'ERR': (CatchAllHandler,self)
-            }
-            # the mllp server is not running, try starting it
-
-            self.mllp = MLLPServer('0.0.0.0', port, handlers )
-
-            self.mllp_thread = threading.Thread(target=self.start_mllp_server)
-            self.mllp_thread.daemon = True
-            self.logger.info("Starting MLLP Server for stanza=%s", stanza)
-            self.mllp_thread.start()
-
-        while True:
-            while not self._queue.empty():
-                t0, t1=self._queue.get()
-                #self.logger.info("about to process this message before storing it %s", t0)
+        if self.spool is None and cleaned_params.get("durable_spool", False):
+            self.spool = self.open_spool(input_config.checkpoint_dir, stanza)
 
-                # raw_test= ("MSH|^~\&|EPIC|EPICADT|SMS|SMSADT|199912271408|CHARRIS|ADT^A04|1817457|D|2.5|\r" +
-                #     "PID||0493575^^^2^ID 1|454721||DOE^JOHN^^^^|DOE^JOHN^^^^|19480203|M||B|254 MYSTREET AVE^^MYTOWN^OH^44123^USA||(216)123-4567|||M|NON|400003403~1129086|999-|\r"
-                #     +"NK1||ROE^MARIE^^^^|SPO||(216)123-4567||EC|||||||||||||||||||||||||||\r"
-                #     +"NK1||DOE^JOHN ^^^^|SPO||(216)123-4567||EC|||||||||||||||||||||||||||\r"
-                #     +"NK1||DOE^ROBERT ^^^^|SPO||(216)123-4568||EC|||||||||||||||||||||||||||\r"
-                #     +"PV1||O|168 ~219~C~PMA^^^^^^^^^||||277^ALLEN MYLASTNAME^BONNIE^^^^|||||||||| ||2688684|||||||||||||||||||||||||199912271408||||||002376853")
-                # t1 = parse_message(raw_test)
-                # t1.name="unamed"
+        if self.dedupe is None:
+            self.dedupe = self.open_dedupe(cleaned_params, input_config.checkpoint_dir, stanza)
 
-                #todo: option to splunk parsed data as kvp
-                #todo: option to chooce timestamp
-                #todo: option to de-identify the data based on default or user-supplied routines
-                #todo: option to filter out large segments
-
-
-
-                t2= ["    "*level+ (n.name or "unamed")  +"="+ hl7_util.escape_spaces(n.to_er7())+ "," for [n, level] in hl7_util.preorder(t1)]
-
-                t3="\n".join(t2)
+        if self.mllp is None:
+            # the mllp server is not running, try starting it
+            self.start_parse_pool(cleaned_params)
+            self.mllp = self.create_mllp_server(cleaned_params)
+            self.start_mllp_thread(stanza)
 
-                out = t0
-                self.logger.info("about to send this to splunk\n %s", out)
-                self.output_event(out, stanza, _time=calendar.timegm(time.gmtime()), sourcetype=sourcetype, host=host, index=index)
+            if cleaned_params.get("batch_directory", None):
+                self.start_batch_thread(stanza, os.path.expandvars(cleaned_params["batch_directory"]))
 
-            time.sleep(0.1)
+        self.output_loop(stanza, cleaned_params)
+        if self.stop_requested:
+            # don't let the single instance loop run the stanza again
+            sys.exit(0)
 
         # if self.needs_another_run(input_config.checkpoint_dir, stanza, interval):
         #     pass
@@ -371,42 +1204,226 @@ class hl7_util:
             pass
 
 
-class CatchAllHandler(AbstractErrorHandler):
+def validate_message(t0, parse_size_limit=None):
+    """
+    Parse a message to check that it is valid. The message is indexed as received, so the parse tree is only
+    used for this check. It runs in the parse worker processes, if configured, so it only depends on its
+    arguments
+
+    :param t0: the ER7-encoded message
+    :param parse_size_limit: the size above which the message isn't parsed
+    :return: the error that prevented parsing the message, or ``None``
+    """
+    if parse_size_limit and len(t0) > parse_size_limit:
+        # an embedded document would multiply the memory used by the message
+        return None
+    try:
+        parse_message(t0)
+    except Exception as e:
+        return str(e)
+    return None
+
+
+# the input whose create_event_string builds the events of the parse workers, see start_parse_pool
+_parse_input = None
+
+
+def render_event(t0, parse_size_limit, stanza, sourcetype, host, index):
+    """
+    Validate a message and build the XML event written to Splunk, so that the parse workers return events
+    ready to be written
+
+    :return: a tuple with the event and the error that prevented parsing the message, or ``None``
+    """
+    error = validate_message(t0, parse_size_limit)
+    event = _parse_input.create_event_string(t0, stanza, calendar.timegm(time.gmtime()), sourcetype, None, index,
+                                             host)
+    return event, error
+
+
+def positive_number(value):
+    number = float(value)
+    if number <= 0:
+        raise ValueError("%s is not positive" % value)
+    return number
+
+
+def mllp_address(value):
+    host, _, port = value.rpartition(":")
+    if not host:
+        raise ValueError("%s is not a host:port address" % value)
+    return host, int(port)
+
+
+def peer_host():
+    """
+    Return the address of the sender of the message being handled, or ``None`` outside of the MLLP server
+    """
+    peer = current_peer()
+    return peer[0] if isinstance(peer, tuple) else peer
+
+
+def batch_checkpoint(path):
+    """
+    Return the path of the file holding the number of messages accepted from a batch file: a hidden file
+    next to it, which isn't taken for a batch file
+    """
+    directory, name = os.path.split(path)
+    return os.path.join(directory, "." + name + ".offset")
+
+
+def read_batch_checkpoint(checkpoint):
+    try:
+        with open(checkpoint) as f:
+            return int(f.read().strip() or 0)
+    except (IOError, OSError, ValueError):
+        return 0
+
+
+def write_batch_checkpoint(checkpoint, accepted):
+    # replaced at once, so that a crash leaves either the previous count or the new one
+    with open(checkpoint + ".tmp", "w") as f:
+        f.write("%d\n" % accepted)
+    if os.name == "nt" and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    os.rename(checkpoint + ".tmp", checkpoint)
+
+
+def reset_signals():
+    # the parse workers are stopped by the output loop, not by the signals sent to the modular input
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class _InputHandlerMixin(object):
+    """
+    Acknowledges and queues the messages of the input :attr:`mi`
+    """
+
+    def ack(self, header):
+        """
+        Build a ack response for the incoming message. In the enhanced acknowledgment mode, with durable_spool,
+        it is a commit ACK, sent only if requested in MSH-15, and the application ACK is sent once the message
+        is written to Splunk
 
-    def ack(self, message):
+        :param header: the MSH header of the incoming message
+        :return: the MLLP-encoded ACK message, or ``None``
         """
-        Build a ack response for the incoming message
+        if self.mi.enhanced_mode(header):
+            return self.commit_ack(header, "CA", "received by splunk")
+        return build_ack(header, "AA", text="received by splunk")
 
-        :param message: incoming message
-        :return: a NAK message
+    def nak(self, header):
         """
-        response = Message("ACK")
-        response.MSH.MSH_9 = "ACK"  # message type
-        response.MSA.MSA_1 = "AA"   # accept
-        response.MSA.MSA_2 = message.MSH.MSH_10  # the original message's control ID
-        response.MSA.MSA_3 = "received by splunk"  # any text message
-        return response
+        Build the negative ack response sent when the message is refused because Splunk is falling behind
 
-    def __init__(self, ex, msg, mi):
-        super(CatchAllHandler, self).__init__(ex, msg)
-        self.mi = mi
+        :param header: the MSH header of the incoming message
+        :return: the MLLP-encoded ACK message, or ``None``
+        """
+        code = self.mi.backpressure if self.mi.backpressure in ("AE", "AR") else "AE"
+        if self.mi.enhanced_mode(header):
+            return self.commit_ack(header, "C" + code[1], "receiver busy, retry later")
+        return build_ack(header, code, text="receiver busy, retry later")
 
-    def reply(self):
+    def reject(self, header, segment):
+        """
+        Build the negative ack response sent when the body of the message is corrupt, so that it isn't
+        acknowledged from its header alone
+
+        :param header: the MSH header of the incoming message
+        :param segment: the invalid segment, see :meth:`MSHHeader.invalid_segment`
+        :return: the MLLP-encoded ACK message, or ``None``
+        """
+        self.mi.logger.warning("Message control_id=%s from sending_application=%s sending_facility=%s refused, "
+                               "invalid segment %r", header.control_id, header.sending_application,
+                               header.sending_facility, segment[:40])
+        error = "invalid segment %s" % segment[:40]
+        if self.mi.enhanced_mode(header):
+            return self.commit_ack(header, "CE", "message refused", error)
+        return build_ack(header, "AE", text="message refused", error=error)
+
+    def commit_ack(self, header, code, text, error=None):
+        if not ack_required(header.accept_ack_type, code):
+            return None
+        return build_ack(header, code, text=text, error=error)
 
-        msg = parse_message(self.incoming_message)
+    def batch_ack(self):
+        """
+        Accept the messages of an incoming batch and build the acknowledgment of the batch
+        """
+        reader = BatchReader(self.incoming_message)
+        comment = None
+        try:
+            for message in reader:
+                if not self.mi.accept_new_message(message):
+                    self.mi.logger.warning("Batch not acknowledged, the input stopped after %d messages",
+                                           reader.messages - 1)
+                    return None
+        except InvalidBatch as e:
+            self.mi.logger.warning("Invalid batch after %d messages: %s", reader.messages, e)
+            comment = str(e)
+        return build_batch_ack(reader.file_header, reader.batch_header, comment)
 
-        # put the message into the queue and don't wait for splunking.
-        self.mi.en_queue((self.incoming_message,msg))
-        # do something with the message
+    def reply(self):
 
-        res = self.ack(msg)
-        res_mllp=res.to_mllp()
+        if self.incoming_message[:3] in ("FHS", "BHS"):
+            # a batch is acknowledged as a whole, so it waits for the queue to drain and, if it doesn't in
+            # time, isn't acknowledged at all: the sender sends it again
+            if not self.mi.wait_for_batch_room():
+                self.mi.logger.warning("Batch not acknowledged, the queue is still throttled after %s seconds",
+                                       self.mi.drain_timeout if self.mi.stop_requested
+                                       else self.mi.backpressure_hold_timeout)
+                return None
+            res_mllp = self.batch_ack()
+        else:
+            header = self.header
+            invalid_segment = header.invalid_segment(self.incoming_message)
+            if invalid_segment is not None:
+                return self.reject(header, invalid_segment)
+            sender = self.mi.sender_of(header)
+            key, duplicate, previous_ack = self.mi.find_duplicate(header)
+            if duplicate:
+                # a retransmission of a message already indexed gets the same answer as the first time
+                res_mllp = previous_ack or self.ack(header)
+            elif self.mi.admit_message(sender):
+                res_mllp = self.ack(self.mi.accept_message(self.incoming_message, header, sender))
+                if key is not None:
+                    self.mi.dedupe.remember(key, res_mllp)
+            else:
+                res_mllp = self.nak(header)
 
         self.mi.logger.debug("about to send this replay to the client: \n %s", res_mllp)
 
         return res_mllp
 
 
+class MessageHandler(_InputHandlerMixin, AbstractHandler):
+    """
+    Handles the messages routed by their type, i.e. all the messages with a valid MSH segment
+    """
+
+    def __init__(self, msg, mi):
+        super(MessageHandler, self).__init__(msg)
+        self.mi = mi
+
+
+class CatchAllHandler(_InputHandlerMixin, AbstractErrorHandler):
+    """
+    Handles the batches and the messages that can't be routed. The errors raised by :class:`MessageHandler`
+    are raised again, so that the connection is closed without an ACK and the sender retries
+    """
+
+    def __init__(self, ex, msg, mi):
+        super(CatchAllHandler, self).__init__(ex, msg)
+        self.mi = mi
+
+    def reply(self):
+        if self.exc is not None and not isinstance(self.exc, (UnsupportedMessageType, InvalidHL7Message)):
+            self.mi.logger.error("Unable to handle the message: %s", self.exc)
+            raise self.exc
+        return super(CatchAllHandler, self).reply()
+
+
 
 
 if __name__ == '__main__':
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the MLLP stack and of the modular input. They run with ``python -m pytest tests`` or, on
+Python 2, with ``python -m unittest discover -s tests -t .`` from the root of the repository.
+"""
+
+import os
+import sys
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'TA-cdis-hl7', 'bin')
+
+for path in (BIN_DIR, os.path.join(BIN_DIR, 'TA-cdis-hl7')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers shared by the tests: sample messages, servers running in a background thread, raw MLLP connections
+and TLS certificates.
+"""
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+from hl7apy.mllp import AbstractHandler, MLLPFrameReader, MSHHeader, build_ack, _frame_data, _decode
+
+
+def message(control_id='1', message_type='ADT^A01', version='2.5', sending_application='APP',
+            sending_facility='FAC', accept_ack_type=None, application_ack_type=None,
+            segments=('PID|1||123^^^HOSP||DOE^JOHN',)):
+    """
+    Build an ER7 message, with ``\\r`` as segment separator
+    """
+    msh = ['MSH', '^~\\&', sending_application, sending_facility, 'SPLUNK', 'SPLUNKFAC', '20200101120000', '',
+           message_type, control_id, 'P', version]
+    if accept_ack_type is not None or application_ack_type is not None:
+        msh += ['', '', accept_ack_type or '', application_ack_type or '']
+    return '\r'.join(['|'.join(msh)] + list(segments)) + '\r'
+
+
+def frame(msg):
+    """
+    Wrap a message with the MLLP encoding characters
+    """
+    return b'\x0b' + msg.encode('utf-8') + b'\x1c\r'
+
+
+def msa(ack):
+    """
+    Return the acknowledgment code (MSA-1) and the control id (MSA-2) of an acknowledgment
+    """
+    for segment in ack.strip('\x0b\x1c\r').split('\r'):
+        if segment.startswith('MSA'):
+            fields = segment.split(segment[3])
+            return fields[1], fields[2]
+    return None, None
+
+
+class AckHandler(AbstractHandler):
+    """
+    Accepts every message
+    """
+    def reply(self):
+        return build_ack(MSHHeader(self.incoming_message), 'AA')
+
+
+class SlowAckHandler(AbstractHandler):
+    """
+    Accepts every message after :attr:`delay` seconds
+    """
+    delay = 0.5
+
+    def reply(self):
+        time.sleep(self.delay)
+        return build_ack(MSHHeader(self.incoming_message), 'AA')
+
+
+def serve(testcase, server):
+    """
+    Run a threaded server in a background thread until the end of the test
+
+    :return: the address of the server
+    """
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05})
+    thread.daemon = True
+    thread.start()
+
+    def stop():
+        if not getattr(server, 'draining', False):
+            server.shutdown()
+            server.server_close()
+        thread.join(5)
+    testcase.addCleanup(stop)
+    return server.server_address
+
+
+def connect(testcase, address, timeout=5):
+    """
+    Open a connection to a TCP address or Unix domain socket, closed at the end of the test
+    """
+    if isinstance(address, tuple):
+        sock = socket.create_connection(address, timeout)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(address)
+    testcase.addCleanup(sock.close)
+    return sock
+
+
+def read_messages(sock, count):
+    """
+    Read up to :attr:`count` frames from a socket, stopping if the peer closes the connection
+
+    :return: the list of the messages, without the MLLP encoding characters
+    """
+    reader = MLLPFrameReader(sock)
+    messages = []
+    while len(messages) < count:
+        received = reader.read_frame()
+        if received is None:
+            break
+        messages.append(_decode(_frame_data(received)[1:-2], 'utf-8'))
+    return messages
+
+
+def closed_by_peer(sock):
+    """
+    Tell whether the peer closed the connection, waiting up to the timeout of the socket
+    """
+    try:
+        return sock.recv(1) == b''
+    except socket.timeout:
+        return False
+    except socket.error:
+        return True
+
+
+def temp_dir(testcase):
+    """
+    Create a temporary directory removed at the end of the test
+    """
+    directory = tempfile.mkdtemp(prefix='hl7-test-')
+    testcase.addCleanup(shutil.rmtree, directory, True)
+    return directory
+
+
+def free_port():
+    """
+    Return a TCP port nobody is listening on
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_until(condition, timeout=5):
+    """
+    Wait until :attr:`condition` returns a true value
+
+    :return: the last value returned by the condition
+    """
+    deadline = time.time() + timeout
+    value = condition()
+    while not value and time.time() < deadline:
+        time.sleep(0.02)
+        value = condition()
+    return value
+
+
+def make_certificate(testcase):
+    """
+    Generate a self-signed certificate for localhost with the openssl command
+
+    :return: the paths of the certificate and of its private key
+    :raises: :exc:`unittest.SkipTest` if openssl is not available
+    """
+    directory = temp_dir(testcase)
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    try:
+        with open(os.devnull, 'wb') as devnull:
+            subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '2',
+                                   '-subj', '/CN=localhost', '-keyout', keyfile, '-out', certfile],
+                                  stdout=devnull, stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise unittest.SkipTest('unable to generate a certificate with openssl: %s' % e)
+    return certfile, keyfile
+
+
+def client_tls_context():
+    """
+    Client-side TLS context that accepts the self-signed certificates of the tests
+    """
+    import ssl
+    context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_CLIENT', ssl.PROTOCOL_SSLv23))
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def import_modular_input():
+    """
+    Import the modular input, which needs the Splunk libraries and the Python 2 interpreter of Splunk
+
+    :raises: :exc:`unittest.SkipTest` if it can't be imported
+    """
+    try:
+        import hl7_modular_input
+    except ImportError as e:
+        raise unittest.SkipTest('the modular input can\'t be imported here: %s' % e)
+    return hl7_modular_input
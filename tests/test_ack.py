@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import unittest
+
+from hl7apy.mllp import MSHHeader, ack_required, build_ack
+from spool import MessageSpool
+
+from tests.support import import_modular_input, message, msa, temp_dir
+
+
+def err_segment(ack):
+    for segment in ack.strip('\x0b\x1c\r').split('\r'):
+        if segment.startswith('ERR'):
+            return segment.split('|')
+    return None
+
+
+class BuildAckTest(unittest.TestCase):
+
+    def test_fields_are_swapped(self):
+        ack = build_ack(MSHHeader(message('42', version='2.4')), 'AA', text='ok')
+        self.assertTrue(ack.startswith('\x0bMSH|^~\\&|SPLUNK|SPLUNKFAC|APP|FAC|'))
+        self.assertTrue(ack.endswith('\x1c\r'))
+        self.assertEqual(msa(ack), ('AA', '42'))
+        self.assertIn('|ACK||P|2.4\rMSA|AA|42|ok\r', ack)
+
+    def test_without_mllp(self):
+        ack = build_ack(MSHHeader(message()), 'AE', mllp=False)
+        self.assertTrue(ack.startswith('MSH|'))
+        self.assertTrue(ack.endswith('\r'))
+        self.assertNotIn('\x1c', ack)
+
+    def test_text_is_escaped(self):
+        ack = build_ack(MSHHeader(message()), 'AE', text='a|b^c')
+        self.assertIn('MSA|AE|1|a\\F\\b\\S\\c\r', ack)
+
+    def test_invalid_code(self):
+        self.assertRaises(ValueError, build_ack, MSHHeader(message()), 'XX')
+
+    def test_error_segment_by_version(self):
+        for version, v25 in (('2.3', False), ('2.4', False), ('2.5', True), ('2.5.1', True),
+                             ('2.10', True), ('2.6^ISO', True), ('', False)):
+            err = err_segment(build_ack(MSHHeader(message(version=version)), 'AE', error='bad'))
+            if v25:
+                self.assertEqual(err[3], '207^Application internal error^HL70357', version)
+                self.assertEqual(err[8], 'bad', version)
+            else:
+                self.assertEqual(err[1], '^^^207&bad&HL70357', version)
+
+    def test_version_number(self):
+        self.assertEqual(MSHHeader(message(version='2.5.1')).version_number, (2, 5, 1))
+        self.assertEqual(MSHHeader(message(version='2.10^ISO')).version_number, (2, 10))
+        self.assertEqual(MSHHeader(message(version='')).version_number, ())
+        self.assertTrue(MSHHeader(message(version='2.10')).version_number > (2, 9))
+
+
+class AckRequiredTest(unittest.TestCase):
+
+    def test_rules(self):
+        expected = {
+            'AL': ('CA', 'CE', 'CR', 'AA', 'AE', 'AR'),
+            '': ('CA', 'CE', 'CR', 'AA', 'AE', 'AR'),
+            'XX': ('CA', 'CE', 'CR', 'AA', 'AE', 'AR'),
+            'NE': (),
+            'ER': ('CE', 'CR', 'AE', 'AR'),
+            'SU': ('CA', 'AA'),
+        }
+        for ack_type, required in expected.items():
+            for code in ('CA', 'CE', 'CR', 'AA', 'AE', 'AR'):
+                self.assertEqual(ack_required(ack_type, code), code in required, (ack_type, code))
+                self.assertEqual(ack_required(ack_type.lower(), code), code in required, (ack_type, code))
+
+
+class InvalidSegmentTest(unittest.TestCase):
+
+    def test_valid_message(self):
+        msg = message(segments=('EVN|A01', 'PID|1||123', 'ZPD|x', 'NTE'))
+        self.assertIsNone(MSHHeader(msg).invalid_segment(msg))
+
+    def test_crlf_and_trailing_separators(self):
+        msg = message(segments=('PID|1', 'PV1|1')).replace('\r', '\r\n') + '\r\r'
+        self.assertIsNone(MSHHeader(msg).invalid_segment(msg))
+
+    def test_corrupt_segments(self):
+        for segment in ('pid|1', 'PI|1', 'PIDX|1', 'P1D^1', '\x00\x00\x00', '1||123^^^HOSP'):
+            msg = message(segments=('EVN|A01', segment, 'PV1|1'))
+            self.assertEqual(MSHHeader(msg).invalid_segment(msg), segment)
+
+    def test_other_field_separator(self):
+        msg = message(segments=('PID|1',)).replace('|', '#')
+        self.assertIsNone(MSHHeader(msg).invalid_segment(msg))
+        self.assertEqual(MSHHeader(msg).invalid_segment(msg + 'PID|1\r'), 'PID|1')
+
+
+class CatchAllHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.module = import_modular_input()
+        self.mi = self.module.MyInput()
+
+    def reply(self, msg):
+        return self.module.CatchAllHandler(None, msg, self.mi).reply()
+
+    def queued(self):
+        return self.mi._queue.stats()['messages']
+
+    def test_valid_message_is_accepted(self):
+        self.assertEqual(msa(self.reply(message('1'))), ('AA', '1'))
+        self.assertEqual(self.queued(), 1)
+
+    def test_corrupt_body_is_refused(self):
+        ack = self.reply(message('2', segments=('PID|1', '\x00garbage')))
+        self.assertEqual(msa(ack), ('AE', '2'))
+        self.assertIn('invalid segment', ack)
+        self.assertEqual(self.queued(), 0)
+
+    def test_corrupt_body_in_enhanced_mode(self):
+        # the enhanced mode needs durable_spool
+        self.mi.spool = MessageSpool(os.path.join(temp_dir(self), 'spool'))
+        self.addCleanup(self.mi.spool.close)
+        msg = message('3', accept_ack_type='AL', segments=('PID|1', 'truncated'))
+        self.assertEqual(msa(self.reply(msg)), ('CE', '3'))
+        msg = message('4', accept_ack_type='SU', segments=('PID|1', 'truncated'))
+        self.assertIsNone(self.reply(msg))
+        self.assertEqual(self.queued(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import threading
+import time
+import unittest
+
+from backpressure import WatermarkQueue
+
+from tests.support import import_modular_input, message, msa
+
+
+class WatermarkQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.events = []
+        self.queue = WatermarkQueue(high_messages=5, low_messages=2,
+                                    listener=lambda q: self.events.append(q.throttled))
+
+    def test_throttle_and_release_with_hysteresis(self):
+        for i in range(4):
+            self.queue.put(i)
+        self.assertFalse(self.queue.throttled)
+        self.queue.put(4)
+        self.assertTrue(self.queue.throttled)
+        self.assertFalse(self.queue.has_room())
+
+        # still throttled between the watermarks
+        self.queue.get()
+        self.queue.get()
+        self.assertTrue(self.queue.throttled)
+        self.queue.put(5)
+        self.queue.get()
+        self.assertTrue(self.queue.throttled)
+        self.queue.get()
+        self.assertFalse(self.queue.throttled)
+        self.assertEqual(self.events, [True, False])
+        self.assertEqual(self.queue.stats()['throttle_events'], 1)
+        self.assertEqual([self.queue.get() for i in range(2)], [4, 5])
+
+    def test_byte_watermarks(self):
+        queue = WatermarkQueue(high_bytes=100)
+        self.assertEqual(queue.low_bytes, 80)
+        queue.put('a', 60)
+        queue.put('b', 50)
+        self.assertTrue(queue.throttled)
+        queue.get()
+        self.assertFalse(queue.throttled)
+        self.assertEqual(queue.stats()['bytes'], 50)
+
+    def test_throttled_until_both_are_below_low(self):
+        queue = WatermarkQueue(high_messages=3, low_messages=1, high_bytes=100, low_bytes=10)
+        queue.put('a', 1)
+        queue.put('b', 100)
+        self.assertTrue(queue.throttled)
+        queue.get()
+        # one message is at its low watermark, but the bytes aren't
+        self.assertTrue(queue.throttled)
+        queue.get()
+        self.assertFalse(queue.throttled)
+
+    def test_wait_for_room_times_out(self):
+        for i in range(5):
+            self.queue.put(i)
+        started = time.time()
+        self.assertFalse(self.queue.wait_for_room(0.2))
+        self.assertGreaterEqual(time.time() - started, 0.18)
+        self.assertEqual(self.queue.stats()['held'], 1)
+
+    def test_release_wakes_the_producers(self):
+        for i in range(5):
+            self.queue.put(i)
+        results = []
+        producers = [threading.Thread(target=lambda: results.append(self.queue.wait_for_room(5))) for i in range(3)]
+        for producer in producers:
+            producer.start()
+        time.sleep(0.1)
+        self.assertEqual(results, [])
+        for i in range(3):
+            self.queue.get()
+        for producer in producers:
+            producer.join(5)
+        self.assertEqual(results, [True] * 3)
+        self.assertEqual(self.queue.stats()['held'], 3)
+        self.assertGreater(self.queue.stats()['throttled_seconds'], 0)
+
+    def test_get_from_an_empty_queue(self):
+        self.assertRaises(IndexError, self.queue.get, 0)
+        started = time.time()
+        self.assertRaises(IndexError, self.queue.get, 0.1)
+        self.assertGreaterEqual(time.time() - started, 0.08)
+
+
+class BackpressurePolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        module = import_modular_input()
+        self.module = module
+        self.mi = module.MyInput()
+        self.mi.backpressure_hold_timeout = 0.2
+        self.mi._queue.set_watermarks(high_messages=2, low_messages=0)
+
+    def reply(self, control_id):
+        return msa(self.module.CatchAllHandler(None, message(control_id), self.mi).reply())
+
+    def test_negative_ack_policy(self):
+        self.mi.configure_queue({'queue_high_messages': 2, 'queue_low_messages': 0, 'backpressure': 'ar'})
+        self.assertEqual([self.reply(str(i)) for i in range(3)], [('AA', '0'), ('AA', '1'), ('AR', '2')])
+        self.assertEqual(self.mi._queue.stats()['rejected'], 1)
+
+    def test_hold_policy(self):
+        self.assertEqual([self.reply(str(i)) for i in range(2)], [('AA', '0'), ('AA', '1')])
+        started = time.time()
+        self.assertEqual(self.reply('2'), ('AE', '2'))
+        self.assertGreaterEqual(time.time() - started, 0.18)
+
+        threading.Timer(0.1, lambda: [self.mi._queue.get() for i in range(2)]).start()
+        self.assertEqual(self.reply('3'), ('AA', '3'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import io
+import os
+import threading
+import time
+import unittest
+
+from hl7apy.batch import BatchHeader, BatchReader, InvalidBatch, build_batch_ack
+
+from tests.support import import_modular_input, message, temp_dir, wait_until
+
+
+def batch(messages, bts_count=None, fts_count=None, file_envelope=True):
+    segments = []
+    if file_envelope:
+        segments.append('FHS|^~\\&|APP|FAC|SPLUNK|SPLUNKFAC|20200101||||F1')
+    segments.append('BHS|^~\\&|APP|FAC|SPLUNK|SPLUNKFAC|20200101||||B1')
+    segments += [m.rstrip('\r') for m in messages]
+    segments.append('BTS|%s' % (len(messages) if bts_count is None else bts_count))
+    if file_envelope:
+        segments.append('FTS|%s' % (1 if fts_count is None else fts_count))
+    return '\r'.join(segments) + '\r'
+
+
+class BatchReaderTest(unittest.TestCase):
+
+    def test_messages_are_streamed(self):
+        messages = [message(str(i)) for i in range(5)]
+        data = batch(messages).replace('\r', '\r\n').encode('utf-8')
+        reader = BatchReader(io.BytesIO(data), chunk_size=7)
+        self.assertEqual(list(reader), messages)
+        self.assertEqual((reader.messages, reader.batches, reader.errors), (5, 1, []))
+        self.assertEqual(reader.file_header.control_id, 'F1')
+        self.assertEqual(reader.batch_header.control_id, 'B1')
+
+    def test_plain_messages_and_mllp_characters(self):
+        messages = [message(str(i)) for i in range(3)]
+        data = ''.join('\x0b' + m + '\x1c\r' for m in messages)
+        self.assertEqual(list(BatchReader(data)), messages)
+
+    def test_count_errors(self):
+        messages = [message(str(i)) for i in range(3)]
+        for data, error in ((batch(messages, bts_count=4), 'BTS-1 count is 4 but 3 were found'),
+                            (batch(messages, fts_count=2), 'FTS-1 count is 2 but 1 were found'),
+                            (batch(messages, bts_count='three'), 'Invalid BTS-1 count three')):
+            reader = BatchReader(data)
+            with self.assertRaises(InvalidBatch) as raised:
+                list(reader)
+            self.assertEqual(str(raised.exception), error)
+            # the messages before the trailer have been read
+            self.assertEqual(reader.messages, 3)
+
+            reader = BatchReader(data, strict=False)
+            self.assertEqual(list(reader), messages)
+            self.assertEqual(reader.errors, [error])
+
+    def test_empty_count_is_not_checked(self):
+        reader = BatchReader(batch([message()], bts_count='', fts_count=''))
+        self.assertEqual(len(list(reader)), 1)
+
+    def test_envelope_errors(self):
+        for data, error in (
+                (batch([message()]).replace('BTS|1\r', ''), 'Missing BTS segment before FTS'),
+                (batch([message()]).replace('FTS|1\r', ''), 'Missing FTS segment'),
+                ('PID|1\r' + message(), 'Segment PID outside of a message'),
+                ('BHS|^~\\&\r' + batch([message()], file_envelope=False), 'Missing BTS segment before BHS')):
+            reader = BatchReader(data, strict=False)
+            list(reader)
+            self.assertIn(error, reader.errors)
+
+    def test_invalid_header(self):
+        self.assertRaises(InvalidBatch, BatchHeader, 'MSH|^~\\&')
+
+
+class BatchAckTest(unittest.TestCase):
+
+    def test_ack_references_the_batch(self):
+        reader = BatchReader(batch([message()]))
+        list(reader)
+        ack = build_batch_ack(reader.file_header, reader.batch_header, 'a|b', mllp=False).split('\r')
+        self.assertEqual(ack[0].split('|')[2:6], ['SPLUNK', 'SPLUNKFAC', 'APP', 'FAC'])
+        # FHS-12 and BHS-12 reference the control ids of the batch
+        self.assertEqual(ack[0].split('|')[11], 'F1')
+        self.assertEqual(ack[1].split('|')[11], 'B1')
+        self.assertEqual(ack[2:], ['BTS|0|a b', 'FTS|1', ''])
+
+    def test_ack_without_envelope(self):
+        self.assertEqual(build_batch_ack(), '\x0bBHS|^~\\&\rBTS|0\r\x1c\r')
+
+
+class BatchBackpressureTest(unittest.TestCase):
+
+    def setUp(self):
+        module = import_modular_input()
+        self.module = module
+        self.mi = module.MyInput()
+        self.mi.backpressure_hold_timeout = 0.2
+        self.mi.drain_timeout = 0.4
+        self.mi._queue.set_watermarks(high_messages=1, low_messages=0)
+
+    def reply(self, data):
+        return self.module.CatchAllHandler(None, data, self.mi).reply()
+
+    def test_batch_is_accepted_when_the_queue_has_room(self):
+        ack = self.reply(batch([message('1'), message('2')]))
+        self.assertIn('BTS|0', ack)
+        self.assertEqual(self.mi._queue.qsize(), 2)
+
+    def test_batch_is_not_acknowledged_while_throttled(self):
+        self.reply(batch([message('1')]))
+        self.assertTrue(self.mi._queue.throttled)
+        started = time.time()
+        self.assertIsNone(self.reply(batch([message('2')])))
+        self.assertAlmostEqual(time.time() - started, 0.2, delta=0.15)
+        self.assertEqual(self.mi._queue.qsize(), 1)
+        self.assertEqual(self.mi._queue.stats()['rejected'], 1)
+
+    def test_drain_timeout_applies_while_stopping(self):
+        self.reply(batch([message('1')]))
+        self.mi.stop_requested = True
+        started = time.time()
+        self.assertFalse(self.mi.wait_for_batch_room())
+        self.assertAlmostEqual(time.time() - started, 0.4, delta=0.15)
+
+    def test_batch_waits_for_the_rate_limit_of_its_sender(self):
+        self.mi._queue.set_watermarks(high_messages=10, low_messages=0)
+        self.mi.rate_limits = {'FAC': 5}
+        started = time.time()
+        ack = self.reply(batch([message(str(i)) for i in range(7)]))
+        # 5 messages in the burst, then one every 0.2 seconds
+        self.assertAlmostEqual(time.time() - started, 0.4, delta=0.15)
+        self.assertIn('BTS|0', ack)
+        self.assertEqual(self.mi._queue.qsize(), 7)
+
+    def test_batch_is_not_acknowledged_once_stopping(self):
+        self.mi._queue.set_watermarks(high_messages=10, low_messages=0)
+        self.mi.rate_limits = {'FAC': 1}
+        threading.Timer(0.2, setattr, (self.mi, 'stop_requested', True)).start()
+        self.assertIsNone(self.reply(batch([message('1'), message('2')])))
+        self.assertEqual(self.mi._queue.qsize(), 1)
+
+
+class BatchFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.mi = import_modular_input().MyInput()
+        self.directory = temp_dir(self)
+        self.path = os.path.join(self.directory, 'batch.hl7')
+
+    def write(self, data):
+        with open(self.path, 'wb') as f:
+            f.write(data.encode('utf-8'))
+
+    def control_ids(self):
+        ids = []
+        while self.mi._queue.qsize():
+            ids.append(self.mi._queue.get(0)[1].control_id)
+        return ids
+
+    def test_file_is_read_and_its_checkpoint_removed(self):
+        self.mi.batch_checkpoint_interval = 2
+        self.write(batch([message(str(i)) for i in range(5)]))
+        reader = self.mi.ingest_batch_file(self.path)
+        self.assertEqual((reader.messages, reader.batches), (5, 1))
+        self.assertEqual(self.control_ids(), ['0', '1', '2', '3', '4'])
+        self.assertEqual(os.listdir(self.directory), ['batch.hl7'])
+
+    def test_counts_are_checked_before_accepting_anything(self):
+        self.write(batch([message(str(i)) for i in range(3)], bts_count=4))
+        self.assertRaises(InvalidBatch, self.mi.ingest_batch_file, self.path)
+        self.assertEqual(self.mi._queue.qsize(), 0)
+
+    def test_stopped_file_is_resumed_from_its_checkpoint(self):
+        self.mi._queue.set_watermarks(high_messages=2, low_messages=0)
+        self.write(batch([message(str(i)) for i in range(5)]))
+        result = []
+        thread = threading.Thread(target=lambda: result.append(self.mi.ingest_batch_file(self.path)))
+        thread.daemon = True
+        thread.start()
+        # held by the throttled queue after 2 messages
+        wait_until(lambda: self.mi._queue.throttled)
+        self.mi.stop_requested = True
+        thread.join(5)
+        self.assertEqual(result, [None])
+        self.assertIsNone(self.mi.batch_file)
+        self.assertEqual(self.control_ids(), ['0', '1'])
+
+        self.mi.stop_requested = False
+        self.mi._queue.set_watermarks(high_messages=10, low_messages=0)
+        reader = self.mi.ingest_batch_file(self.path)
+        self.assertEqual(reader.messages, 5)
+        self.assertEqual(self.control_ids(), ['2', '3', '4'])
+        self.assertEqual(os.listdir(self.directory), ['batch.hl7'])
+
+    def test_stopped_file_stays_in_the_directory(self):
+        self.mi.sleep_interval = 0
+        self.write(batch([message()]))
+        # the input stops while the file is being read
+        self.mi.ingest_batch_file = lambda path: setattr(self.mi, 'stop_requested', True)
+        self.mi.poll_batch_directory('stanza', self.directory)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['batch.hl7', 'failed', 'processed'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import time
+import unittest
+
+from dedupe import BloomFilter, DuplicateFilter
+from hl7apy.mllp import MSHHeader
+
+from tests.support import import_modular_input, message, msa, temp_dir
+
+
+def key(control_id, application='APP', facility='FAC'):
+    return application, facility, control_id
+
+
+class DuplicateFilterTest(unittest.TestCase):
+
+    def test_key(self):
+        self.assertEqual(DuplicateFilter.key(MSHHeader(message('42', sending_application='LAB'))),
+                         ('LAB', 'FAC', '42'))
+
+    def test_ack_is_replayed(self):
+        dedupe = DuplicateFilter(10)
+        self.assertEqual(dedupe.check(key('1')), (False, None))
+        dedupe.remember(key('1'), 'ACK 1')
+        self.assertEqual(dedupe.check(key('1')), (True, 'ACK 1'))
+        # the same control id from another sender is a different message
+        self.assertEqual(dedupe.check(key('1', facility='OTHER')), (False, None))
+        self.assertEqual(dedupe.stats(), {'APP|FAC': 1})
+
+    def test_least_recently_used_are_forgotten(self):
+        dedupe = DuplicateFilter(2)
+        dedupe.remember(key('1'), 'ACK 1')
+        dedupe.remember(key('2'), 'ACK 2')
+        # a duplicate becomes the most recently used
+        dedupe.check(key('1'))
+        dedupe.remember(key('3'), 'ACK 3')
+        self.assertEqual(dedupe.check(key('2')), (False, None))
+        self.assertEqual(dedupe.check(key('1')), (True, 'ACK 1'))
+        self.assertEqual(dedupe.check(key('3')), (True, 'ACK 3'))
+
+    def test_older_messages_are_found_in_the_bloom_filter(self):
+        dedupe = DuplicateFilter(1, BloomFilter(os.path.join(temp_dir(self), 'filter'), capacity=100))
+        self.addCleanup(dedupe.close)
+        dedupe.remember(key('1'), 'ACK 1')
+        dedupe.remember(key('2'), 'ACK 2')
+        self.assertEqual(dedupe.check(key('1')), (True, None))
+        self.assertEqual(dedupe.check(key('2')), (True, 'ACK 2'))
+        self.assertEqual(dedupe.check(key('3')), (False, None))
+        # only the messages in the cache are duplicates for certain
+        self.assertFalse(dedupe.cached(key('1')))
+        self.assertTrue(dedupe.cached(key('2')))
+
+
+class BloomFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(temp_dir(self), 'filter')
+
+    def keys(self, start, stop):
+        return [('key %d' % i).encode('ascii') for i in range(start, stop)]
+
+    def test_keys_survive_a_restart(self):
+        bloom = BloomFilter(self.path, capacity=1000)
+        for k in self.keys(0, 500):
+            bloom.add(k)
+        bloom.close()
+
+        bloom = BloomFilter(self.path, capacity=1000)
+        self.addCleanup(bloom.close)
+        self.assertTrue(all(k in bloom for k in self.keys(0, 500)))
+        self.assertLessEqual(sum(k in bloom for k in self.keys(500, 1500)), 2)
+
+    def test_file_of_another_size_is_replaced(self):
+        bloom = BloomFilter(self.path, capacity=1000)
+        bloom.add(b'key')
+        bloom.close()
+        bloom = BloomFilter(self.path, capacity=2000)
+        self.addCleanup(bloom.close)
+        self.assertNotIn(b'key', bloom)
+
+    def test_corrupt_header_is_reset(self):
+        bloom = BloomFilter(self.path, capacity=100)
+        bloom.add(b'key')
+        bloom.close()
+        with open(self.path, 'r+b') as f:
+            f.write(b'XXXX')
+        bloom = BloomFilter(self.path, capacity=100)
+        self.addCleanup(bloom.close)
+        self.assertNotIn(b'key', bloom)
+
+    def test_generations(self):
+        bloom = BloomFilter(self.path, capacity=10)
+        self.addCleanup(bloom.close)
+        for k in self.keys(0, 25):
+            bloom.add(k)
+        # at least the last capacity keys are remembered, the older generation has been cleared
+        self.assertTrue(all(k in bloom for k in self.keys(10, 25)))
+        self.assertLessEqual(sum(k in bloom for k in self.keys(0, 10)), 1)
+
+
+class AckReplayTest(unittest.TestCase):
+
+    def test_retransmission_gets_the_first_ack(self):
+        module = import_modular_input()
+        mi = module.MyInput()
+        mi.dedupe = DuplicateFilter(10)
+
+        def reply(msg):
+            return module.CatchAllHandler(None, msg, mi).reply()
+
+        first = reply(message('1'))
+        time.sleep(1.1)
+        self.assertEqual(reply(message('1')), first)
+        self.assertEqual(msa(reply(message('2'))), ('AA', '2'))
+        self.assertEqual(mi._queue.qsize(), 2)
+        self.assertEqual(mi.dedupe.stats(), {'APP|FAC': 1})
+
+
+class DedupeSettingsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.module = import_modular_input()
+        self.mi = self.module.MyInput()
+
+    def validate(self, **parameters):
+        return self.mi.validate_parameters('stanza', parameters)
+
+    def test_listener_processes_are_refused(self):
+        self.assertRaises(self.module.FieldValidationException, self.validate, dedupe_cache_size='100',
+                          listener_processes='2')
+        self.assertEqual(self.validate(dedupe_cache_size='100', listener_processes='1')['dedupe_cache_size'], 100)
+        # listener_processes is ignored with unix_socket
+        self.validate(dedupe_cache_size='100', listener_processes='2', unix_socket='/tmp/hl7.sock')
+
+    def test_error_rate(self):
+        for rate in ('0', '1', 'x'):
+            self.assertRaises(self.module.FieldValidationException, self.validate, dedupe_filter_error_rate=rate)
+        self.validate(dedupe_filter_error_rate='0.000001')
+
+        directory = temp_dir(self)
+        dedupe = self.mi.open_dedupe({'dedupe_cache_size': 10, 'dedupe_persistent': True}, directory, 'stanza')
+        self.addCleanup(dedupe.close)
+        self.assertEqual(dedupe.bloom_filter.error_rate, 0.0000001)
+        dedupe = self.mi.open_dedupe({'dedupe_cache_size': 10, 'dedupe_persistent': True,
+                                      'dedupe_filter_error_rate': '0.001'}, directory, 'other')
+        self.addCleanup(dedupe.close)
+        self.assertEqual(dedupe.bloom_filter.error_rate, 0.001)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import threading
+import time
+import unittest
+
+from hl7apy.mllp import MLLPServer, PooledMLLPServer, WorkerSupervisor
+
+from tests.support import AckHandler, SlowAckHandler, closed_by_peer, connect, frame, import_modular_input, \
+    message, msa, read_messages, wait_until
+
+
+class DrainTest(unittest.TestCase):
+
+    def start(self, server):
+        thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        return server.server_address
+
+    def busy(self, server, address, count):
+        socks = []
+        for i in range(count):
+            sock = connect(self, address)
+            sock.sendall(frame(message(str(i))))
+            socks.append(sock)
+        self.assertTrue(wait_until(lambda: len(server._served) == count))
+        return socks
+
+    def check_drain(self, server):
+        address = self.start(server)
+        socks = self.busy(server, address, 2)
+        self.assertEqual(server.drain(5), {'drained': 2, 'abandoned': 0})
+        self.assertEqual([msa(read_messages(sock, 1)[0]) for sock in socks], [('AA', '0'), ('AA', '1')])
+        # new connections are refused
+        self.assertRaises(Exception, connect, self, address)
+
+    def check_abandon(self, server):
+        address = self.start(server)
+        sock = self.busy(server, address, 1)[0]
+        started = time.time()
+        self.assertEqual(server.drain(0.2), {'drained': 0, 'abandoned': 1})
+        self.assertLess(time.time() - started, SlowAckHandler.delay)
+        self.assertTrue(closed_by_peer(sock))
+        # the handler completing later doesn't count the connection as drained
+        time.sleep(SlowAckHandler.delay)
+        self.assertEqual((server.drained, server.abandoned), (0, 1))
+
+    def test_threaded_server_drains(self):
+        self.check_drain(MLLPServer('127.0.0.1', 0, {'*': (SlowAckHandler,)}))
+
+    def test_pooled_server_drains(self):
+        self.check_drain(PooledMLLPServer('127.0.0.1', 0, {'*': (SlowAckHandler,)}, max_workers=2))
+
+    def test_threaded_server_abandons_after_the_timeout(self):
+        self.check_abandon(MLLPServer('127.0.0.1', 0, {'*': (SlowAckHandler,)}))
+
+    def test_pooled_server_abandons_after_the_timeout(self):
+        self.check_abandon(PooledMLLPServer('127.0.0.1', 0, {'*': (SlowAckHandler,)}, max_workers=1))
+
+
+def sleep_forever(index):
+    while True:
+        time.sleep(1)
+
+
+class StopRequestTest(unittest.TestCase):
+
+    def test_stop_request_doesnt_join_the_listener_processes(self):
+        module = import_modular_input()
+        mi = module.MyInput()
+        supervisor = WorkerSupervisor(sleep_forever, 2)
+        self.addCleanup(supervisor.stop)
+        supervisor.start()
+        mi.supervisor = supervisor
+        mi.request_stop()
+        self.assertTrue(mi.stop_requested)
+        self.assertTrue(wait_until(lambda: supervisor.alive() == 0))
+        supervisor.supervise()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import threading
+import time
+import unittest
+
+import mllp2
+from hl7apy.mllp import AbstractHandler, MLLPServer, MSHHeader
+from spool import MessageSpool
+
+from tests.support import AckHandler, closed_by_peer, connect, frame, import_modular_input, message, msa, \
+    read_messages, serve, temp_dir, wait_until
+
+
+class SilentHandler(AbstractHandler):
+    """
+    Never answers
+    """
+    def reply(self):
+        return None
+
+
+class RecordingHandler(AbstractHandler):
+    """
+    Records the messages received, without answering
+    """
+    received = None
+
+    def reply(self):
+        self.received.append(self.incoming_message)
+        return None
+
+
+def open_spool(testcase, mi):
+    mi.spool = MessageSpool(os.path.join(temp_dir(testcase), 'spool'))
+    testcase.addCleanup(mi.spool.close)
+
+
+class MSHHeaderTest(unittest.TestCase):
+
+    def test_original_mode(self):
+        header = MSHHeader(message('1'))
+        self.assertEqual((header.accept_ack_type, header.application_ack_type), ('', ''))
+        self.assertFalse(header.enhanced_mode)
+
+    def test_enhanced_mode(self):
+        header = MSHHeader(message('1', accept_ack_type='AL', application_ack_type='ER'))
+        self.assertEqual((header.accept_ack_type, header.application_ack_type), ('AL', 'ER'))
+        self.assertTrue(header.enhanced_mode)
+        self.assertTrue(MSHHeader(message('1', application_ack_type='NE')).enhanced_mode)
+
+
+class NoResponseTest(unittest.TestCase):
+
+    handlers = {'ADT^A01': (AckHandler,), 'ADT^A08': (SilentHandler,)}
+
+    def test_nothing_is_sent(self):
+        address = serve(self, MLLPServer('127.0.0.1', 0, self.handlers))
+        sock = connect(self, address)
+        sock.sendall(frame(message('1', 'ADT^A08')))
+        self.assertTrue(closed_by_peer(sock))
+
+    def test_only_the_responses_are_sent_on_a_persistent_connection(self):
+        address = serve(self, mllp2.MLLPServer('127.0.0.1', 0, self.handlers))
+        sock = connect(self, address)
+        sock.sendall(frame(message('1', 'ADT^A01')) + frame(message('2', 'ADT^A08')) +
+                     frame(message('3', 'ADT^A01')))
+        self.assertEqual([msa(ack) for ack in read_messages(sock, 2)], [('AA', '1'), ('AA', '3')])
+
+
+class CommitAckTest(unittest.TestCase):
+
+    def setUp(self):
+        self.module = import_modular_input()
+        self.mi = self.module.MyInput()
+        open_spool(self, self.mi)
+
+    def reply(self, msg):
+        return self.module.CatchAllHandler(None, msg, self.mi).reply()
+
+    def test_original_mode_gets_one_application_ack(self):
+        self.assertEqual(msa(self.reply(message('1'))), ('AA', '1'))
+
+    def test_commit_ack(self):
+        self.assertEqual(msa(self.reply(message('1', accept_ack_type='AL'))), ('CA', '1'))
+        self.assertEqual(msa(self.reply(message('2', accept_ack_type='SU'))), ('CA', '2'))
+        self.assertIsNone(self.reply(message('3', accept_ack_type='NE')))
+        self.assertIsNone(self.reply(message('4', accept_ack_type='ER')))
+        # the message is queued even if the sender didn't want the commit ACK
+        self.assertEqual(self.mi._queue.qsize(), 4)
+
+    def test_refused_message(self):
+        self.mi.configure_queue({'backpressure': 'AR', 'queue_high_messages': 1, 'queue_low_messages': 1})
+        self.assertIsNone(self.reply(message('1', accept_ack_type='ER')))
+        self.assertEqual(msa(self.reply(message('2', accept_ack_type='ER'))), ('CR', '2'))
+        self.assertIsNone(self.reply(message('3', accept_ack_type='SU')))
+        self.assertEqual(msa(self.reply(message('4'))), ('AR', '4'))
+        self.assertEqual(self.mi._queue.qsize(), 1)
+
+    def test_original_mode_without_durable_spool(self):
+        self.mi.spool = None
+        self.mi.ack_destinations = {'*': ('127.0.0.1', 1)}
+        self.assertEqual(msa(self.reply(message('1', accept_ack_type='AL', application_ack_type='AL'))),
+                         ('AA', '1'))
+        self.assertEqual(msa(self.reply(message('2', accept_ack_type='NE'))), ('AA', '2'))
+        self.assertTrue(self.mi.enhanced_mode_refused)
+        # no application ACK either, the sender already got an AA
+        self.mi.output_event = lambda out, stanza, **kwargs: None
+        item = self.mi._queue.get(0)
+        self.mi.write_message(item, 'hl7://test', 'hl7', None, 'main')
+        self.assertEqual(self.mi._application_acks.unfinished_tasks, 0)
+
+
+class ApplicationAckTest(unittest.TestCase):
+
+    def setUp(self):
+        self.module = import_modular_input()
+        self.mi = self.module.MyInput()
+        open_spool(self, self.mi)
+        self.addCleanup(lambda: self.mi.ack_client is not None and self.mi.ack_client.close())
+        self.received = []
+        handler = type(str('Handler'), (RecordingHandler,), {'received': self.received})
+        # like most receivers, the destination doesn't answer the application ACKs and keeps the connection open
+        self.address = serve(self, mllp2.MLLPServer('127.0.0.1', 0, {'ACK': (handler,)}))
+
+    def configure(self, destinations):
+        self.mi.configure_application_acks({'application_ack_destinations': destinations})
+
+    def test_sent_to_the_destination_of_the_facility(self):
+        self.configure('LAB=127.0.0.1:%d,*=127.0.0.1:1' % self.address[1])
+        self.mi.send_application_ack(MSHHeader(message('1', sending_facility='LAB', application_ack_type='AL')),
+                                     'AA', text='indexed')
+        self.assertTrue(wait_until(lambda: self.received))
+        ack = self.received[0]
+        self.assertEqual(msa(ack), ('AA', '1'))
+        self.assertIn('MSH|^~\\&|SPLUNK|SPLUNKFAC|APP|LAB|', ack)
+        self.assertTrue(wait_until(lambda: not self.mi._application_acks.unfinished_tasks))
+
+    def test_ack_type_and_missing_destination(self):
+        self.configure('LAB=127.0.0.1:%d' % self.address[1])
+        self.mi.send_application_ack(MSHHeader(message('1', sending_facility='LAB', application_ack_type='ER')),
+                                     'AA')
+        self.mi.send_application_ack(MSHHeader(message('2', sending_facility='LAB', application_ack_type='NE')),
+                                     'AE')
+        self.mi.send_application_ack(MSHHeader(message('3', sending_facility='RAD', application_ack_type='AL')),
+                                     'AA')
+        self.assertEqual(self.mi._application_acks.unfinished_tasks, 0)
+        self.mi.send_application_ack(MSHHeader(message('4', sending_facility='LAB', application_ack_type='ER')),
+                                     'AE')
+        self.assertTrue(wait_until(lambda: self.received))
+        self.assertEqual([msa(ack) for ack in self.received], [('AE', '4')])
+
+    def test_written_message_is_acknowledged(self):
+        self.configure('*=127.0.0.1:%d' % self.address[1])
+        events = []
+        self.mi.output_event = lambda out, stanza, **kwargs: events.append(out)
+        for control_id, body in (('1', ('PID|1||123',)), ('2', ('PID|1||456',))):
+            msg = message(control_id, accept_ack_type='AL', application_ack_type='AL', segments=body)
+            self.mi.write_message((msg, MSHHeader(msg), None, None), 'hl7://test', 'hl7', None, 'main')
+        self.assertEqual(len(events), 2)
+        self.assertTrue(wait_until(lambda: len(self.received) == 2))
+        self.assertEqual(sorted(msa(ack) for ack in self.received), [('AA', '1'), ('AA', '2')])
+
+    def test_acks_dont_wait_for_an_answer(self):
+        self.configure('*=127.0.0.1:%d' % self.address[1])
+        started = time.time()
+        for control_id in '123':
+            self.mi.send_application_ack(MSHHeader(message(control_id, application_ack_type='AL')), 'AA')
+        self.assertTrue(wait_until(lambda: not self.mi._application_acks.unfinished_tasks))
+        self.assertTrue(wait_until(lambda: len(self.received) == 3))
+        # far below the 10 seconds the client would wait for every answer
+        self.assertLess(time.time() - started, 2)
+        self.assertEqual([msa(ack) for ack in self.received], [('AA', '1'), ('AA', '2'), ('AA', '3')])
+        # on the same connection
+        self.assertEqual(self.mi.ack_client.reconnects, 0)
+        self.assertEqual(len(self.mi.ack_client._pools[('127.0.0.1', self.address[1])]), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
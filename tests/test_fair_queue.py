@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import time
+import unittest
+
+from backpressure import FairQueue, TokenBucket
+from hl7apy.mllp import AbstractHandler, MLLPServer, MSHHeader, build_ack, current_peer
+
+from tests.support import connect, frame, import_modular_input, message, msa, read_messages, serve
+
+
+class PeerHandler(AbstractHandler):
+    """
+    Replies with the peer of the connection in MSA-3
+    """
+    def reply(self):
+        return build_ack(MSHHeader(self.incoming_message), 'AA', text='%s:%s' % current_peer())
+
+
+class FairQueueTest(unittest.TestCase):
+
+    def drain(self, queue):
+        items = []
+        while not queue.empty():
+            items.append(queue.get(0))
+        return items
+
+    def test_weighted_round_robin(self):
+        queue = FairQueue(weights={'A': 2})
+        for i in range(4):
+            queue.put('A%d' % i, sender='A')
+        for i in range(3):
+            queue.put('B%d' % i, sender='B')
+        queue.put('C0', sender='C')
+        self.assertEqual(queue.backlog(), {'A': 4, 'B': 3, 'C': 1})
+        self.assertEqual(self.drain(queue), ['A0', 'A1', 'B0', 'C0', 'A2', 'A3', 'B1', 'B2'])
+
+    def test_every_sender_keeps_its_order(self):
+        queue = FairQueue(default_weight=3)
+        for i in range(10):
+            queue.put(i, sender=i % 3)
+        items = self.drain(queue)
+        for sender in range(3):
+            self.assertEqual([i for i in items if i % 3 == sender], list(range(sender, 10, 3)))
+
+    def test_fair_share_while_throttled(self):
+        queue = FairQueue(high_messages=4, low_messages=1)
+        for i in range(4):
+            queue.put(i, sender='busy')
+        self.assertTrue(queue.throttled)
+        # the busy sender filled the queue, a quiet one still has its share
+        self.assertFalse(queue.has_room('busy'))
+        self.assertTrue(queue.has_room('quiet'))
+        queue.put('q0', sender='quiet')
+        queue.put('q1', sender='quiet')
+        self.assertFalse(queue.has_room('quiet'))
+        self.assertFalse(queue.wait_for_room(0.05, 'busy'))
+        self.assertEqual(queue.qsize(), 6)
+
+    def test_fair_share_of_the_bytes(self):
+        queue = FairQueue(high_bytes=100)
+        queue.put('a', 100, sender='busy')
+        self.assertTrue(queue.throttled)
+        self.assertFalse(queue.has_room('busy'))
+        self.assertTrue(queue.has_room('quiet'))
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst_and_refill(self):
+        bucket = TokenBucket(10, burst=3)
+        self.assertEqual([bucket.consume() for i in range(3)], [0, 0, 0])
+        wait = bucket.consume()
+        self.assertAlmostEqual(wait, 0.1, delta=0.02)
+        self.assertEqual(bucket.limited, 1)
+        time.sleep(wait)
+        self.assertEqual(bucket.consume(), 0)
+
+    def test_default_burst_is_the_rate(self):
+        bucket = TokenBucket(0.5)
+        self.assertEqual(bucket.burst, 1)
+        self.assertEqual(bucket.consume(), 0)
+        self.assertAlmostEqual(bucket.consume(), 2, delta=0.05)
+
+
+class CurrentPeerTest(unittest.TestCase):
+
+    def test_peer_of_the_connection(self):
+        self.assertIsNone(current_peer())
+        address = serve(self, MLLPServer('127.0.0.1', 0, {'*': (PeerHandler,)}))
+        sock = connect(self, address)
+        sock.sendall(frame(message('1')))
+        ack = read_messages(sock, 1)[0]
+        self.assertIn('MSA|AA|1|%s:%s\r' % sock.getsockname(), ack)
+
+
+class RateLimitTest(unittest.TestCase):
+
+    def test_sender_over_its_rate_is_refused(self):
+        module = import_modular_input()
+        mi = module.MyInput()
+        mi.configure_queue({'backpressure': 'AE', 'sender_rate_limits': 'SLOW=1,*=100'})
+
+        def reply(control_id, facility):
+            msg = message(control_id, sending_facility=facility)
+            return msa(module.CatchAllHandler(None, msg, mi).reply())
+
+        self.assertEqual(reply('1', 'SLOW'), ('AA', '1'))
+        self.assertEqual(reply('2', 'SLOW'), ('AE', '2'))
+        self.assertEqual([reply(str(i), 'FAST')[0] for i in range(10)], ['AA'] * 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
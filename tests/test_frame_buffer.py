@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import socket
+import unittest
+
+from hl7apy.mllp import MLLPFrameReader
+
+from tests.support import frame, message
+
+
+class FrameBufferTest(unittest.TestCase):
+
+    def test_frames_are_views_of_the_buffer(self):
+        data = frame(message('1'))
+        reader = MLLPFrameReader(chunk_size=1024)
+        reader.feed(data + data)
+        first = reader.next_frame()
+        self.assertIsInstance(first, memoryview)
+        self.assertEqual(first.tobytes(), data)
+        # the view shares the memory of the buffer instead of copying the frame
+        reader._buffer[1:4] = b'XXX'
+        self.assertEqual(first.tobytes()[1:4], b'XXX')
+        self.assertEqual(reader.next_frame().tobytes(), data)
+
+    def test_buffer_is_reused(self):
+        reader = MLLPFrameReader(chunk_size=256)
+        buffer = reader._buffer
+        for i in range(20):
+            data = frame(message(str(i)))
+            reader.feed(data[:50])
+            reader.feed(data[50:])
+            self.assertEqual(reader.next_frame().tobytes(), data)
+        self.assertIs(reader._buffer, buffer)
+        self.assertEqual(len(buffer), 512)
+
+    def test_pending_bytes_are_moved_to_the_start(self):
+        data = frame(message('1'))
+        reader = MLLPFrameReader(chunk_size=len(data))
+        reader.feed(data + data[:20])
+        self.assertEqual(reader.next_frame().tobytes(), data)
+        reader.feed(data[20:] + data[:30])
+        self.assertEqual(reader.next_frame().tobytes(), data)
+        self.assertEqual(reader.buffered(), 30)
+        # more than the capacity of the buffer was received, but it never held more than a frame
+        self.assertEqual(reader.received, 2 * len(data) + 30)
+        self.assertEqual(len(reader._buffer), 2 * len(data))
+
+    def test_buffer_grows_for_a_large_frame_and_shrinks_back(self):
+        reader = MLLPFrameReader(chunk_size=64)
+        large = frame(message('1', segments=['OBX|%d|TX|||%s' % (i, 'x' * 100) for i in range(50)]))
+        for start in range(0, len(large), 64):
+            reader.feed(large[start:start + 64])
+        self.assertGreaterEqual(len(reader._buffer), len(large))
+        self.assertEqual(reader.next_frame().tobytes(), large)
+        self.assertEqual(len(reader._buffer), 128)
+
+        small = frame(message('2'))
+        reader.feed(small)
+        self.assertEqual(reader.next_frame().tobytes(), small)
+
+    def test_recv_into_the_buffer(self):
+        left, right = socket.socketpair()
+        self.addCleanup(left.close)
+        self.addCleanup(right.close)
+        data = frame(message('1'))
+        reader = MLLPFrameReader(right, chunk_size=32)
+        left.sendall(data * 3)
+        left.close()
+        received = [f.tobytes() for f in reader]
+        self.assertEqual(received, [data] * 3)
+        self.assertEqual(reader.received, len(data) * 3)
+        self.assertTrue(reader.eof)
+        self.assertEqual(reader.fill(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import unittest
+
+import mllp2
+from hl7apy.mllp import FrameLimits, MLLPFrameReader, MLLPServer, OversizedFrame, SpilledFrame, _frame_data
+
+from tests.support import AckHandler, closed_by_peer, connect, frame, message, msa, read_messages, serve, \
+    temp_dir
+
+
+def large_message(control_id, size):
+    return message(control_id, segments=['OBX|%d|TX|||%s' % (i, 'x' * 90) for i in range(size // 100)])
+
+
+class FrameLimitsTest(unittest.TestCase):
+
+    def feed(self, reader, data, chunk=64):
+        for start in range(0, len(data), chunk):
+            reader.feed(data[start:start + chunk])
+            received = reader.next_frame()
+            if received is not None:
+                return received
+        return None
+
+    def test_invalid_oversize_ack(self):
+        self.assertRaises(ValueError, FrameLimits, oversize_ack='AA')
+
+    def test_large_frame_is_spilled(self):
+        directory = temp_dir(self)
+        reader = MLLPFrameReader(chunk_size=64, limits=FrameLimits(spill_size=500, spill_dir=directory))
+        data = frame(large_message('1', 5000))
+        spilled = self.feed(reader, data)
+        self.assertIsInstance(spilled, SpilledFrame)
+        self.assertEqual(len(spilled), len(data))
+        self.assertEqual(bytes(_frame_data(spilled)[:]), data)
+        # the buffer of the connection didn't grow with the frame
+        self.assertEqual(len(reader._buffer), 128)
+        spilled.close()
+
+        small = frame(message('2'))
+        self.assertEqual(self.feed(reader, small).tobytes(), small)
+
+    def test_oversized_frame_is_discarded(self):
+        limits = FrameLimits(max_size=1000, spill_size=500)
+        reader = MLLPFrameReader(chunk_size=64, limits=limits)
+        data = frame(large_message('1', 5000))
+        oversized = self.feed(reader, data)
+        self.assertIsInstance(oversized, OversizedFrame)
+        self.assertEqual(oversized.size, len(data))
+        # the head, up to header_size bytes, is enough to acknowledge the message
+        self.assertTrue(data.startswith(oversized.head))
+        self.assertIn(b'|ADT^A01|1|', oversized.head)
+        self.assertIsNone(reader._spill)
+
+        small = frame(message('2'))
+        self.assertEqual(self.feed(reader, small).tobytes(), small)
+
+    def test_oversized_frame_in_a_single_read(self):
+        reader = MLLPFrameReader(chunk_size=65536, limits=FrameLimits(max_size=1000))
+        data = frame(large_message('1', 5000))
+        reader.feed(data)
+        oversized = reader.next_frame()
+        self.assertIsInstance(oversized, OversizedFrame)
+        self.assertEqual(oversized.size, len(data))
+
+    def test_head_stops_at_the_end_of_the_frame(self):
+        # max_size is below header_size, so the head is the whole frame, not the one that follows it
+        first, second = frame(large_message('1', 1000)), frame(message('2'))
+        reader = MLLPFrameReader(chunk_size=65536, limits=FrameLimits(max_size=len(second)))
+        reader.feed(first + second)
+        oversized = reader.next_frame()
+        self.assertIsInstance(oversized, OversizedFrame)
+        self.assertEqual(oversized.head, first)
+        self.assertEqual(reader.next_frame().tobytes(), second)
+
+    def test_spilled_head_stops_at_the_end_of_the_frame(self):
+        first, second = frame(large_message('1', 1000)), frame(message('2'))
+        reader = MLLPFrameReader(chunk_size=64, limits=FrameLimits(max_size=len(second), spill_size=100,
+                                                                  spill_dir=temp_dir(self)))
+        frames = []
+        data = first + second
+        for start in range(0, len(data), 500):
+            reader.feed(data[start:start + 500])
+            received = reader.next_frame()
+            while received is not None:
+                frames.append(received)
+                received = reader.next_frame()
+        self.assertEqual(len(frames), 2)
+        # the head is taken from the bytes received when the frame exceeded max_size
+        self.assertTrue(first.startswith(frames[0].head))
+        self.assertEqual(frames[0].size, len(first))
+        self.assertEqual(frames[1].tobytes(), second)
+
+
+class ServerFrameLimitsTest(unittest.TestCase):
+
+    def test_oversized_message_gets_a_negative_ack(self):
+        limits = FrameLimits(max_size=1000, oversize_ack='AE')
+        server = mllp2.MLLPServer('127.0.0.1', 0, {'*': (AckHandler,)}, frame_limits=limits)
+        sock = connect(self, serve(self, server))
+        sock.sendall(frame(large_message('1', 5000)) + frame(message('2')))
+        acks = read_messages(sock, 2)
+        self.assertEqual([msa(ack) for ack in acks], [('AE', '1'), ('AA', '2')])
+        self.assertIn('message too large', acks[0])
+        self.assertEqual(server.connection_stats()[0]['last_rejection'], 'frame too large')
+
+    def test_oversized_message_closes_the_connection(self):
+        server = MLLPServer('127.0.0.1', 0, {'*': (AckHandler,)}, frame_limits=FrameLimits(max_size=1000))
+        sock = connect(self, serve(self, server))
+        sock.sendall(frame(large_message('1', 5000)))
+        self.assertTrue(closed_by_peer(sock))
+
+    def test_spilled_message_is_handled(self):
+        limits = FrameLimits(spill_size=500, spill_dir=temp_dir(self))
+        server = MLLPServer('127.0.0.1', 0, {'*': (AckHandler,)}, frame_limits=limits)
+        sock = connect(self, serve(self, server))
+        sock.sendall(frame(large_message('1', 20000)))
+        self.assertEqual(msa(read_messages(sock, 1)[0]), ('AA', '1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import socket
+import threading
+import time
+import unittest
+
+from hl7apy.mllp import MLLPFrameReader, MLLPServer
+
+from tests.support import AckHandler, connect, frame, message, msa, read_messages, serve
+
+
+def frames(reader):
+    result = []
+    received = reader.next_frame()
+    while received is not None:
+        result.append(received.tobytes())
+        received = reader.next_frame()
+    return result
+
+
+class MLLPFrameReaderTest(unittest.TestCase):
+
+    def test_frame_split_across_reads(self):
+        data = frame(message('1'))
+        reader = MLLPFrameReader()
+        for i in range(len(data) - 1):
+            reader.feed(data[i:i + 1])
+            self.assertIsNone(reader.next_frame())
+        reader.feed(data[-1:])
+        self.assertEqual(reader.next_frame().tobytes(), data)
+        self.assertEqual(reader.buffered(), 0)
+
+    def test_end_block_split_across_reads(self):
+        data = frame(message('1'))
+        reader = MLLPFrameReader()
+        reader.feed(data[:-1])
+        self.assertIsNone(reader.next_frame())
+        reader.feed(data[-1:])
+        self.assertEqual(reader.next_frame().tobytes(), data)
+
+    def test_several_frames_in_one_read_keep_the_trailing_bytes(self):
+        first, second, third = frame(message('1')), frame(message('2')), frame(message('3'))
+        reader = MLLPFrameReader()
+        reader.feed(first + second + third[:10])
+        self.assertEqual(frames(reader), [first, second])
+        self.assertEqual(reader.buffered(), 10)
+        reader.feed(third[10:])
+        self.assertEqual(frames(reader), [third])
+        self.assertEqual(reader.received, len(first + second + third))
+
+    def test_end_block_characters_alone_do_not_end_the_frame(self):
+        data = frame(message('1', segments=('PID|1', 'PV1|1|\x1cX')))
+        reader = MLLPFrameReader()
+        reader.feed(data)
+        self.assertEqual(frames(reader), [data])
+
+    def test_read_frames_from_a_socket_written_in_pieces(self):
+        server, client = socket.socketpair()
+        self.addCleanup(server.close)
+        self.addCleanup(client.close)
+        data = frame(message('1')) + frame(message('2'))
+
+        def write():
+            for i in range(0, len(data), 7):
+                client.sendall(data[i:i + 7])
+                time.sleep(0.001)
+            client.close()
+        writer = threading.Thread(target=write)
+        writer.start()
+        reader = MLLPFrameReader(server, chunk_size=16)
+        self.assertEqual([f.tobytes() for f in reader], [frame(message('1')), frame(message('2'))])
+        writer.join()
+        self.assertTrue(reader.eof)
+
+    def test_connection_closed_in_the_middle_of_a_frame(self):
+        server, client = socket.socketpair()
+        self.addCleanup(server.close)
+        client.sendall(frame(message('1'))[:20])
+        client.close()
+        reader = MLLPFrameReader(server)
+        self.assertIsNone(reader.read_frame())
+        self.assertEqual(reader.buffered(), 20)
+
+
+class MLLPServerFramingTest(unittest.TestCase):
+
+    def test_frame_split_across_packets(self):
+        address = serve(self, MLLPServer('127.0.0.1', 0, {'*': (AckHandler,)}))
+        sock = connect(self, address)
+        data = frame(message('split'))
+        sock.sendall(data[:15])
+        time.sleep(0.1)
+        sock.sendall(data[15:-1])
+        time.sleep(0.1)
+        sock.sendall(data[-1:])
+        self.assertEqual(msa(read_messages(sock, 1)[0]), ('AA', 'split'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import time
+import unittest
+
+import mllp2
+from hl7apy.mllp import FRAME_VALIDATOR, InvalidMLLPFrame, MLLPFrameValidator
+
+from tests.support import AckHandler, connect, frame, message, msa, read_messages, serve, wait_until
+
+
+class MLLPFrameValidatorTest(unittest.TestCase):
+
+    def reason(self, data):
+        try:
+            FRAME_VALIDATOR.validate(data)
+        except InvalidMLLPFrame as e:
+            return e.reason, e.position
+        return None
+
+    def test_valid_frames(self):
+        data = frame(message('1'))
+        self.assertEqual(FRAME_VALIDATOR.validate(data), (1, len(data) - 2))
+        if bytes is not str:
+            self.assertEqual(FRAME_VALIDATOR.validate(memoryview(data)), (1, len(data) - 2))
+        # the terminator of the last segment is optional
+        self.assertEqual(FRAME_VALIDATOR.validate(b'\x0bMSH|^~\\&\x1c\r'), (1, 9))
+
+    def test_reasons_and_positions(self):
+        for data, expected in (
+                (b'MSH|^~\\&\r\x1c\r', (MLLPFrameValidator.MISSING_START_BLOCK, 0)),
+                (b'\x0bMSH|^~\\&\r', (MLLPFrameValidator.MISSING_END_BLOCK, 10)),
+                (b'\x0bMSH|^~\\&\r\x1c', (MLLPFrameValidator.MISSING_END_BLOCK, 11)),
+                (b'\x0b\x1c\r', (MLLPFrameValidator.EMPTY_MESSAGE, 1)),
+                (b'\x0b\rMSH|^~\\&\r\x1c\r', (MLLPFrameValidator.EMPTY_SEGMENT, 1)),
+                (b'\x0bMSH|^~\\&\r\rPID|1\r\x1c\r', (MLLPFrameValidator.EMPTY_SEGMENT, 10))):
+            self.assertEqual(self.reason(data), expected, data)
+
+    def test_message_of_the_error(self):
+        error = InvalidMLLPFrame(MLLPFrameValidator.EMPTY_SEGMENT, 10)
+        self.assertEqual(str(error), 'Invalid MLLP frame: empty segment at offset 10')
+
+    def test_linear_time_on_malformed_frames(self):
+        # frames that make a backtracking regular expression explode: long runs of segment separators
+        # without the end block
+        timings = []
+        for size in (20000, 200000):
+            data = b'\x0b' + b'A\r' * size
+            started = time.time()
+            self.assertEqual(self.reason(data)[0], MLLPFrameValidator.MISSING_END_BLOCK)
+            timings.append(time.time() - started)
+        self.assertLess(timings[1], 1)
+
+
+class RejectedFramesTest(unittest.TestCase):
+
+    def test_invalid_frames_are_counted(self):
+        server = mllp2.MLLPServer('127.0.0.1', 0, {'*': (AckHandler,)})
+        sock = connect(self, serve(self, server))
+        sock.sendall(b'\x0bMSH|^~\\&\r\r\x1c\r' + frame(message('2')))
+        self.assertEqual(msa(read_messages(sock, 1)[0]), ('AA', '2'))
+        stats = server.connection_stats()[0]
+        self.assertEqual(stats['rejected_frames'], 1)
+        self.assertEqual(stats['last_rejection'], MLLPFrameValidator.EMPTY_SEGMENT)
+
+
+if __name__ == '__main__':
+    unittest.main()
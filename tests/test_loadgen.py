@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import socket
+import sys
+import unittest
+
+import hl7_loadgen
+from hl7apy.mllp_client import MLLPClientError, MLLPFuture
+
+from tests.support import free_port, message, temp_dir
+
+
+class Output(object):
+    """
+    Collects what is printed to stdout
+    """
+    def __init__(self):
+        self.data = []
+
+    def write(self, data):
+        self.data.append(data)
+
+    def flush(self):
+        pass
+
+    def __str__(self):
+        return ''.join(self.data)
+
+
+class LoadgenHelpersTest(unittest.TestCase):
+
+    def test_load_samples(self):
+        directory = temp_dir(self)
+        samples = {
+            'a.msg': b'MSH|^~\\&|APP|FAC\r\nPID|1\r\n\r\nnot a segment\n',
+            'b.msg': b'PID|1\nPV1|1\n',
+            'c.txt': b'MSH|^~\\&|OTHER\n',
+            'd.msg': b'MSH|^~\\&|APP2|FAC\rEVN|A01',
+        }
+        for name, data in samples.items():
+            with open(os.path.join(directory, name), 'wb') as f:
+                f.write(data)
+        self.assertEqual(hl7_loadgen.load_samples(directory),
+                         ['MSH|^~\\&|APP|FAC\rPID|1\r', 'MSH|^~\\&|APP2|FAC\rEVN|A01\r'])
+
+    def test_set_control_id(self):
+        self.assertIn('|ADT^A01|run0001|P|', hl7_loadgen.set_control_id(message('1'), 'run0001'))
+        self.assertEqual(hl7_loadgen.set_control_id('MSH|^~\\&|APP\rPID|1\r', 'x'),
+                         'MSH|^~\\&|APP|||||||x\rPID|1\r')
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(hl7_loadgen.percentile(values, 50), 50)
+        self.assertEqual(hl7_loadgen.percentile(values, 99), 99)
+        self.assertEqual(hl7_loadgen.percentile(values, 99.5), 100)
+        self.assertEqual(hl7_loadgen.percentile(values, 100), 100)
+        self.assertEqual(hl7_loadgen.percentile([5], 50), 5)
+        self.assertEqual(hl7_loadgen.percentile([], 50), 0.0)
+
+    def test_stats(self):
+        stats = hl7_loadgen.Stats()
+        for control_id, result in (('1', 'MSH|^~\\&\rMSA|AA|1\r'), ('2', 'MSH|^~\\&\rMSA|CA|2\r'),
+                                   ('3', 'MSH|^~\\&\rMSA|AE|3\r'), ('4', 'MSH|^~\\&\rMSA|AA|5\r'),
+                                   ('6', MLLPClientError('closed'))):
+            future = MLLPFuture()
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+            stats.record(future, control_id, 0)
+        self.assertEqual((stats.acked, stats.nak, stats.mismatched, stats.errors), (2, 1, 1, 1))
+        self.assertEqual(len(stats.latencies), 4)
+
+
+class LoadgenRunTest(unittest.TestCase):
+
+    def test_local_run(self):
+        output = Output()
+        stdout, sys.stdout = sys.stdout, output
+        try:
+            status = hl7_loadgen.main(['127.0.0.1', str(free_port()), '--local', '-c', '2', '-i', '4', '-n', '50',
+                                       '--run-id', 'test'])
+        finally:
+            sys.stdout = stdout
+        report = dict(line.split(None, 1) for line in str(output).splitlines())
+        self.assertEqual(status, 0, report)
+        self.assertEqual(report['sent'], '50')
+        self.assertEqual(report['acked'], '50')
+        self.assertEqual(report['errors'], '0')
+
+    def test_local_server_that_cant_bind(self):
+        busy = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(busy.close)
+        busy.bind(('127.0.0.1', 0))
+        busy.listen(1)
+        output = Output()
+        stderr, sys.stderr = sys.stderr, output
+        try:
+            with self.assertRaises(SystemExit) as context:
+                hl7_loadgen.main(['127.0.0.1', str(busy.getsockname()[1]), '--local'])
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(context.exception.code, 2)
+        self.assertIn('unable to start the local server on port %d' % busy.getsockname()[1], str(output))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import threading
+import unittest
+
+from mllp2 import CONNECTION_STATE, MLLPServer
+
+from tests.support import AckHandler, closed_by_peer, connect, frame, message, msa, read_messages, serve, \
+    wait_until
+
+
+class ClosingServer(MLLPServer):
+    """
+    Records the statistics of the closed connections
+    """
+    def __init__(self, *args, **kwargs):
+        self.closed = []
+        MLLPServer.__init__(self, *args, **kwargs)
+
+    def connection_closed(self, handler):
+        MLLPServer.connection_closed(self, handler)
+        self.closed.append(handler.stats())
+
+
+class PersistentConnectionTest(unittest.TestCase):
+
+    def start(self, handlers=None, **kwargs):
+        server = ClosingServer('127.0.0.1', 0, handlers or {'*': (AckHandler,)}, **kwargs)
+        return server, serve(self, server)
+
+    def states(self, server):
+        return [c['state'] for c in server.connection_stats()]
+
+    def test_connection_lifecycle(self):
+        server, address = self.start()
+        sock = connect(self, address)
+        self.assertTrue(wait_until(lambda: self.states(server) == [CONNECTION_STATE.IDLE]))
+
+        data = frame(message('1'))
+        sock.sendall(data[:10])
+        self.assertTrue(wait_until(lambda: self.states(server) == [CONNECTION_STATE.READING]))
+        sock.sendall(data[10:])
+        self.assertEqual(msa(read_messages(sock, 1)[0]), ('AA', '1'))
+        self.assertTrue(wait_until(lambda: self.states(server) == [CONNECTION_STATE.IDLE]))
+
+        sock.sendall(frame(message('2')))
+        self.assertEqual(msa(read_messages(sock, 1)[0]), ('AA', '2'))
+        stats = server.connection_stats()[0]
+        self.assertEqual(stats['frames'], 2)
+        self.assertEqual(stats['bytes_received'], len(data) * 2)
+
+        sock.close()
+        self.assertTrue(wait_until(lambda: server.closed))
+        self.assertEqual(server.closed[0]['close_reason'], 'eof')
+        self.assertEqual(server.closed[0]['state'], CONNECTION_STATE.CLOSED)
+        self.assertEqual(server.connection_stats(), [])
+        self.assertEqual(server.closed_totals['connections'], 1)
+        self.assertEqual(server.closed_totals['frames'], 2)
+
+    def test_idle_timeout(self):
+        server, address = self.start(timeout=5, idle_timeout=0.2)
+        sock = connect(self, address)
+        sock.sendall(frame(message('1')))
+        read_messages(sock, 1)
+        self.assertTrue(closed_by_peer(sock))
+        self.assertTrue(wait_until(lambda: server.closed))
+        self.assertEqual(server.closed[0]['close_reason'], 'timeout')
+
+    def test_timeout_while_reading(self):
+        server, address = self.start(timeout=0.2, idle_timeout=5)
+        sock = connect(self, address)
+        sock.sendall(frame(message('1'))[:10])
+        self.assertTrue(closed_by_peer(sock))
+        self.assertTrue(wait_until(lambda: server.closed))
+        self.assertEqual(server.closed[0]['close_reason'], 'timeout')
+        self.assertEqual(server.closed[0]['frames'], 0)
+
+    def test_routing_error_closes_the_connection(self):
+        server, address = self.start({'ADT^A01': (AckHandler,)})
+        sock = connect(self, address)
+        sock.sendall(frame(message('1')) + frame(message('2', message_type='ORU^R01')))
+        self.assertEqual(msa(read_messages(sock, 1)[0]), ('AA', '1'))
+        self.assertTrue(closed_by_peer(sock))
+        self.assertTrue(wait_until(lambda: server.closed))
+        self.assertEqual(server.closed[0]['close_reason'], 'invalid frame')
+        self.assertEqual(server.closed[0]['errors'], 1)
+        self.assertEqual(server.closed_totals['errors'], 1)
+
+    def test_drain_closes_idle_connections(self):
+        server = ClosingServer('127.0.0.1', 0, {'*': (AckHandler,)})
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(server.server_close)
+        sock = connect(self, server.server_address)
+        sock.sendall(frame(message('1')))
+        read_messages(sock, 1)
+        self.assertTrue(wait_until(lambda: self.states(server) == [CONNECTION_STATE.IDLE]))
+
+        server.drain(5)
+        thread.join(5)
+        self.assertTrue(closed_by_peer(sock))
+        self.assertEqual([c['close_reason'] for c in server.closed], ['drain'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import socket
+import threading
+import time
+import unittest
+
+from hl7apy.mllp import create_tls_context
+from hl7apy.mllp_client import MLLPClient
+
+from tests.support import AckHandler, SlowAckHandler, client_tls_context, closed_by_peer, connect, frame, \
+    make_certificate, message, msa, read_messages, temp_dir, wait_until
+
+try:
+    from hl7apy.mllp_async import AsyncMLLPServer
+except SyntaxError:
+    # Python 2
+    AsyncMLLPServer = None
+
+
+@unittest.skipIf(AsyncMLLPServer is None, 'the asyncio server requires Python 3.7')
+class AsyncMLLPServerTest(unittest.TestCase):
+
+    def start(self, handlers=None, **kwargs):
+        server = AsyncMLLPServer('127.0.0.1', 0, handlers or {'*': (AckHandler,)}, **kwargs)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.assertTrue(wait_until(lambda: server._server is not None and server._server.is_serving()))
+
+        def stop():
+            server.shutdown()
+            thread.join(5)
+        self.addCleanup(stop)
+        return server
+
+    @staticmethod
+    def receiving(server):
+        # the connections that received part of a frame
+        return sum(1 for connection in list(server._connections.values()) if connection.frames.buffered())
+
+    def test_pipelined_frames_are_answered_in_order_on_a_persistent_connection(self):
+        server = self.start()
+        sock = connect(self, server.server_address)
+        sock.sendall(b''.join(frame(message(str(i))) for i in range(3)))
+        self.assertEqual([msa(ack) for ack in read_messages(sock, 3)], [('AA', '0'), ('AA', '1'), ('AA', '2')])
+        sock.sendall(frame(message('3')))
+        self.assertEqual(msa(read_messages(sock, 1)[0]), ('AA', '3'))
+
+    def test_slow_handler_does_not_block_the_other_connections(self):
+        SlowHandler = type(str('SlowHandler'), (SlowAckHandler,), {'delay': 1.0})
+        server = self.start({'ADT^A01': (SlowHandler,), 'ADT^A08': (AckHandler,)})
+        slow = connect(self, server.server_address)
+        fast = connect(self, server.server_address)
+        slow.sendall(frame(message('slow', 'ADT^A01')))
+        time.sleep(0.1)
+        start = time.time()
+        fast.sendall(frame(message('fast', 'ADT^A08')))
+        self.assertEqual(msa(read_messages(fast, 1)[0]), ('AA', 'fast'))
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(msa(read_messages(slow, 1)[0]), ('AA', 'slow'))
+
+    def test_unix_socket(self):
+        path = os.path.join(temp_dir(self), 'mllp.sock')
+        # a socket file left by a server that is no longer running
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(path)
+        stale.close()
+        server = self.start(unix_path=path)
+        sock = connect(self, path)
+        sock.sendall(frame(message('unix')))
+        self.assertEqual(msa(read_messages(sock, 1)[0]), ('AA', 'unix'))
+        sock.close()
+        server.shutdown()
+        self.assertTrue(wait_until(lambda: not os.path.exists(path)))
+
+    def test_tls(self):
+        certfile, keyfile = make_certificate(self)
+        server = self.start(ssl_context=create_tls_context(certfile, keyfile))
+        client = MLLPClient(ssl_context=client_tls_context())
+        self.addCleanup(client.close)
+        ack = client.send('127.0.0.1', server.server_address[1], message('tls')).result(5)
+        self.assertEqual(msa(ack), ('AA', 'tls'))
+
+    def test_drain_closes_idle_connections_and_answers_the_frames_being_received(self):
+        server = self.start({'*': (SlowAckHandler,)})
+        idle = connect(self, server.server_address)
+        busy = connect(self, server.server_address)
+        data = frame(message('busy'))
+        busy.sendall(data[:20])
+        self.assertTrue(wait_until(lambda: self.receiving(server) == 1 and server.active_connections == 2))
+        address = server.server_address
+
+        result = {}
+        drain = threading.Thread(target=lambda: result.update(server.drain(5)))
+        drain.start()
+        time.sleep(0.2)
+        busy.sendall(data[20:])
+        self.assertEqual(msa(read_messages(busy, 1)[0]), ('AA', 'busy'))
+        drain.join(5)
+        self.assertEqual(result, {'drained': 2, 'abandoned': 0})
+        self.assertTrue(closed_by_peer(idle))
+        self.assertTrue(closed_by_peer(busy))
+        # new connections are refused
+        self.assertRaises(socket.error, socket.create_connection, address, 1)
+
+    def test_drain_abandons_the_connections_not_completed_in_time(self):
+        server = self.start()
+        sock = connect(self, server.server_address)
+        sock.sendall(frame(message('never completed'))[:20])
+        self.assertTrue(wait_until(lambda: self.receiving(server) == 1))
+        self.assertEqual(server.drain(0.3), {'drained': 0, 'abandoned': 1})
+        self.assertTrue(closed_by_peer(sock))
+
+
+if __name__ == '__main__':
+    unittest.main()
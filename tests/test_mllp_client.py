@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import socket
+import threading
+import time
+import unittest
+
+import mllp2
+from hl7apy.mllp import MLLPServer, create_tls_context
+from hl7apy.mllp_client import MLLPClient, MLLPClientError
+
+from tests.support import AckHandler, client_tls_context, make_certificate, message, msa, serve, wait_until
+
+
+class MLLPClientTest(unittest.TestCase):
+
+    def client(self, **kwargs):
+        client = MLLPClient(**kwargs)
+        self.addCleanup(client.close)
+        return client
+
+    def test_pipelining_on_a_persistent_connection(self):
+        server = mllp2.MLLPServer('127.0.0.1', 0, {'*': (AckHandler,)})
+        host, port = serve(self, server)
+        client = self.client(max_in_flight=8)
+        futures = [client.send(host, port, message(str(i))) for i in range(20)]
+        self.assertEqual([msa(f.result(5)) for f in futures], [('AA', str(i)) for i in range(20)])
+        self.assertEqual(len(server.connection_stats()), 1)
+        self.assertEqual(client.reconnects, 0)
+
+    def test_concurrent_senders_share_the_pool(self):
+        server = mllp2.MLLPServer('127.0.0.1', 0, {'*': (AckHandler,)})
+        host, port = serve(self, server)
+        client = self.client(max_in_flight=10, pool_size=2)
+        acks = []
+        threads = [threading.Thread(target=lambda i=i: acks.append(client.send(host, port, message(str(i)))
+                                                                   .result(5)))
+                   for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(sorted(msa(ack)[1] for ack in acks), sorted(str(i) for i in range(10)))
+        self.assertLessEqual(len(server.connection_stats()), 2)
+
+    def test_responses_not_expected(self):
+        server = mllp2.MLLPServer('127.0.0.1', 0, {'*': (AckHandler,)})
+        host, port = serve(self, server)
+        client = self.client(timeout=0.5, expect_responses=False)
+        futures = [client.send(host, port, message(str(i))) for i in range(5)]
+        self.assertEqual([f.result(0) for f in futures], [None] * 5)
+        self.assertTrue(wait_until(lambda: [c['frames'] for c in server.connection_stats()] == [5]))
+        # the answers are discarded, and the connection doesn't time out waiting for them
+        time.sleep(1)
+        client.send(host, port, message('5'))
+        self.assertEqual(client.reconnects, 0)
+
+    def test_reconnects_to_a_closing_server(self):
+        host, port = serve(self, MLLPServer('127.0.0.1', 0, {'*': (AckHandler,)}))
+        client = self.client()
+        for i in range(4):
+            self.assertEqual(msa(client.send(host, port, message(str(i))).result(5)), ('AA', str(i)))
+            # the server closes the connection once it has answered
+            self.assertTrue(wait_until(lambda: all(c.closed for c in client._pools[(host, port)])))
+        client.send(host, port, message('4')).result(5)
+        self.assertEqual(client.reconnects, 4)
+
+    def test_stalled_handshake_doesnt_block_other_servers(self):
+        certfile, keyfile = make_certificate(self)
+        host, port = serve(self, MLLPServer('127.0.0.1', 0, {'*': (AckHandler,)},
+                                            ssl_context=create_tls_context(certfile, keyfile)))
+        # accepts TCP connections but never answers the TLS handshake
+        stalled = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(stalled.close)
+        stalled.bind(('127.0.0.1', 0))
+        stalled.listen(5)
+
+        client = self.client(timeout=3, connect_timeout=3, retries=0, ssl_context=client_tls_context())
+        errors = []
+
+        def send_to_stalled():
+            try:
+                client.send('127.0.0.1', stalled.getsockname()[1], message('stalled'))
+            except MLLPClientError as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=send_to_stalled)
+        thread.start()
+        time.sleep(0.3)
+        started = time.time()
+        self.assertEqual(msa(client.send(host, port, message('fast')).result(5)), ('AA', 'fast'))
+        self.assertLess(time.time() - started, 2)
+        thread.join(10)
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(client._connecting[('127.0.0.1', stalled.getsockname()[1])], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import multiprocessing
+import os
+import random
+import time
+import unittest
+
+from hl7apy.mllp import WorkerSupervisor
+from pipeline import OrderedPipeline, ShardedPipeline
+
+from tests.support import import_modular_input, message
+
+
+def delayed(value, delay):
+    time.sleep(delay)
+    return value
+
+
+def worker_of(value, delay):
+    time.sleep(delay)
+    return value, os.getpid()
+
+
+def parse_in_worker(index, params, results):
+    module = import_modular_input()
+    mi = module.MyInput()
+    mi.start_parse_pool(params)
+    try:
+        for i in range(10):
+            mi.pipeline.submit('APP|FAC', i, message(str(i)), None, 'hl7://test', 'hl7', None, 'main')
+        results.put([(i, error, event is not None and 'MSH' in event) for i, (event, error) in mi.pipeline.flush(30)])
+    finally:
+        mi.pipeline.close()
+
+
+class OrderedPipelineTest(unittest.TestCase):
+
+    def pipeline(self, workers=4, **kwargs):
+        pool = multiprocessing.Pool(workers)
+        pipeline = OrderedPipeline(pool, delayed, **kwargs)
+        self.addCleanup(pipeline.close)
+        return pipeline
+
+    def test_results_are_released_in_order(self):
+        pipeline = self.pipeline()
+        # the later items are ready first
+        for i, delay in enumerate((0.4, 0.3, 0.2, 0.1, 0)):
+            pipeline.submit('A', i, i, delay)
+        self.assertEqual(len(pipeline), 5)
+        self.assertEqual(pipeline.flush(10), [(i, i) for i in range(5)])
+        self.assertEqual(len(pipeline), 0)
+
+    def test_streams_dont_wait_for_each_other(self):
+        pipeline = self.pipeline()
+        pipeline.submit('slow', 's0', 's0', 1)
+        pipeline.submit('slow', 's1', 's1', 0)
+        for i in range(3):
+            pipeline.submit('fast', 'f%d' % i, 'f%d' % i, 0)
+        released = []
+        while len(released) < 3:
+            released.extend(pipeline.release(0.5))
+        self.assertEqual(released, [('f0', 'f0'), ('f1', 'f1'), ('f2', 'f2')])
+        self.assertEqual(pipeline.flush(10), [('s0', 's0'), ('s1', 's1')])
+
+    def test_reorder_buffer_is_bounded(self):
+        pipeline = self.pipeline(max_pending=2)
+        pipeline.submit('A', 0, 0, 0)
+        self.assertFalse(pipeline.full())
+        pipeline.submit('A', 1, 1, 0)
+        self.assertTrue(pipeline.full())
+        pipeline.flush(10)
+        self.assertFalse(pipeline.full())
+
+    def test_late_result_is_computed_here(self):
+        pipeline = self.pipeline(workers=1, task_timeout=0.2)
+        pipeline.submit('A', 0, 0, 2)
+        pipeline.submit('A', 1, 1, 0)
+        self.assertEqual(pipeline.flush(10), [(0, 0), (1, 1)])
+        self.assertGreaterEqual(pipeline.timeouts, 1)
+
+
+class ShardedPipelineTest(unittest.TestCase):
+
+    def test_sender_stays_on_its_shard(self):
+        pools = [multiprocessing.Pool(1) for i in range(3)]
+        pipeline = ShardedPipeline(pools, worker_of, max_pending=1000)
+        self.addCleanup(pipeline.close)
+        senders = ['APP%d|FAC' % i for i in range(6)]
+        expected = dict((sender, []) for sender in senders)
+        for i in range(60):
+            sender = random.choice(senders)
+            expected[sender].append(i)
+            pipeline.submit(sender, sender, i, random.random() / 100)
+        released = pipeline.flush(30)
+        self.assertEqual(len(released), 60)
+
+        for sender in senders:
+            results = [result for s, result in released if s == sender]
+            self.assertEqual([value for value, pid in results], expected[sender])
+            # the single process of the pool of its shard
+            self.assertEqual(set(pid for value, pid in results) - set([pipeline._pool(sender)._pool[0].pid]), set())
+
+    def test_close_stops_every_shard(self):
+        pools = [multiprocessing.Pool(1) for i in range(2)]
+        pipeline = ShardedPipeline(pools, worker_of)
+        processes = [p for pool in pools for p in pool._pool]
+        pipeline.close()
+        for process in processes:
+            process.join(5)
+        self.assertFalse(any(p.is_alive() for p in processes))
+
+
+class ParseWorkersTest(unittest.TestCase):
+
+    def setUp(self):
+        import_modular_input()
+
+    def parse_in_supervised_worker(self, params):
+        results = multiprocessing.Queue()
+        supervisor = WorkerSupervisor(parse_in_worker, 1, args=(params, results), min_uptime=60)
+        self.addCleanup(supervisor.stop)
+        supervisor.start()
+        released = results.get(timeout=30)
+        self.assertEqual(released, [(i, None, True) for i in range(10)])
+        supervisor._processes[0].join(10)
+        self.assertEqual(supervisor._processes[0].exitcode, 0)
+
+    def test_parse_pool_in_listener_process(self):
+        self.parse_in_supervised_worker({'parse_workers': 2})
+
+    def test_sharded_parse_pools_in_listener_process(self):
+        self.parse_in_supervised_worker({'parse_workers': 2, 'parse_sharding': 'sender'})
+
+    def test_messages_are_only_validated(self):
+        module = import_modular_input()
+        self.assertIsNone(module.validate_message(message('1')))
+        self.assertIsNotNone(module.validate_message('PID|1\r'))
+        # not parsed above the size limit
+        self.assertIsNone(module.validate_message('PID|1\r', parse_size_limit=3))
+
+
+if __name__ == '__main__':
+    unittest.main()
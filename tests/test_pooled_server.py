@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import threading
+import unittest
+
+from hl7apy.mllp import PooledMLLPServer
+
+from tests.support import AckHandler, SlowAckHandler, closed_by_peer, connect, frame, message, msa, \
+    read_messages, serve, wait_until
+
+
+class PooledMLLPServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.before = set(threading.enumerate())
+
+    def start(self, handler=SlowAckHandler, **kwargs):
+        server = PooledMLLPServer('127.0.0.1', 0, {'*': (handler,)}, **kwargs)
+        return server, serve(self, server)
+
+    def test_messages_are_served_by_the_workers(self):
+        server, address = self.start(AckHandler, max_workers=2)
+        for i in range(5):
+            sock = connect(self, address)
+            sock.sendall(frame(message(str(i))))
+            self.assertEqual(msa(read_messages(sock, 1)[0]), ('AA', str(i)))
+        self.assertTrue(wait_until(lambda: server.stats()['active'] == 0))
+        self.assertEqual(server.stats(), {'accepted': 5, 'active': 0, 'queued': 0, 'rejected': 0})
+
+    def test_refuse_when_all_the_workers_are_busy(self):
+        server, address = self.start(max_workers=1, overflow=PooledMLLPServer.REFUSE)
+        busy = connect(self, address)
+        busy.sendall(frame(message('busy')))
+        self.assertTrue(wait_until(lambda: server.stats()['active'] == 1))
+
+        refused = connect(self, address)
+        self.assertTrue(closed_by_peer(refused))
+        self.assertEqual(msa(read_messages(busy, 1)[0]), ('AA', 'busy'))
+        self.assertEqual(server.stats()['rejected'], 1)
+
+    def test_queue_until_a_worker_is_free(self):
+        server, address = self.start(max_workers=1, max_queued=1)
+        first = connect(self, address)
+        first.sendall(frame(message('first')))
+        self.assertTrue(wait_until(lambda: server.stats()['active'] == 1))
+
+        queued = connect(self, address)
+        queued.sendall(frame(message('queued')))
+        self.assertTrue(wait_until(lambda: server.stats()['queued'] == 1))
+        refused = connect(self, address)
+        self.assertTrue(closed_by_peer(refused))
+
+        self.assertEqual(msa(read_messages(first, 1)[0]), ('AA', 'first'))
+        self.assertEqual(msa(read_messages(queued, 1)[0]), ('AA', 'queued'))
+        self.assertEqual(server.stats()['accepted'], 2)
+        self.assertEqual(server.stats()['rejected'], 1)
+
+    def test_workers_stop_when_the_server_is_closed(self):
+        server = PooledMLLPServer('127.0.0.1', 0, {'*': (AckHandler,)}, max_workers=3)
+        workers = list(server._workers)
+        self.assertEqual(sum(1 for w in workers if w.is_alive()), 3)
+        server.server_close()
+        for worker in workers:
+            worker.join(5)
+        self.assertFalse(any(w.is_alive() for w in workers))
+
+    def test_unknown_overflow_policy(self):
+        self.assertRaises(ValueError, PooledMLLPServer, '127.0.0.1', 0, {'*': (AckHandler,)}, overflow='drop')
+        self.assertFalse(any(t.name.startswith('mllp-worker') and t.is_alive() and t not in self.before
+                             for t in threading.enumerate()))
+
+
+if __name__ == '__main__':
+    unittest.main()
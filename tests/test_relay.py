@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import threading
+import unittest
+
+import mllp2
+from hl7apy.mllp import AbstractHandler, MLLPServer, MSHHeader, build_ack, current_peer
+from relay import Relay, RelayDestination
+
+from tests.support import free_port, import_modular_input, message, serve, wait_until
+
+
+class RecordingHandler(AbstractHandler):
+    """
+    Records the control id and the peer of the messages received, refusing the ones listed in :attr:`refuse`
+    with AR once for every entry
+    """
+    received = None
+    refuse = None
+    lock = threading.Lock()
+
+    def reply(self):
+        header = MSHHeader(self.incoming_message)
+        with self.lock:
+            self.received.append((header.control_id, current_peer()))
+            if header.control_id in self.refuse:
+                self.refuse.remove(header.control_id)
+                return build_ack(header, 'AR')
+        return build_ack(header, 'AA')
+
+
+class RelayDestinationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.received = []
+        self.refuse = []
+        self.handler = type(str('Handler'), (RecordingHandler,), {'received': self.received, 'refuse': self.refuse})
+
+    def destination(self, port, **kwargs):
+        kwargs.setdefault('initial_backoff', 0.05)
+        kwargs.setdefault('max_backoff', 0.2)
+        kwargs.setdefault('timeout', 5)
+        destination = RelayDestination('127.0.0.1', port, **kwargs)
+        self.addCleanup(destination.close)
+        return destination
+
+    def serve(self, server_class, port=0):
+        return serve(self, server_class('127.0.0.1', port, {'*': (self.handler,)}))[1]
+
+    def control_ids(self):
+        return [control_id for control_id, peer in self.received]
+
+    def relay(self, destination, count):
+        for i in range(count):
+            self.assertTrue(destination.put(message(str(i))))
+        self.assertTrue(wait_until(lambda: not destination.pending(), 10))
+
+    def test_one_message_per_connection_to_a_closing_server(self):
+        destination = self.destination(self.serve(MLLPServer), initial_backoff=60)
+        self.relay(destination, 5)
+        self.assertEqual(self.control_ids(), [str(i) for i in range(5)])
+        self.assertEqual(len(set(peer for control_id, peer in self.received)), 5)
+        # a message sent before the close of the previous connection is noticed is sent again at once
+        self.assertEqual(destination.stats()['sent'], 5)
+        self.assertLessEqual(destination.retries, 4)
+
+    def test_pipelining_on_a_persistent_connection(self):
+        destination = self.destination(self.serve(mllp2.MLLPServer), max_in_flight=8)
+        self.relay(destination, 50)
+        self.assertEqual(self.control_ids(), [str(i) for i in range(50)])
+        self.assertEqual(len(set(peer for control_id, peer in self.received)), 1)
+        self.assertEqual(destination.sent, 50)
+        self.assertEqual(destination.retries, 0)
+
+    def test_refused_message_is_sent_again_with_the_following_ones(self):
+        self.refuse.append('2')
+        destination = self.destination(self.serve(mllp2.MLLPServer), max_in_flight=4)
+        self.relay(destination, 4)
+        # the messages after the refused one were already in flight, so they are received twice
+        self.assertEqual(self.control_ids(), ['0', '1', '2', '3', '2', '3'])
+        self.assertEqual(destination.sent, 4)
+        self.assertEqual(destination.retries, 1)
+
+    def test_retried_until_the_destination_is_back(self):
+        port = free_port()
+        destination = self.destination(port)
+        for i in range(3):
+            destination.put(message(str(i)))
+        self.assertTrue(wait_until(lambda: destination.retries >= 3))
+        self.assertEqual(destination.sent, 0)
+        self.assertEqual(destination.pending(), 3)
+        self.serve(MLLPServer, port)
+        self.assertTrue(wait_until(lambda: not destination.pending()))
+        self.assertEqual(self.control_ids(), ['0', '1', '2'])
+        self.assertEqual(destination.sent, 3)
+        self.assertEqual(destination.rejected, 0)
+
+    def test_backoff_doubles_up_to_the_maximum(self):
+        destination = self.destination(free_port(), initial_backoff=0.3, max_backoff=0.6)
+        destination.put(message('1'))
+        # attempts after 0, 0, 0.3, 0.9 and 1.5 seconds
+        self.assertTrue(wait_until(lambda: destination.retries >= 2))
+        self.assertFalse(wait_until(lambda: destination.retries >= 4, 0.7))
+        self.assertTrue(wait_until(lambda: destination.retries >= 5, 1.5))
+
+    def test_message_refused_too_many_times_is_dropped(self):
+        self.refuse.extend(['1'] * 10)
+        destination = self.destination(self.serve(mllp2.MLLPServer), max_attempts=3)
+        self.relay(destination, 3)
+        self.assertEqual(self.control_ids(), ['0', '1', '1', '1', '2'])
+        self.assertEqual(destination.stats(), {'pending': 0, 'sent': 2, 'dropped': 0, 'rejected': 1, 'retries': 2})
+
+    def test_full_queue_drops_the_new_messages(self):
+        destination = self.destination(free_port(), max_queued=2, initial_backoff=60)
+        self.assertTrue(destination.put(message('1')))
+        self.assertTrue(destination.put(message('2')))
+        self.assertFalse(destination.put(message('3')))
+        self.assertEqual(destination.pending(), 2)
+        self.assertEqual(destination.dropped, 1)
+
+
+class RelayTest(unittest.TestCase):
+
+    def test_every_destination_gets_a_copy(self):
+        received = [[], []]
+        ports = []
+        for i in range(2):
+            handler = type(str('Handler'), (RecordingHandler,), {'received': received[i], 'refuse': []})
+            ports.append(serve(self, mllp2.MLLPServer('127.0.0.1', 0, {'*': (handler,)}))[1])
+        down = free_port()
+        relay = Relay([('127.0.0.1', port) for port in ports + [down]], initial_backoff=60, max_in_flight=4)
+        for i in range(3):
+            relay.forward(message(str(i)))
+        self.assertTrue(wait_until(lambda: all(len(r) == 3 for r in received)))
+        self.assertEqual([[control_id for control_id, peer in r] for r in received], [['0', '1', '2']] * 2)
+        self.assertEqual(relay.stats()['127.0.0.1:%d' % down]['pending'], 3)
+        self.assertEqual(relay.close(0.1), 3)
+
+
+class ConfigureRelayTest(unittest.TestCase):
+
+    def test_settings(self):
+        module = import_modular_input()
+        mi = module.MyInput()
+        mi.configure_relay({'relay_destinations': 'engine1:2575, bad, engine2:2576', 'relay_queue_size': 5,
+                            'relay_max_in_flight': 4})
+        self.addCleanup(mi.relay.close)
+        self.assertEqual([(d.host, d.port, d.max_queued, d.max_in_flight) for d in mi.relay.destinations],
+                         [('engine1', 2575, 5, 4), ('engine2', 2576, 5, 4)])
+
+
+if __name__ == '__main__':
+    unittest.main()
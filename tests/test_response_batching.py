@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import time
+import unittest
+
+import mllp2
+from hl7apy import mllp
+
+from tests.support import AckHandler, closed_by_peer, connect, frame, import_modular_input, message, msa, \
+    read_messages, serve, wait_until
+
+
+def recording(server_class):
+    """
+    Subclass the server so that the counters of every handler are recorded when its connection is closed
+    """
+    base = server_class.handler_class
+
+    class Handler(base):
+        def finish(self):
+            self.server.finished.append((self.frames, self.writes, self.bytes_sent))
+            base.finish(self)
+
+    class Server(server_class):
+        handler_class = Handler
+
+        def __init__(self, *args, **kwargs):
+            self.finished = []
+            server_class.__init__(self, *args, **kwargs)
+
+    return Server
+
+
+class ResponseBatchingTest(unittest.TestCase):
+
+    def test_buffered_frames_are_answered_with_one_write(self):
+        server = recording(mllp.MLLPServer)('127.0.0.1', 0, {'*': (AckHandler,)})
+        sock = connect(self, serve(self, server))
+        sock.sendall(b''.join(frame(message(str(i))) for i in range(3)))
+
+        acks = read_messages(sock, 3)
+        self.assertEqual([msa(ack) for ack in acks], [('AA', '0'), ('AA', '1'), ('AA', '2')])
+        self.assertTrue(closed_by_peer(sock))
+        self.assertTrue(wait_until(lambda: server.finished))
+        frames, writes, bytes_sent = server.finished[0]
+        self.assertEqual((frames, writes), (3, 1))
+        self.assertEqual(bytes_sent, sum(len(ack.encode('utf-8')) + 3 for ack in acks))
+
+    def test_pooled_server_closes_after_the_first_read(self):
+        server = recording(mllp.PooledMLLPServer)('127.0.0.1', 0, {'*': (AckHandler,)}, max_workers=1)
+        sock = connect(self, serve(self, server))
+        sock.sendall(frame(message('1')))
+        self.assertEqual(msa(read_messages(sock, 1)[0]), ('AA', '1'))
+        self.assertTrue(closed_by_peer(sock))
+        self.assertTrue(wait_until(lambda: server.finished))
+        self.assertEqual(server.finished[0][:2], (1, 1))
+
+    def test_persistent_connection_writes_once_per_read(self):
+        server = recording(mllp2.MLLPServer)('127.0.0.1', 0, {'*': (AckHandler,)})
+        sock = connect(self, serve(self, server))
+        sock.sendall(b''.join(frame(message(str(i))) for i in range(3)))
+        self.assertEqual([msa(ack)[1] for ack in read_messages(sock, 3)], ['0', '1', '2'])
+        sock.sendall(b''.join(frame(message(str(i))) for i in range(3, 5)))
+        self.assertEqual([msa(ack)[1] for ack in read_messages(sock, 2)], ['3', '4'])
+        sock.close()
+
+        self.assertTrue(wait_until(lambda: server.finished))
+        self.assertEqual(server.finished[0][:2], (5, 2))
+
+
+class PersistentInputTest(unittest.TestCase):
+
+    def setUp(self):
+        self.module = import_modular_input()
+        self.mi = self.module.MyInput()
+
+    def test_frames_written_separately_on_one_connection(self):
+        server = self.mi.create_mllp_server({'port': 0, 'persistent_connections': True, 'idle_timeout': 1})
+        self.assertIsInstance(server, mllp2.MLLPServer)
+        sock = connect(self, ('127.0.0.1', serve(self, server)[1]))
+        for i in range(3):
+            sock.sendall(frame(message(str(i))))
+            time.sleep(0.05)
+        self.assertEqual([msa(ack) for ack in read_messages(sock, 3)], [('AA', '0'), ('AA', '1'), ('AA', '2')])
+        sock.sendall(frame(message('3')))
+        self.assertEqual(msa(read_messages(sock, 1)[0]), ('AA', '3'))
+        self.assertEqual(self.mi._queue.qsize(), 4)
+        # closed once idle
+        self.assertTrue(wait_until(lambda: closed_by_peer(sock), 3))
+
+    def test_not_with_max_connections(self):
+        server = self.mi.create_mllp_server({'port': 0, 'persistent_connections': True,
+                                              'max_connections': 2})
+        server.server_close()
+        self.assertIsInstance(server, mllp.PooledMLLPServer)
+
+
+if __name__ == '__main__':
+    unittest.main()
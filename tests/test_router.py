@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import unittest
+
+from hl7apy.mllp import AbstractErrorHandler, AbstractHandler, MessageRouter, MLLPServer, MSHHeader, \
+    UnsupportedMessageType, build_ack
+
+from tests.support import AckHandler, closed_by_peer, connect, frame, import_modular_input, message, msa, \
+    read_messages, serve
+
+
+class ErrorHandler(AbstractErrorHandler):
+    """
+    Refuses the message with the name of the exception in MSA-3
+    """
+    def reply(self):
+        return build_ack(MSHHeader(self.incoming_message), 'AR', text=type(self.exc).__name__)
+
+
+class HeaderHandler(AbstractHandler):
+    """
+    Records the header passed by the server
+    """
+    headers = []
+
+    def reply(self):
+        self.headers.append(self._header)
+        return build_ack(self.header, 'AA')
+
+
+class MessageRouterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.router = MessageRouter({
+            'ADT^A01': ('exact', 1),
+            'ADT^A*': ('prefix',),
+            'ADT^A0?': ('longer prefix',),
+            'O??^R01': ('single chars',),
+            '*': ('any',),
+            'ERR': ('error',),
+        })
+
+    def handler(self, msg_type):
+        return self.router.resolve(msg_type)[0]
+
+    def test_exact_types_come_first(self):
+        self.assertEqual(self.router.resolve('ADT^A01'), ('exact', (1,)))
+
+    def test_longest_literal_pattern_wins(self):
+        self.assertEqual(self.handler('ADT^A04'), 'longer prefix')
+        self.assertEqual(self.handler('ADT^A31'), 'prefix')
+        self.assertEqual(self.handler('ORU^R01'), 'single chars')
+        self.assertEqual(self.handler('SIU^S12'), 'any')
+
+    def test_error_handler_is_not_a_route(self):
+        self.assertEqual(self.router.error_handler, ('error', ()))
+        self.assertIsNone(MessageRouter({'ADT^A01': ('exact',)}).resolve('ERR'))
+
+    def test_no_match(self):
+        router = MessageRouter({'ADT^A*': ('prefix',)})
+        self.assertIsNone(router.resolve('ORU^R01'))
+        self.assertIsNone(router.resolve(None))
+        self.assertEqual(router.stats(), {'ADT^A*': 0})
+
+    def test_hits(self):
+        for msg_type in ('ADT^A01', 'ADT^A01', 'ADT^A04', 'ADT^A31', 'SIU^S12'):
+            self.router.resolve(msg_type)
+        stats = self.router.stats()
+        self.assertEqual(stats['ADT^A01'], 2)
+        self.assertEqual(stats['ADT^A0?'], 1)
+        self.assertEqual(stats['ADT^A*'], 1)
+        self.assertEqual(stats['*'], 1)
+        self.assertEqual(stats['ERR'], 0)
+
+    def test_cache_is_bounded(self):
+        router = MessageRouter({'*': ('any',)}, cache_size=2)
+        for i in range(5):
+            self.assertEqual(router.resolve('Z%02d^Z01' % i)[0], 'any')
+        self.assertEqual(len(router._cache), 2)
+        self.assertEqual(router.stats()['*'], 5)
+
+
+class ServerRoutingTest(unittest.TestCase):
+
+    def test_unsupported_type_goes_to_the_error_handler(self):
+        server = MLLPServer('127.0.0.1', 0, {'ADT^A*': (AckHandler,), 'ERR': (ErrorHandler,)})
+        address = serve(self, server)
+        for control_id, message_type, expected in (('1', 'ADT^A08', 'AA'), ('2', 'ORU^R01', 'AR')):
+            sock = connect(self, address)
+            sock.sendall(frame(message(control_id, message_type=message_type)))
+            ack = read_messages(sock, 1)[0]
+            self.assertEqual(msa(ack), (expected, control_id))
+        self.assertIn(UnsupportedMessageType.__name__, ack)
+        self.assertEqual(server.router.stats(), {'ADT^A*': 1, 'ERR': 1})
+
+    def test_header_is_split_once(self):
+        del HeaderHandler.headers[:]
+        address = serve(self, MLLPServer('127.0.0.1', 0, {'*': (HeaderHandler,)}))
+        sock = connect(self, address)
+        sock.sendall(frame(message('1')))
+        self.assertEqual(msa(read_messages(sock, 1)[0]), ('AA', '1'))
+        self.assertEqual([header.control_id for header in HeaderHandler.headers], ['1'])
+        # a handler created outside of a server splits it on demand
+        self.assertEqual(HeaderHandler(message('2')).header.control_id, '2')
+
+    def test_missing_type_goes_to_the_error_handler(self):
+        server = MLLPServer('127.0.0.1', 0, {'*': (AckHandler,), 'ERR': (ErrorHandler,)})
+        sock = connect(self, serve(self, server))
+        sock.sendall(frame('MSH|^~\\&|APP|FAC|SPLUNK|SPLUNKFAC|20200101\rPID|1\r'))
+        self.assertEqual(msa(read_messages(sock, 1)[0])[0], 'AR')
+        self.assertEqual(server.router.stats(), {'*': 0, 'ERR': 1})
+
+
+class InputRoutingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.module = import_modular_input()
+        self.mi = self.module.MyInput()
+        self.server = self.mi.create_mllp_server({'port': 0})
+        self.address = ('127.0.0.1', serve(self, self.server)[1])
+
+    def send(self, data):
+        sock = connect(self, self.address)
+        sock.sendall(frame(data))
+        return sock
+
+    def test_messages_are_routed_to_the_message_handler(self):
+        for i in range(3):
+            self.assertEqual(msa(read_messages(self.send(message(str(i))), 1)[0]), ('AA', str(i)))
+        batch = 'FHS|^~\\&|APP|FAC|SPLUNK|SPLUNKFAC|20200101||||F1\r' + message('4') + 'FTS|1\r'
+        self.assertEqual(len(read_messages(self.send(batch), 1)), 1)
+        self.assertEqual(self.server.router.stats(), {'*': 3, 'ERR': 1})
+        self.assertEqual(self.mi._queue.qsize(), 4)
+        self.assertEqual(self.server.router.resolve('ORU^R01')[0], self.module.MessageHandler)
+
+    def test_handler_error_closes_the_connection(self):
+        def fail(header):
+            raise RuntimeError('sender lookup failed')
+        self.mi.sender_of = fail
+        sock = self.send(message('1'))
+        self.assertTrue(closed_by_peer(sock))
+        self.assertEqual(self.mi._queue.qsize(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import threading
+import unittest
+
+from spool import MessageSpool
+
+from tests.support import temp_dir
+
+
+class MessageSpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = os.path.join(temp_dir(self), 'spool')
+
+    def open(self, **kwargs):
+        spool = MessageSpool(self.directory, **kwargs)
+        self.addCleanup(spool.close)
+        return spool
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith('.seg'))
+
+    def test_unacknowledged_records_are_recovered_in_order(self):
+        spool = self.open()
+        ids = [spool.append(('message %d' % i).encode('ascii')) for i in range(5)]
+        spool.ack(ids[1])
+        spool.ack(ids[3])
+        self.assertEqual(spool.pending(), 3)
+        spool.close()
+
+        spool = self.open()
+        self.assertEqual([data for entry_id, data in spool.recovered], [b'message 0', b'message 2', b'message 4'])
+        self.assertEqual([entry_id for entry_id, data in spool.recovered], [ids[0], ids[2], ids[4]])
+        self.assertEqual(spool.pending(), 3)
+
+    def test_torn_record_is_discarded(self):
+        spool = self.open()
+        for i in range(3):
+            spool.append(('message %d' % i).encode('ascii'))
+        spool.close()
+        path = os.path.join(self.directory, self.segments()[-1])
+        size = os.path.getsize(path)
+        with open(path, 'r+b') as f:
+            f.truncate(size - 4)
+
+        spool = self.open()
+        self.assertEqual([data for entry_id, data in spool.recovered], [b'message 0', b'message 1'])
+        # the spool goes on in a new segment and the replayed records can be acknowledged
+        spool.append(b'message 3')
+        for entry_id, data in spool.recovered:
+            spool.ack(entry_id)
+        spool.close()
+
+        spool = self.open()
+        self.assertEqual([data for entry_id, data in spool.recovered], [b'message 3'])
+
+    def test_corrupt_record_ends_the_segment(self):
+        spool = self.open()
+        for i in range(3):
+            spool.append(('message %d' % i).encode('ascii'))
+        spool.close()
+        path = os.path.join(self.directory, self.segments()[-1])
+        with open(path, 'r+b') as f:
+            data = f.read()
+            f.seek(data.index(b'message 1'))
+            f.write(b'MESSAGE')
+
+        spool = self.open()
+        self.assertEqual([data for entry_id, data in spool.recovered], [b'message 0'])
+
+    def test_drained_segments_are_reclaimed(self):
+        spool = self.open(segment_size=20)
+        ids = [spool.append(b'x' * 20) for i in range(4)]
+        self.assertEqual(len(self.segments()), 4)
+        for entry_id in ids[:3]:
+            spool.ack(entry_id)
+        # the current segment is kept even if all its records are acknowledged
+        spool.ack(ids[3])
+        self.assertEqual(spool.reclaimed, 3)
+        self.assertEqual(len(self.segments()), 1)
+        spool.close()
+
+        spool = self.open()
+        self.assertEqual(spool.recovered, [])
+        self.assertEqual(len(self.segments()), 1)
+
+    def test_group_commit(self):
+        spool = self.open(commit_delay=0.05)
+        ids = []
+        threads = [threading.Thread(target=lambda i=i: ids.append(spool.append(b'%d' % i))) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(len(ids), 20)
+        self.assertEqual(spool.appended, 20)
+        self.assertLess(spool.commits, 20)
+        spool.close()
+
+        self.assertEqual(len(self.open().recovered), 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import socket
+import sys
+import threading
+import unittest
+
+from hl7apy.mllp import MLLPServer, PooledMLLPServer, create_tls_context
+from hl7apy.mllp_client import MLLPClient
+
+from tests.support import AckHandler, client_tls_context, closed_by_peer, connect, make_certificate, message, msa, \
+    serve, temp_dir, wait_until
+
+
+def handshake_threads():
+    return [t for t in threading.enumerate() if t.name.startswith('mllp-handshake-') and t.is_alive()]
+
+
+class TLSTest(unittest.TestCase):
+
+    def setUp(self):
+        self.certificate = make_certificate(self)
+
+    def context(self):
+        return create_tls_context(*self.certificate)
+
+    def client(self):
+        client = MLLPClient(ssl_context=client_tls_context())
+        self.addCleanup(client.close)
+        return client
+
+    def check_server(self, server):
+        host, port = serve(self, server)
+        client = self.client()
+        for i in range(3):
+            self.assertEqual(msa(client.send(host, port, message(str(i))).result(5)), ('AA', str(i)))
+            # the server closes the connection once it has answered
+            self.assertTrue(wait_until(lambda: all(c.closed for c in client._pools[(host, port)])))
+        self.assertTrue(wait_until(lambda: server.tls_stats()['handshakes'] == 3))
+        stats = server.tls_stats()
+        self.assertEqual((stats['failed'], stats['refused'], stats['pending']), (0, 0, 0))
+        if sys.version_info >= (3, 6):
+            # the client resumes the session of its previous connection
+            self.assertGreaterEqual(stats['resumed'], 1)
+        else:
+            self.assertNotIn('resumed', stats)
+
+    def test_threaded_server(self):
+        self.check_server(MLLPServer('127.0.0.1', 0, {'*': (AckHandler,)}, ssl_context=self.context()))
+
+    def test_pooled_server(self):
+        self.check_server(PooledMLLPServer('127.0.0.1', 0, {'*': (AckHandler,)}, max_workers=2,
+                                           ssl_context=self.context()))
+
+    def test_failed_and_stalled_handshakes(self):
+        server = MLLPServer('127.0.0.1', 0, {'*': (AckHandler,)}, ssl_context=self.context(), handshake_timeout=0.3)
+        address = serve(self, server)
+        plain = connect(self, address)
+        plain.sendall(b'\x0bMSH|^~\\&|APP\r\x1c\r')
+        self.assertTrue(closed_by_peer(plain))
+        stalled = connect(self, address)
+        self.assertTrue(closed_by_peer(stalled))
+        self.assertTrue(wait_until(lambda: server.tls_stats()['failed'] == 2))
+        self.assertEqual(server.tls_stats()['handshakes'], 0)
+
+    def test_no_threads_are_left_when_bind_fails(self):
+        before = set(handshake_threads())
+        busy = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(busy.close)
+        busy.bind(('127.0.0.1', 0))
+        busy.listen(1)
+        for server_class in (MLLPServer, PooledMLLPServer):
+            self.assertRaises(socket.error, server_class, '127.0.0.1', busy.getsockname()[1],
+                              {'*': (AckHandler,)}, ssl_context=self.context())
+            self.assertRaises(ValueError, server_class, None, None, {'*': (AckHandler,)},
+                              ssl_context=self.context(), reuse_port=True,
+                              unix_path=os.path.join(temp_dir(self), 'mllp.sock'))
+        self.assertTrue(wait_until(lambda: set(handshake_threads()) <= before))
+
+    def test_threads_stop_when_the_server_is_closed(self):
+        before = set(handshake_threads())
+        server = MLLPServer('127.0.0.1', 0, {'*': (AckHandler,)}, ssl_context=self.context(), handshake_workers=3)
+        self.assertEqual(len(set(handshake_threads()) - before), 3)
+        server.server_close()
+        self.assertTrue(wait_until(lambda: set(handshake_threads()) <= before))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import os
+import socket
+import unittest
+
+import mllp2
+from hl7apy.mllp import AbstractHandler, MLLPServer, MSHHeader, PooledMLLPServer, build_ack
+
+from tests.support import AckHandler, connect, frame, import_modular_input, message, msa, read_messages, serve, \
+    temp_dir
+
+
+class RejectHandler(AbstractHandler):
+
+    def reply(self):
+        return build_ack(MSHHeader(self.incoming_message), 'AR')
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'Unix domain sockets are not supported')
+class UnixSocketTest(unittest.TestCase):
+
+    handlers = {'ADT^A01': (AckHandler,), 'ADT^A08': (RejectHandler,)}
+
+    def path(self):
+        return os.path.join(temp_dir(self), 'mllp.sock')
+
+    def check_server(self, server_class, **kwargs):
+        path = self.path()
+        server = server_class('127.0.0.1', 0, self.handlers, unix_path=path, **kwargs)
+        self.assertEqual(serve(self, server), path)
+        sock = connect(self, path)
+        sock.sendall(frame(message('1', 'ADT^A01')))
+        self.assertEqual(msa(read_messages(sock, 1)[0]), ('AA', '1'))
+        sock = connect(self, path)
+        sock.sendall(frame(message('2', 'ADT^A08')))
+        self.assertEqual(msa(read_messages(sock, 1)[0]), ('AR', '2'))
+        server.shutdown()
+        server.server_close()
+        self.assertFalse(os.path.exists(path))
+
+    def test_threaded_server(self):
+        self.check_server(MLLPServer)
+
+    def test_pooled_server(self):
+        self.check_server(PooledMLLPServer, max_workers=2)
+
+    def test_persistent_server(self):
+        path = self.path()
+        serve(self, mllp2.MLLPServer('127.0.0.1', 0, self.handlers, unix_path=path))
+        sock = connect(self, path)
+        sock.sendall(frame(message('1', 'ADT^A01')) + frame(message('2', 'ADT^A08')))
+        self.assertEqual([msa(ack) for ack in read_messages(sock, 2)], [('AA', '1'), ('AR', '2')])
+
+    def test_stale_socket_file_is_replaced(self):
+        path = self.path()
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(path)
+        stale.close()
+        serve(self, MLLPServer('127.0.0.1', 0, self.handlers, unix_path=path))
+        sock = connect(self, path)
+        sock.sendall(frame(message('1')))
+        self.assertEqual(msa(read_messages(sock, 1)[0]), ('AA', '1'))
+
+    def test_socket_of_a_running_server_is_kept(self):
+        path = self.path()
+        serve(self, MLLPServer('127.0.0.1', 0, self.handlers, unix_path=path))
+        self.assertRaises(socket.error, MLLPServer, '127.0.0.1', 0, self.handlers, unix_path=path)
+        # the running server still gets the connections
+        sock = connect(self, path)
+        sock.sendall(frame(message('1')))
+        self.assertEqual(msa(read_messages(sock, 1)[0]), ('AA', '1'))
+
+    def test_other_files_are_not_replaced(self):
+        path = self.path()
+        with open(path, 'w') as f:
+            f.write('data')
+        self.assertRaises(socket.error, MLLPServer, '127.0.0.1', 0, self.handlers, unix_path=path)
+        with open(path) as f:
+            self.assertEqual(f.read(), 'data')
+
+    def test_reuse_port_is_rejected(self):
+        path = self.path()
+        self.assertRaises(ValueError, MLLPServer, '127.0.0.1', 0, self.handlers, reuse_port=True, unix_path=path)
+        self.assertFalse(os.path.exists(path))
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'Unix domain sockets are not supported')
+class ModularInputUnixSocketTest(unittest.TestCase):
+
+    def check_input(self, params, server_class):
+        module = import_modular_input()
+        mi = module.MyInput()
+        path = os.path.join(temp_dir(self), 'mllp.sock')
+        params = dict(params, unix_socket=path)
+        server = mi.create_mllp_server(params)
+        self.assertIsInstance(server, server_class)
+        serve(self, server)
+        sock = connect(self, path)
+        sock.sendall(frame(message('1')))
+        self.assertEqual(msa(read_messages(sock, 1)[0]), ('AA', '1'))
+        self.assertEqual(mi._queue.qsize(), 1)
+
+    def test_threaded_server(self):
+        self.check_input({}, MLLPServer)
+
+    def test_pooled_server(self):
+        self.check_input({'max_connections': 2}, PooledMLLPServer)
+
+
+if __name__ == '__main__':
+    unittest.main()
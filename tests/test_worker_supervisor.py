@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import multiprocessing
+import os
+import signal
+import socket
+import time
+import unittest
+
+from hl7apy.mllp import MLLPServer, WorkerSupervisor
+
+from tests.support import AckHandler, connect, frame, message, msa, read_messages, serve, wait_until
+
+
+def exit_at_once(index):
+    pass
+
+
+def sleep_forever(index):
+    while True:
+        time.sleep(1)
+
+
+def drain_on_sigterm(index, ready):
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    ready.put(index)
+    while not stopping:
+        time.sleep(0.05)
+    # the time taken to drain
+    time.sleep(0.5)
+
+
+def map_in_pool(index, results):
+    pool = multiprocessing.Pool(1)
+    try:
+        results.put((index, pool.map(abs, [-1, -2, -3])))
+    finally:
+        pool.terminate()
+
+
+def ignore_sigterm(index, ready):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    ready.put(os.getpid())
+    sleep_forever(index)
+
+
+def follow_parent(index, parent_pid, ready):
+    ready.put(os.getpid())
+    while os.getppid() == parent_pid:
+        time.sleep(0.05)
+
+
+def supervise_follower(ready):
+    supervisor = WorkerSupervisor(follow_parent, 1, args=(os.getpid(), ready))
+    supervisor.start()
+    supervisor.supervise(poll_interval=0.05)
+
+
+def running(pid):
+    try:
+        with open('/proc/%d/stat' % pid) as stat:
+            return stat.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except (IOError, OSError):
+        return False
+
+
+class WorkerSupervisorTest(unittest.TestCase):
+
+    def supervisor(self, target, workers=1, **kwargs):
+        supervisor = WorkerSupervisor(target, workers, **kwargs)
+        self.addCleanup(supervisor.stop)
+        supervisor.start()
+        return supervisor
+
+    def test_failing_worker_is_restarted_with_backoff(self):
+        supervisor = self.supervisor(exit_at_once, min_uptime=60, restart_delay=0.2, max_restart_delay=0.3)
+        for expected_delay in (0.2, 0.3, 0.3):
+            self.assertTrue(wait_until(lambda: supervisor.alive() == 0))
+            restarts = supervisor.restarts
+            failed_at = time.time()
+            supervisor.check()
+            self.assertEqual(supervisor.restarts, restarts)
+            self.assertAlmostEqual(supervisor._restart_at[0] - failed_at, expected_delay, delta=0.1)
+            self.assertTrue(wait_until(lambda: supervisor.check() or supervisor.restarts > restarts))
+            self.assertGreaterEqual(time.time() - failed_at, expected_delay - 0.05)
+
+    def test_healthy_worker_is_restarted_at_once(self):
+        supervisor = self.supervisor(exit_at_once, workers=2, min_uptime=0, restart_delay=60)
+        self.assertTrue(wait_until(lambda: supervisor.alive() == 0))
+        supervisor.check()
+        self.assertEqual(supervisor.restarts, 2)
+        self.assertEqual(supervisor._failures, [0, 0])
+
+    def test_stop_terminates_the_workers(self):
+        supervisor = self.supervisor(sleep_forever, workers=2)
+        self.assertEqual(supervisor.alive(), 2)
+        supervisor.stop(5)
+        self.assertEqual(supervisor.alive(), 0)
+        supervisor.check()
+        self.assertEqual(supervisor.restarts, 0)
+
+    def test_terminate_doesnt_wait_for_the_workers(self):
+        ready = multiprocessing.Queue()
+        supervisor = self.supervisor(drain_on_sigterm, workers=2, args=(ready,))
+        for i in range(2):
+            ready.get(timeout=10)
+        started = time.time()
+        supervisor.terminate()
+        self.assertLess(time.time() - started, 0.3)
+        self.assertEqual(supervisor.alive(), 2)
+
+        # supervise() returns and the draining workers aren't restarted
+        supervisor.supervise(poll_interval=0.05)
+        supervisor.check()
+        supervisor.stop(5)
+        self.assertGreaterEqual(time.time() - started, 0.45)
+        self.assertEqual(supervisor.alive(), 0)
+        self.assertEqual(supervisor.restarts, 0)
+        self.assertEqual([p.exitcode for p in supervisor._processes], [0, 0])
+
+    def test_workers_can_start_a_pool(self):
+        results = multiprocessing.Queue()
+        supervisor = self.supervisor(map_in_pool, workers=2, args=(results,), min_uptime=60)
+        self.assertEqual(sorted(results.get(timeout=10) for i in range(2)), [(0, [1, 2, 3]), (1, [1, 2, 3])])
+        self.assertTrue(wait_until(lambda: supervisor.alive() == 0))
+        self.assertEqual([p.exitcode for p in supervisor._processes], [0, 0])
+
+    def test_stop_kills_the_workers_left(self):
+        ready = multiprocessing.Queue()
+        supervisor = self.supervisor(ignore_sigterm, args=(ready,))
+        ready.get(timeout=10)
+        supervisor.stop(0.2)
+        self.assertEqual(supervisor.alive(), 0)
+        self.assertEqual(supervisor._processes[0].exitcode, -signal.SIGKILL)
+
+    @unittest.skipUnless(os.path.isdir('/proc'), 'needs /proc to check the orphaned worker')
+    def test_worker_exits_with_the_supervisor(self):
+        ready = multiprocessing.Queue()
+        parent = multiprocessing.Process(target=supervise_follower, args=(ready,))
+        parent.start()
+        self.addCleanup(parent.join)
+        worker = ready.get(timeout=10)
+        self.assertTrue(running(worker))
+        os.kill(parent.pid, signal.SIGKILL)
+        self.assertTrue(wait_until(lambda: not running(worker)))
+
+
+@unittest.skipUnless(hasattr(socket, 'SO_REUSEPORT'), 'SO_REUSEPORT is not supported')
+class ReusePortTest(unittest.TestCase):
+
+    def test_servers_share_the_port(self):
+        first = MLLPServer('127.0.0.1', 0, {'*': (AckHandler,)}, reuse_port=True)
+        address = serve(self, first)
+        second = MLLPServer('127.0.0.1', address[1], {'*': (AckHandler,)}, reuse_port=True)
+        serve(self, second)
+        for i in range(4):
+            sock = connect(self, address)
+            sock.sendall(frame(message(str(i))))
+            self.assertEqual(msa(read_messages(sock, 1)[0]), ('AA', str(i)))
+
+    def test_port_is_not_shared_without_reuse_port(self):
+        first = MLLPServer('127.0.0.1', 0, {'*': (AckHandler,)}, reuse_port=True)
+        address = serve(self, first)
+        self.assertRaises(socket.error, MLLPServer, '127.0.0.1', address[1], {'*': (AckHandler,)})
+
+
+if __name__ == '__main__':
+    unittest.main()